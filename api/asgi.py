@@ -0,0 +1,479 @@
+"""
+ASGI entry point: the same LINE bot on a fully async serving path.
+
+Upstream calls (OpenAI, Jina search, scraping) go through one shared
+httpx.AsyncClient and LINE calls through the SDK's async API, so a single
+process can hold thousands of slow upstream calls without a thread each.
+Transcript fetching has no async client and runs in a worker thread.
+
+It runs alongside api/main.py (same environment variables), e.g.
+    uvicorn api.asgi:app --host 0.0.0.0 --port 8080
+"""
+import os
+import uuid
+import asyncio
+import base64
+import functools
+
+from dotenv import load_dotenv
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import (MessageEvent, TextMessageContent,
+                                 AudioMessageContent, ImageMessageContent)
+
+load_dotenv('.env')
+
+from src.models import OpenAIModel, AsyncOpenAIModel
+from src.admission import AdmissionController, AdmissionRejected
+from src.singleflight import AsyncSingleFlight
+from src.webhook import ConcurrentWebhookHandler, RecentEventIds, MongoEventIdStore
+from src.deadline import Deadline, DeadlineExceeded, DEADLINE_MESSAGE, request_deadline, current_deadline
+from src.http_client import aclose_async_client
+from src import metrics
+from src.memory import Memory, MemoryCompactor
+from src.longterm import LongTermMemory
+from src.documents import DocumentStore
+from src.routing import ModelRouter
+from src.accounting import UsageAccounting
+from src.jobs import background_jobs_enabled
+from src.streaming import ProgressiveDelivery
+from src.messages import HELP_MESSAGE
+from src.logger import get_logger
+from src.utils import get_role_and_content
+from src.lazy import LazyModule
+from src.mongodb import mongodb
+
+
+logger = get_logger('asgi')
+messaging = LazyModule('linebot.v3.messaging')
+youtube_service = LazyModule('src.service.youtube')
+website_service = LazyModule('src.service.website')
+event_id_store = None
+if os.getenv('WEBHOOK_DEDUP_MONGODB', 'false').lower() == 'true':
+    mongodb.connect_to_database()
+    event_id_store = MongoEventIdStore(mongodb.db, ttl=int(os.getenv('WEBHOOK_DEDUP_TTL', '600')))
+event_ids = RecentEventIds(ttl=int(os.getenv('WEBHOOK_DEDUP_TTL', '600')), store=event_id_store)
+line_handler = ConcurrentWebhookHandler.from_env(os.getenv('LINE_CHANNEL_SECRET'), event_ids=event_ids)
+
+accounting = UsageAccounting.from_env()
+compactor = None
+if os.getenv('COMPACTION_MODEL_ENGINE'):
+    # 背景摘要只由 compactor 自己的 worker 數量限制，不佔用回覆用的 admission slot
+    compactor = MemoryCompactor.from_env(OpenAIModel(api_key=os.getenv('OPENAI_API_KEY'), accounting=accounting))
+long_term = LongTermMemory.from_env(OpenAIModel(api_key=os.getenv('OPENAI_API_KEY'), accounting=accounting))
+memory = Memory(system_message=os.getenv('SYSTEM_MESSAGE'), memory_message_count=20, compactor=compactor,
+                long_term=long_term)
+documents = DocumentStore.from_env()
+image_detail = os.getenv('IMAGE_DETAIL') or 'low'  # low, high, or auto
+BLOB_TIMEOUT = 20
+REPLY_MIN_TIMEOUT = 5
+PUSH_TIMEOUT = 20
+# 長回答分段送出：第一段用 reply，之後以 push 送出（push 會計入訊息額度）
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', 'false').lower() == 'true'
+# Vercel 回應送出後 instance 會被凍結，背景工作改在 request 內完成
+BACKGROUND_JOBS = background_jobs_enabled()
+admission = AdmissionController.from_env()
+router = ModelRouter.from_env()
+url_flight = AsyncSingleFlight()
+model_management = {}
+
+metrics.registry.register_collector('linebot_admission', admission.metrics)
+metrics.registry.register_collector('linebot_singleflight', url_flight.metrics)
+metrics.registry.register_collector('linebot_webhook_dedup', event_ids.metrics)
+metrics.registry.register_collector('linebot_webhook_batch', line_handler.metrics)
+metrics.registry.register_collector('linebot_route', router.metrics, label='route')
+metrics.registry.register_collector('linebot_accounting', accounting.metrics)
+if compactor is not None:
+    metrics.registry.register_collector('linebot_memory_compaction', compactor.metrics)
+if long_term is not None:
+    metrics.registry.register_collector('linebot_long_term_memory', long_term.metrics)
+if documents is not None:
+    metrics.registry.register_collector('linebot_documents', documents.metrics)
+
+_line_api_client = None
+
+
+async def get_history(user_id, deadline):
+    # Memory 的使用者鎖也會被摘要與長期記憶的 worker 持有，檢索也可能要呼叫 embedding API，
+    # 所有 Memory 操作都不在 event loop 上執行
+    return await asyncio.to_thread(memory.get, user_id, deadline)
+
+
+async def get_chat_history(user_id, deadline):
+    history = await get_history(user_id, deadline)
+    # 追問上一份文件時，附上全文中最相關的段落
+    return documents.augment(user_id, history) if documents is not None else history
+
+
+def get_line_api_client():
+    # aiohttp session 需要在 event loop 中建立
+    global _line_api_client
+    if _line_api_client is None:
+        _line_api_client = messaging.AsyncApiClient(messaging.Configuration(
+            host=os.getenv('LINE_API_HOST') or None,
+            access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN')))
+    return _line_api_client
+
+
+def get_line_bot_api():
+    return messaging.AsyncMessagingApi(get_line_api_client())
+
+
+def get_blob_api():
+    return messaging.AsyncMessagingApiBlob(get_line_api_client())
+
+
+@functools.lru_cache(maxsize=None)
+def get_youtube():
+    return youtube_service.Youtube()
+
+
+@functools.lru_cache(maxsize=None)
+def get_website():
+    return website_service.AsyncWebsite()
+
+
+def get_user_model(user_id):
+    if user_id not in model_management:
+        model_management[user_id] = AsyncOpenAIModel(
+            api_key=os.getenv('OPENAI_API_KEY'), admission=admission, router=router,
+            accounting=accounting, user_id=user_id)
+    return model_management[user_id]
+
+
+async def reply_message(event, msg, deadline):
+    with metrics.track('line_reply'):
+        await get_line_bot_api().reply_message(
+            messaging.ReplyMessageRequest(reply_token=event.reply_token, messages=[msg]),
+            _request_timeout=max(REPLY_MIN_TIMEOUT, deadline.remaining()))
+
+
+async def reply_if_expired(event, deadline):
+    # 同一批中較晚開始的事件，request 的時間可能已經用完，只回覆簡短訊息
+    if not deadline.expired():
+        return False
+    await reply_message(event, messaging.TextMessage(text=DEADLINE_MESSAGE), deadline)
+    return True
+
+
+async def push_message(to, msg):
+    with metrics.track('line_push'):
+        await get_line_bot_api().push_message(
+            messaging.PushMessageRequest(to=to, messages=[msg]),
+            _request_timeout=PUSH_TIMEOUT)
+
+
+def push_target(source):
+    return getattr(source, 'group_id', None) or getattr(source, 'room_id', None) or source.user_id
+
+
+def build_document(source, chunks):
+    # 保留完整內文給後續追問；在 single flight 內建立一次，共用同一份摘要的使用者共用索引
+    return documents.build(source, chunks) if documents is not None else None
+
+
+async def summarize_youtube(user_model, video_id, deadline, on_section=None):
+    is_successful, chunks, error_message = await asyncio.to_thread(
+        get_youtube().get_transcript_chunks, video_id, deadline)
+    if not is_successful:
+        raise Exception(error_message)
+    reader = youtube_service.AsyncYoutubeTranscriptReader(user_model, os.getenv('OPENAI_MODEL_ENGINE'))
+    is_successful, response, error_message = await reader.summarize(chunks, deadline=deadline, on_section=on_section)
+    if not is_successful:
+        raise Exception(error_message)
+    document = await asyncio.to_thread(build_document, f'https://www.youtube.com/watch?v={video_id}', chunks)
+    return get_role_and_content(response) + (document,)
+
+
+async def summarize_website(user_model, url, deadline, on_section=None):
+    chunks = await get_website().get_content_from_url(url, deadline=deadline)
+    if len(chunks) == 0:
+        raise Exception('無法撈取此網站文字')
+    reader = website_service.AsyncWebsiteReader(user_model, os.getenv('OPENAI_MODEL_ENGINE'))
+    is_successful, response, error_message = await reader.summarize(chunks, deadline=deadline, on_section=on_section)
+    if not is_successful:
+        raise Exception(error_message)
+    document = await asyncio.to_thread(build_document, url, chunks)
+    return get_role_and_content(response) + (document,)
+
+
+async def error_message_for(user_id, error_msg):
+    await asyncio.to_thread(memory.remove, user_id)
+    if error_msg.startswith('Incorrect API key provided'):
+        return 'OpenAI API Token 有誤，請重新註冊。'
+    if 'overloaded' in error_msg.lower():
+        return '已超過負荷，請稍後再試'
+    return error_msg
+
+
+@line_handler.add(MessageEvent, message=TextMessageContent)
+async def handle_text_message(event):
+    deadline = current_deadline()
+    if await reply_if_expired(event, deadline):
+        return
+    with metrics.handler_latency.time(handler='text'):
+        await _handle_text_message(event, deadline)
+
+
+async def _handle_text_message(event, deadline):
+    user_id = event.source.user_id
+    text = event.message.text.strip()
+    user_model = get_user_model(user_id)
+    delivery = ProgressiveDelivery(
+        lambda msg: reply_message(event, msg, deadline),
+        lambda msg: push_message(push_target(event.source), msg))
+    on_section = None
+    if STREAM_REPLIES:
+        async def on_section(section):
+            await delivery.send(messaging.TextMessage(text=section))
+
+    try:
+        if text.startswith('/help'):
+            msg = messaging.TextMessage(text=HELP_MESSAGE)
+        elif text.startswith('/系統訊息'):
+            await asyncio.to_thread(memory.change_system_message, user_id, text[5:].strip())
+            msg = messaging.TextMessage(text='輸入成功')
+        elif text.startswith('忘記'):
+            await asyncio.to_thread(memory.forget, user_id)
+            if documents is not None:
+                documents.remove(user_id)
+            msg = messaging.TextMessage(text='歷史訊息清除成功')
+        elif text.startswith('圖像'):
+            admission.admit(user_id)
+            prompt = text[3:].strip()
+            await asyncio.to_thread(memory.append, user_id, 'user', prompt)
+            is_successful, response, error_message = await user_model.image_generations(prompt, deadline=deadline)
+            if not is_successful:
+                raise Exception(error_message)
+            url = response['data'][0]['url']
+            msg = messaging.ImageMessage(original_content_url=url, preview_image_url=url)
+            await asyncio.to_thread(memory.append, user_id, 'assistant', url)
+        elif text.lower().startswith('ext'):
+            admission.admit(user_id)
+            await asyncio.to_thread(memory.append, user_id, 'user', text[3:].strip())
+            is_successful, result, error_message = await user_model.chat_with_ext_multi_turn(
+                await get_history(user_id, deadline), os.getenv('OPENAI_MODEL_ENGINE'),
+                max_iterations=15, max_tool_calls=5, deadline=deadline)
+            if not is_successful:
+                raise Exception(error_message)
+            msg = messaging.TextMessage(text=result['content'])
+            await asyncio.to_thread(memory.append, user_id, result['role'], result['content'])
+        else:
+            admission.admit(user_id)
+            await asyncio.to_thread(memory.append, user_id, 'user', text)
+            url = get_website().get_url_from_text(text)
+            if url:
+                video_id = get_youtube().retrieve_video_id(text)
+                if video_id:
+                    role, response, document = await url_flight.do(
+                        f'youtube:{video_id}', summarize_youtube, user_model, video_id, deadline, on_section,
+                        timeout=deadline.remaining())
+                else:
+                    role, response, document = await url_flight.do(
+                        get_website().normalize_url(url), summarize_website, user_model, url, deadline, on_section,
+                        timeout=deadline.remaining())
+                if documents is not None:
+                    documents.put(user_id, document)
+            elif on_section is not None:
+                is_successful, response, error_message = await user_model.chat_completions_stream(
+                    await get_chat_history(user_id, deadline), os.getenv('OPENAI_MODEL_ENGINE'), on_section=on_section, deadline=deadline, task='chat')
+                if not is_successful:
+                    raise Exception(error_message)
+                role, response = get_role_and_content(response)
+            else:
+                is_successful, response, error_message = await user_model.chat_completions(
+                    await get_chat_history(user_id, deadline), os.getenv('OPENAI_MODEL_ENGINE'), deadline=deadline, task='chat')
+                if not is_successful:
+                    raise Exception(error_message)
+                role, response = get_role_and_content(response)
+            # 串流時回答已分段送出；共用同一個摘要的其他使用者則在這裡收到完整回答
+            msg = None if delivery.sent else messaging.TextMessage(text=response)
+            await asyncio.to_thread(memory.append, user_id, role, response)
+    except AdmissionRejected as e:
+        msg = messaging.TextMessage(text=str(e))
+    except (DeadlineExceeded, asyncio.TimeoutError):
+        msg = messaging.TextMessage(text=DEADLINE_MESSAGE)
+    except Exception as e:
+        msg = messaging.TextMessage(text=await error_message_for(user_id, str(e)))
+    if msg is not None:
+        await delivery.send(msg)
+
+
+@line_handler.add(MessageEvent, message=AudioMessageContent)
+async def handle_audio_message(event):
+    deadline = current_deadline()
+    if await reply_if_expired(event, deadline):
+        return
+    with metrics.handler_latency.time(handler='audio'):
+        await _handle_audio_message(event, deadline)
+
+
+async def _handle_audio_message(event, deadline):
+    user_id = event.source.user_id
+    user_model = get_user_model(user_id)
+    input_audio_path = f'{str(uuid.uuid4())}.m4a'
+    try:
+        admission.admit(user_id)
+        with metrics.track('line_blob'):
+            audio_content = await get_blob_api().get_message_content(
+                event.message.id, _request_timeout=deadline.timeout(BLOB_TIMEOUT))
+        await asyncio.to_thread(_write_file, input_audio_path, audio_content)
+        is_successful, response, error_message = await user_model.audio_transcriptions(
+            input_audio_path, 'whisper-1', deadline=deadline)
+        if not is_successful:
+            raise Exception(error_message)
+        await asyncio.to_thread(memory.append, user_id, 'user', response['text'])
+        is_successful, response, error_message = await user_model.chat_completions(
+            await get_history(user_id, deadline), os.getenv('OPENAI_MODEL_ENGINE'), deadline=deadline, task='chat')
+        if not is_successful:
+            raise Exception(error_message)
+        role, response = get_role_and_content(response)
+        await asyncio.to_thread(memory.append, user_id, role, response)
+        msg = messaging.TextMessage(text=response)
+    except AdmissionRejected as e:
+        msg = messaging.TextMessage(text=str(e))
+    except (DeadlineExceeded, asyncio.TimeoutError):
+        msg = messaging.TextMessage(text=DEADLINE_MESSAGE)
+    except Exception as e:
+        msg = messaging.TextMessage(text=await error_message_for(user_id, str(e)))
+    finally:
+        if os.path.exists(input_audio_path):
+            os.remove(input_audio_path)
+    await reply_message(event, msg, deadline)
+
+
+@line_handler.add(MessageEvent, message=ImageMessageContent)
+async def handle_image_message(event):
+    deadline = current_deadline()
+    if await reply_if_expired(event, deadline):
+        return
+    with metrics.handler_latency.time(handler='image'):
+        await _handle_image_message(event, deadline)
+
+
+async def _handle_image_message(event, deadline):
+    user_id = event.source.user_id
+    user_model = get_user_model(user_id)
+    try:
+        admission.admit(user_id)
+        with metrics.track('line_blob'):
+            image_content = await get_blob_api().get_message_content(
+                event.message.id, _request_timeout=deadline.timeout(BLOB_TIMEOUT))
+        image_data = base64.b64encode(image_content).decode('utf-8')
+        await asyncio.to_thread(memory.append, user_id, 'user', [
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f'data:image/jpeg;base64,{image_data}',
+                    "detail": image_detail
+                }
+            },
+            {
+                "type": "text",
+                "text": "仔細觀察圖片上面的所有細節包含文字。詳細描述圖片上的內容並說明；如果你覺得他是個meme，說明他想傳達的情境，如果不是就不用特別說明"
+            }
+        ])
+        is_successful, response, error_message = await user_model.chat_completions(
+            await get_history(user_id, deadline), os.getenv('OPENAI_MODEL_ENGINE'), deadline=deadline, task='chat')
+        if not is_successful:
+            raise Exception(error_message)
+        role, response = get_role_and_content(response)
+        await asyncio.to_thread(memory.append, user_id, role, response)
+        msg = messaging.TextMessage(text=response)
+    except AdmissionRejected as e:
+        msg = messaging.TextMessage(text=str(e))
+    except (DeadlineExceeded, asyncio.TimeoutError):
+        msg = messaging.TextMessage(text=DEADLINE_MESSAGE)
+    except Exception as e:
+        msg = messaging.TextMessage(text=await error_message_for(user_id, str(e)))
+    await reply_message(event, msg, deadline)
+
+
+def _write_file(path, content):
+    with open(path, 'wb') as fd:
+        fd.write(content)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_response(send, status, body, content_type='text/plain; charset=utf-8'):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def finish_background_work(deadline):
+    # 在回應之前把摘要、長期記憶與用量寫完，最多等到 deadline
+    if compactor is not None and not compactor.drain(deadline.remaining()):
+        logger.warning('memory compaction still running at the deadline')
+    if long_term is not None and not long_term.drain(deadline.remaining()):
+        logger.warning('long-term memory updates still running at the deadline')
+    try:
+        accounting.flush()
+    except Exception:
+        logger.exception('failed to flush usage')
+
+
+async def callback(scope, receive, send):
+    headers = dict(scope['headers'])
+    signature = headers.get(b'x-line-signature', b'').decode()
+    body = (await read_body(receive)).decode('utf-8')
+    logger.debug('Request body: %s', body)
+    deadline = Deadline.from_env()
+    request_deadline.set(deadline)
+    status, text = 200, 'OK'
+    try:
+        await line_handler.handle_async(body, signature)
+    except InvalidSignatureError:
+        logger.warning('Invalid signature. Please check your channel access token/channel secret.')
+        return await send_response(send, 400, 'Bad Request')
+    except Exception:
+        # 失敗的事件已記錄並釋放 event id，回 500 讓 LINE 重送
+        status, text = 500, 'Internal Server Error'
+    if not BACKGROUND_JOBS:
+        await asyncio.to_thread(finish_background_work, deadline)
+    await send_response(send, status, text)
+
+
+async def lifespan(receive, send):
+    global _line_api_client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aclose_async_client()
+            await asyncio.to_thread(accounting.close)
+            if _line_api_client is not None:
+                client, _line_api_client = _line_api_client, None
+                await client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path']
+    if path == '/callback' and method == 'POST':
+        await callback(scope, receive, send)
+    elif path == '/' and method == 'GET':
+        await send_response(send, 200, 'Hello World')
+    elif path == '/metrics' and method == 'GET':
+        await send_response(send, 200, metrics.registry.render(), 'text/plain; version=0.0.4')
+    else:
+        await send_response(send, 404, 'Not Found')
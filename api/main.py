@@ -1,184 +1,425 @@
 from dotenv import load_dotenv
-from flask import Flask, request, abort
-from linebot.v3 import (WebhookHandler)
+from flask import Flask, request, abort, Response, jsonify, send_from_directory
 from linebot.v3.exceptions import (InvalidSignatureError)
-from linebot.v3.messaging import (Configuration, ApiClient, MessagingApi,
-                                  ReplyMessageRequest, TextMessage,
-                                  ImageMessage, MessagingApiBlob, PushMessageRequest)
 from linebot.v3.webhooks import (MessageEvent, TextMessageContent,
                                  AudioMessageContent, ImageMessageContent)
 
 import os
 import uuid
+import atexit
 import base64
+import functools
+import contextvars
+
+# src 模組在 import 時會讀取環境變數（例如 logger 設定），需先載入 .env
+load_dotenv('.env')
 
 from src.models import OpenAIModel
-from src.memory import Memory
-# from src.logger import logger
+from src.admission import AdmissionController, AdmissionRejected
+from src.scheduler import LaneScheduler
+from src.singleflight import SingleFlight
+from src.webhook import ConcurrentWebhookHandler, RecentEventIds, MongoEventIdStore
+from src.deadline import Deadline, DeadlineExceeded, DEADLINE_MESSAGE, request_deadline, current_deadline
+from src import metrics
+from src.profiling import RequestProfiler
+from src.memory import Memory, MemoryCompactor
+from src.longterm import LongTermMemory
+from src.documents import DocumentStore
+from src.routing import ModelRouter
+from src.accounting import UsageAccounting
+from src.jobs import ImageJobQueue, IMAGE_ACCEPTED_MESSAGE, background_jobs_enabled
+from src.streaming import ProgressiveDelivery
+from src.messages import HELP_MESSAGE
+from src.logger import get_logger
 from src.storage import Storage, FileStorage, MongoStorage
 from src.utils import get_role_and_content
-from src.service.youtube import Youtube, YoutubeTranscriptReader
-from src.service.website import Website, WebsiteReader
+from src.lazy import LazyModule
 from src.mongodb import mongodb
 from datetime import datetime,timedelta
 
 
-load_dotenv('.env')
-
+logger = get_logger('main')
 app = Flask(__name__)
-configuration = Configuration(access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
-line_bot_api = MessagingApi(ApiClient(configuration))
-blob_api = MessagingApiBlob(ApiClient(configuration))
-line_handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
+# LINE messaging SDK、字幕與網頁擷取模組都很重，等第一次用到時才 import / 建立
+messaging = LazyModule('linebot.v3.messaging')
+youtube_service = LazyModule('src.service.youtube')
+website_service = LazyModule('src.service.website')
+event_id_store = None
+if os.getenv('WEBHOOK_DEDUP_MONGODB', 'false').lower() == 'true':
+    mongodb.connect_to_database()
+    event_id_store = MongoEventIdStore(mongodb.db, ttl=int(os.getenv('WEBHOOK_DEDUP_TTL', '600')))
+event_ids = RecentEventIds(ttl=int(os.getenv('WEBHOOK_DEDUP_TTL', '600')), store=event_id_store)
+line_handler = ConcurrentWebhookHandler.from_env(os.getenv('LINE_CHANNEL_SECRET'), event_ids=event_ids)
 storage = None
-youtube = Youtube()
-website = Website()
 
-memory = Memory(system_message=os.getenv('SYSTEM_MESSAGE'), memory_message_count=20)
+accounting = UsageAccounting.from_env()
+compactor = None
+if os.getenv('COMPACTION_MODEL_ENGINE'):
+    # 背景摘要只由 compactor 自己的 worker 數量限制，不佔用回覆用的 admission slot
+    compactor = MemoryCompactor.from_env(OpenAIModel(api_key=os.getenv('OPENAI_API_KEY'), accounting=accounting))
+long_term = LongTermMemory.from_env(OpenAIModel(api_key=os.getenv('OPENAI_API_KEY'), accounting=accounting))
+memory = Memory(system_message=os.getenv('SYSTEM_MESSAGE'), memory_message_count=20, compactor=compactor,
+                long_term=long_term)
+documents = DocumentStore.from_env()
 image_detail = os.getenv('IMAGE_DETAIL') or 'low'  # low, high, or auto
+BLOB_TIMEOUT = 20
+PUSH_TIMEOUT = 20
+# 長回答分段送出：第一段用 reply，之後以 push 送出（push 會計入訊息額度）
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', 'false').lower() == 'true'
+REPLY_MIN_TIMEOUT = 5
+# Vercel 回應送出後 instance 會被凍結，背景工作改在 request 內完成
+BACKGROUND_JOBS = background_jobs_enabled()
+admission = AdmissionController.from_env()
+router = ModelRouter.from_env()
+# lane: (weight, max_concurrency)
+scheduler = LaneScheduler.from_env({
+    'chat': (6, 8),
+    'media': (3, 4),
+    'bulk': (1, 3),
+})
+url_flight = SingleFlight()
+profiler = RequestProfiler.from_env()
+# 在 callback 中設定；batch 中的事件會在其他 thread 執行，無法直接讀取 request.headers
+profile_requested = contextvars.ContextVar('profile_requested', default=False)
 model_management = {}
 api_keys = {}
 
+metrics.registry.register_collector('linebot_admission', admission.metrics)
+metrics.registry.register_collector('linebot_lane', scheduler.metrics, label='lane')
+metrics.registry.register_collector('linebot_singleflight', url_flight.metrics)
+metrics.registry.register_collector('linebot_webhook_dedup', event_ids.metrics)
+metrics.registry.register_collector('linebot_webhook_batch', line_handler.metrics)
+metrics.registry.register_collector('linebot_route', router.metrics, label='route')
+metrics.registry.register_collector('linebot_accounting', accounting.metrics)
+# 結束前寫入尚未 flush 的用量
+atexit.register(accounting.close)
+if compactor is not None:
+    metrics.registry.register_collector('linebot_memory_compaction', compactor.metrics)
+if long_term is not None:
+    metrics.registry.register_collector('linebot_long_term_memory', long_term.metrics)
+if documents is not None:
+    metrics.registry.register_collector('linebot_documents', documents.metrics)
+
+
+@functools.lru_cache(maxsize=None)
+def get_line_configuration():
+    # host 為 None 時 SDK 依各 API 使用預設網域（api.line.me / api-data.line.me）；
+    # 設定 LINE_API_HOST 時所有 API（含 blob）都會改打該網域，例如壓力測試的 stub
+    return messaging.Configuration(
+        host=os.getenv('LINE_API_HOST') or None,
+        access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
+
+
+@functools.lru_cache(maxsize=None)
+def get_line_bot_api():
+    return messaging.MessagingApi(messaging.ApiClient(get_line_configuration()))
+
+
+@functools.lru_cache(maxsize=None)
+def get_blob_api():
+    return messaging.MessagingApiBlob(messaging.ApiClient(get_line_configuration()))
+
+
+@functools.lru_cache(maxsize=None)
+def get_youtube():
+    return youtube_service.Youtube()
+
+
+@functools.lru_cache(maxsize=None)
+def get_website():
+    return website_service.Website()
+
+
+def get_reply_timeout(deadline):
+    # reply 是最後一步，即使 deadline 已到仍給予最少的時間送出錯誤訊息
+    return max(REPLY_MIN_TIMEOUT, deadline.remaining())
+
+
+def reply_message(event, msg, deadline):
+    with metrics.track('line_reply'):
+        get_line_bot_api().reply_message_with_http_info(
+            messaging.ReplyMessageRequest(reply_token=event.reply_token, messages=[msg]),
+            _request_timeout=get_reply_timeout(deadline))
+
+
+def reply_if_expired(event, deadline):
+    # 同一批中較晚開始的事件，request 的時間可能已經用完，只回覆簡短訊息
+    if not deadline.expired():
+        return False
+    reply_message(event, messaging.TextMessage(text=DEADLINE_MESSAGE), deadline)
+    return True
+
+
+def push_message(to, msg):
+    with metrics.track('line_push'):
+        get_line_bot_api().push_message_with_http_info(
+            messaging.PushMessageRequest(to=to, messages=[msg]),
+            _request_timeout=PUSH_TIMEOUT)
+
+
+def push_target(source):
+    # 群組與聊天室中要推播回原本的對話，而不是私訊使用者
+    return getattr(source, 'group_id', None) or getattr(source, 'room_id', None) or source.user_id
+
+
+def deliver_image(user_id, to, prompt, is_successful, response, error_message):
+    if is_successful:
+        url = response['data'][0]['url']
+        msg = messaging.ImageMessage(original_content_url=url, preview_image_url=url)
+        memory.append(user_id, 'assistant', url)
+    else:
+        msg = messaging.TextMessage(text=error_message or '圖片產生失敗，請稍後再試')
+    push_message(to, msg)
+
+
+image_jobs = None
+if BACKGROUND_JOBS:
+    image_jobs = ImageJobQueue.from_env(scheduler, deliver_image)
+    metrics.registry.register_collector('linebot_image_jobs', image_jobs.metrics)
+
+
+def finish_background_work(deadline):
+    # 在回應之前把摘要、長期記憶與用量寫完，最多等到 deadline
+    if compactor is not None and not compactor.drain(deadline.remaining()):
+        logger.warning('memory compaction still running at the deadline')
+    if long_term is not None and not long_term.drain(deadline.remaining()):
+        logger.warning('long-term memory updates still running at the deadline')
+    try:
+        accounting.flush()
+    except Exception:
+        logger.exception('failed to flush usage')
+
+
+def profiled(fn, name, event):
+    return profiler.wrap(fn, name, event.source.user_id, profile_requested.get())
+
+
+def get_user_model(user_id):
+    if user_id not in model_management:
+        model_management[user_id] = OpenAIModel(
+            api_key=os.getenv('OPENAI_API_KEY'), admission=admission, router=router,
+            accounting=accounting, user_id=user_id)
+    return model_management[user_id]
+
 
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    logger.debug('Request body: %s', body)
+    profile_requested.set(profiler.is_requested(request.headers))
+    deadline = Deadline.from_env()
+    request_deadline.set(deadline)
+    failed = False
     try:
         line_handler.handle(body, signature)
     except InvalidSignatureError:
-        print("Invalid signature. Please check your channel access token/channel secret.")
+        logger.warning('Invalid signature. Please check your channel access token/channel secret.')
         abort(400)
+    except Exception:
+        # 失敗的事件已記錄並釋放 event id，回 500 讓 LINE 重送
+        failed = True
+    if not BACKGROUND_JOBS:
+        finish_background_work(deadline)
+    if failed:
+        return 'Internal Server Error', 500
     return 'OK'
 
 
+def get_chat_history(user_id, deadline):
+    history = memory.get(user_id, deadline=deadline)
+    # 追問上一份文件時，附上全文中最相關的段落
+    return documents.augment(user_id, history) if documents is not None else history
+
+
+def build_document(source, chunks):
+    # 保留完整內文給後續追問；在 single flight 內建立一次，共用同一份摘要的使用者共用索引
+    return documents.build(source, chunks) if documents is not None else None
+
+
+def summarize_youtube(user_model, video_id, deadline, on_section=None):
+    is_successful, chunks, error_message = get_youtube().get_transcript_chunks(video_id, deadline=deadline)
+    if not is_successful:
+        raise Exception(error_message)
+    youtube_transcript_reader = youtube_service.YoutubeTranscriptReader(
+        user_model, os.getenv('OPENAI_MODEL_ENGINE'))
+    is_successful, response, error_message = youtube_transcript_reader.summarize(
+        chunks, deadline=deadline, on_section=on_section)
+    if not is_successful:
+        raise Exception(error_message)
+    document = build_document(f'https://www.youtube.com/watch?v={video_id}', chunks)
+    return get_role_and_content(response) + (document,)
+
+
+def summarize_website(user_model, url, deadline, on_section=None):
+    chunks = get_website().get_content_from_url(url, deadline=deadline)
+    if len(chunks) == 0:
+        raise Exception('無法撈取此網站文字')
+    website_reader = website_service.WebsiteReader(user_model, os.getenv('OPENAI_MODEL_ENGINE'))
+    is_successful, response, error_message = website_reader.summarize(
+        chunks, deadline=deadline, on_section=on_section)
+    if not is_successful:
+        raise Exception(error_message)
+    document = build_document(url, chunks)
+    return get_role_and_content(response) + (document,)
+
+
+def get_text_lane(text):
+    if text.startswith(('/help', '/系統訊息', '忘記')):
+        return 'chat'
+    if text.startswith('圖像'):
+        # 排入 image_jobs 時只是登記工作，實際產生圖片在 media lane 執行
+        return 'chat' if image_jobs is not None else 'media'
+    if text.lower().startswith('ext') or get_website().get_url_from_text(text):
+        return 'bulk'
+    return 'chat'
+
+
 @line_handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_message(event):
+    deadline = current_deadline()
+    if reply_if_expired(event, deadline):
+        return
+    with metrics.handler_latency.time(handler='text'):
+        scheduler.run(get_text_lane(event.message.text.strip()),
+                      profiled(_handle_text_message, 'text', event), event, deadline)
+
+
+def _handle_text_message(event, deadline):
     user_id = event.source.user_id
     text = event.message.text.strip()
-    # logger.info(f'{user_id}: {text}')
-    print(f'{user_id}: {text}')
-    if user_id not in model_management:
-        model_management[user_id] = OpenAIModel(api_key=os.getenv('OPENAI_API_KEY'))
+    logger.debug('%s: %s', user_id, text)
+    get_user_model(user_id)
+    delivery = ProgressiveDelivery(
+        lambda msg: reply_message(event, msg, deadline),
+        lambda msg: push_message(push_target(event.source), msg))
+    on_section = None
+    if STREAM_REPLIES:
+        def on_section(section):
+            delivery.send(messaging.TextMessage(text=section))
 
     try:
         if text.startswith('/help'):
-            msg = TextMessage(text="""指令：
-/註冊 + API Token
-👉 API Token 請先到 https://platform.openai.com/ 註冊登入後取得\n
-/系統訊息 + Prompt
-👉 Prompt 可以命令機器人扮演某個角色，例如：請你扮演擅長做總結的人\n
-忘記
-👉 當前每一次都會紀錄最後兩筆歷史紀錄，這個指令能夠清除歷史訊息\n
-圖像 + Prompt
-👉 會調用 DALL∙E 2 Model，以文字生成圖像\n
-語音輸入
-👉 會調用 Whisper 模型，先將語音轉換成文字，再調用 ChatGPT 以文字回覆\n
-其他文字輸入
-👉 調用 ChatGPT 以文字回覆\n
-貼上連結可以總結
-👉 Youtube 影片內容、新聞文章（支援：聯合報、Yahoo 新聞、三立新聞網、中央通訊社、風傳媒、TVBS、自由時報、ETtoday、中時新聞網、Line 新聞、台視新聞網）"""
-                                )
+            msg = messaging.TextMessage(text=HELP_MESSAGE)
 
         elif text.startswith('/系統訊息'):
             memory.change_system_message(user_id, text[5:].strip())
-            msg = TextMessage(text='輸入成功')
+            msg = messaging.TextMessage(text='輸入成功')
 
         elif text.startswith('忘記'):
-            memory.remove(user_id)
-            msg = TextMessage(text='歷史訊息清除成功')
+            memory.forget(user_id)
+            if documents is not None:
+                documents.remove(user_id)
+            msg = messaging.TextMessage(text='歷史訊息清除成功')
 
         elif text.startswith('圖像'):
+            admission.admit(user_id)
             prompt = text[3:].strip()
-            memory.append(user_id, 'user', prompt)
-            is_successful, response, error_message = model_management[
-                user_id].image_generations(prompt)
-            if not is_successful:
-                raise Exception(error_message)
-            url = response['data'][0]['url']
-            msg = ImageMessage(original_content_url=url, preview_image_url=url)
-            memory.append(user_id, 'assistant', url)
+            if image_jobs is not None:
+                image_jobs.submit(user_id, push_target(event.source), prompt, model_management[user_id])
+                memory.append(user_id, 'user', prompt)
+                msg = messaging.TextMessage(text=IMAGE_ACCEPTED_MESSAGE)
+            else:
+                memory.append(user_id, 'user', prompt)
+                is_successful, response, error_message = model_management[
+                    user_id].image_generations(prompt, deadline=deadline)
+                if not is_successful:
+                    raise Exception(error_message)
+                url = response['data'][0]['url']
+                msg = messaging.ImageMessage(original_content_url=url, preview_image_url=url)
+                memory.append(user_id, 'assistant', url)
         elif text.lower().startswith('ext'):
+            admission.admit(user_id)
             prompt = text[3:].strip()
             user_model = model_management[user_id]
             memory.append(user_id, 'user', prompt)
             
             # 使用模型的多輪 tool calling 方法，設定合理的限制
             is_successful, result, error_message = user_model.chat_with_ext_multi_turn(
-                memory.get(user_id), 
+                memory.get(user_id, deadline=deadline), 
                 os.getenv('OPENAI_MODEL_ENGINE'),
                 max_iterations=15,  # 減少最大迭代次數
-                max_tool_calls=5    # 限制工具調用總次數
+                max_tool_calls=5,   # 限制工具調用總次數
+                deadline=deadline
             )
             
             if not is_successful:
                 raise Exception(error_message)
             
             # result 是 {'role': role, 'content': content} 格式
-            msg = TextMessage(text=result['content'])
+            msg = messaging.TextMessage(text=result['content'])
             memory.append(user_id, result['role'], result['content'])
         else:
+            admission.admit(user_id)
             user_model = model_management[user_id]
             memory.append(user_id, 'user', text)
-            url = website.get_url_from_text(text)
+            url = get_website().get_url_from_text(text)
             if url:
-                if youtube.retrieve_video_id(text):
-                    is_successful, chunks, error_message = youtube.get_transcript_chunks(
-                        youtube.retrieve_video_id(text))
-                    if not is_successful:
-                        raise Exception(error_message)
-                    youtube_transcript_reader = YoutubeTranscriptReader(
-                        user_model, os.getenv('OPENAI_MODEL_ENGINE'))
-                    is_successful, response, error_message = youtube_transcript_reader.summarize(
-                        chunks)
-                    if not is_successful:
-                        raise Exception(error_message)
-                    role, response = get_role_and_content(response)
-                    msg = TextMessage(text=response)
+                video_id = get_youtube().retrieve_video_id(text)
+                if video_id:
+                    role, response, document = url_flight.do(
+                        f'youtube:{video_id}', summarize_youtube, user_model, video_id, deadline, on_section,
+                        timeout=deadline.remaining())
                 else:
-                    chunks = website.get_content_from_url(url)
-                    if len(chunks) == 0:
-                        raise Exception('無法撈取此網站文字')
-                    website_reader = WebsiteReader(user_model,os.getenv('OPENAI_MODEL_ENGINE'))
-                    is_successful, response, error_message = website_reader.summarize(
-                        chunks)
-                    if not is_successful:
-                        raise Exception(error_message)
-                    role, response = get_role_and_content(response)
-                    msg = TextMessage(text=response)
+                    role, response, document = url_flight.do(
+                        get_website().normalize_url(url), summarize_website, user_model, url, deadline, on_section,
+                        timeout=deadline.remaining())
+                if documents is not None:
+                    documents.put(user_id, document)
+            elif on_section is not None:
+                is_successful, response, error_message = user_model.chat_completions_stream(
+                    get_chat_history(user_id, deadline), os.getenv('OPENAI_MODEL_ENGINE'), on_section=on_section, deadline=deadline, task='chat')
+                if not is_successful:
+                    raise Exception(error_message)
+                role, response = get_role_and_content(response)
             else:
-                is_successful, response, error_message = user_model.chat_completions(memory.get(user_id), os.getenv('OPENAI_MODEL_ENGINE'))
+                is_successful, response, error_message = user_model.chat_completions(get_chat_history(user_id, deadline), os.getenv('OPENAI_MODEL_ENGINE'), deadline=deadline, task='chat')
                 if not is_successful:
                     raise Exception(error_message)
                 role, response = get_role_and_content(response)
-                msg = TextMessage(text=response)
+            # 串流時回答已分段送出；共用同一個摘要的其他使用者則在這裡收到完整回答
+            msg = None if delivery.sent else messaging.TextMessage(text=response)
 
             memory.append(user_id, role, response)
     except ValueError:
-        msg = TextMessage(text='Token 無效，請重新註冊，格式為 /註冊 sk-xxxxx')
+        msg = messaging.TextMessage(text='Token 無效，請重新註冊，格式為 /註冊 sk-xxxxx')
     # except KeyError:
-    #     msg = TextMessage(text='請先註冊 Token，格式為 /註冊')
+    #     msg = messaging.TextMessage(text='請先註冊 Token，格式為 /註冊')
+    except AdmissionRejected as e:
+        msg = messaging.TextMessage(text=str(e))
+    except (DeadlineExceeded, TimeoutError):
+        msg = messaging.TextMessage(text=DEADLINE_MESSAGE)
     except Exception as e:
-        memory.remove(user_id)
         error_msg = str(e)
+        memory.remove(user_id)
         if error_msg.startswith('Incorrect API key provided'):
-            msg = TextMessage(text='OpenAI API Token 有誤，請重新註冊。')
+            msg = messaging.TextMessage(text='OpenAI API Token 有誤，請重新註冊。')
         elif 'overloaded' in error_msg.lower():
-            msg = TextMessage(text='已超過負荷，請稍後再試')
+            msg = messaging.TextMessage(text='已超過負荷，請稍後再試')
         else:
-            msg = TextMessage(text=error_msg)
-    line_bot_api.reply_message_with_http_info(ReplyMessageRequest(reply_token=event.reply_token, messages=[msg]))
+            msg = messaging.TextMessage(text=error_msg)
+    if msg is not None:
+        delivery.send(msg)
 
 @line_handler.add(MessageEvent, message=AudioMessageContent)
 def handle_audio_message(event: MessageEvent):
+    deadline = current_deadline()
+    if reply_if_expired(event, deadline):
+        return
+    with metrics.handler_latency.time(handler='audio'):
+        scheduler.run('media', profiled(_handle_audio_message, 'audio', event), event, deadline)
+
+
+def _handle_audio_message(event: MessageEvent, deadline):
     user_id = event.source.user_id
-    if user_id not in model_management:
-        model_management[user_id] = OpenAIModel(api_key=os.getenv('OPENAI_API_KEY'))
-    audio_content = blob_api.get_message_content(event.message.id)
+    get_user_model(user_id)
     input_audio_path = f'{str(uuid.uuid4())}.m4a'
-    
+
     try:
+        admission.admit(user_id)
+        # 在 lane 中排隊時 deadline 可能已經用完，下載也要在 try 內
+        with metrics.track('line_blob'):
+            audio_content = get_blob_api().get_message_content(event.message.id, _request_timeout=deadline.timeout(BLOB_TIMEOUT))
         with open(input_audio_path, 'wb') as fd:
             # for chunk in audio_content.iter_content():
             #     fd.write(chunk)
@@ -187,82 +428,99 @@ def handle_audio_message(event: MessageEvent):
         if not model_management.get(user_id):
             raise ValueError('Invalid API token')
         else:
-            is_successful, response, error_message = model_management[user_id].audio_transcriptions(input_audio_path, 'whisper-1')
+            is_successful, response, error_message = model_management[user_id].audio_transcriptions(input_audio_path, 'whisper-1', deadline=deadline)
             if not is_successful:
                 raise Exception(error_message)
             memory.append(user_id, 'user', response['text'])
-            is_successful, response, error_message = model_management[user_id].chat_completions(memory.get(user_id), os.getenv('OPENAI_MODEL_ENGINE'))
+            is_successful, response, error_message = model_management[user_id].chat_completions(memory.get(user_id, deadline=deadline), os.getenv('OPENAI_MODEL_ENGINE'), deadline=deadline, task='chat')
             if not is_successful:
                 raise Exception(error_message)
             role, response = get_role_and_content(response)
 
             memory.append(user_id, role, response)
-            msg = TextMessage(text=response)
+            msg = messaging.TextMessage(text=response)
     except ValueError:
-        msg = TextMessage(text='請先註冊你的 API Token，格式為 /註冊 [API TOKEN]')
+        msg = messaging.TextMessage(text='請先註冊你的 API Token，格式為 /註冊 [API TOKEN]')
     except KeyError:
-        msg = TextMessage(text='請先註冊 Token，格式為 /註冊 sk-xxxxx')
+        msg = messaging.TextMessage(text='請先註冊 Token，格式為 /註冊 sk-xxxxx')
+    except AdmissionRejected as e:
+        msg = messaging.TextMessage(text=str(e))
+    except (DeadlineExceeded, TimeoutError):
+        msg = messaging.TextMessage(text=DEADLINE_MESSAGE)
     except Exception as e:
         memory.remove(user_id)
         if str(e).startswith('Incorrect API key provided'):
-            msg = TextMessage(text='OpenAI API Token 有誤，請重新註冊。')
+            msg = messaging.TextMessage(text='OpenAI API Token 有誤，請重新註冊。')
         else:
-            msg = TextMessage(text=str(e))
+            msg = messaging.TextMessage(text=str(e))
     finally:
         # 確保檔案總是被清理
         if os.path.exists(input_audio_path):
             os.remove(input_audio_path)
     
-    line_bot_api.reply_message(event.reply_token, msg)
+    reply_message(event, msg, deadline)
 
 
 @line_handler.add(MessageEvent, message=ImageMessageContent)
 def handle_image_message(event: MessageEvent):
+    deadline = current_deadline()
+    if reply_if_expired(event, deadline):
+        return
+    with metrics.handler_latency.time(handler='image'):
+        scheduler.run('media', profiled(_handle_image_message, 'image', event), event, deadline)
+
+
+def _handle_image_message(event: MessageEvent, deadline):
     user_id = event.source.user_id
-    if user_id not in model_management:
-        model_management[user_id] = OpenAIModel(api_key=os.getenv('OPENAI_API_KEY'))
-    image_content = blob_api.get_message_content(event.message.id)
-    image_data = base64.b64encode(image_content).decode('utf-8')
-    user_content = [
-        {
-            "type": "image_url",
-            "image_url": {
-                "url": f'data:image/jpeg;base64,{image_data}',
-                "detail": image_detail  # low, high, or auto
-            }
-        },
-        {
-            "type": "text",
-            "text": "仔細觀察圖片上面的所有細節包含文字。詳細描述圖片上的內容並說明；如果你覺得他是個meme，說明他想傳達的情境，如果不是就不用特別說明"
-        }
-    ]
-    memory.append(user_id, 'user', user_content)
+    get_user_model(user_id)
 
     try:
+        admission.admit(user_id)
+        # 在 lane 中排隊時 deadline 可能已經用完，下載也要在 try 內
+        with metrics.track('line_blob'):
+            image_content = get_blob_api().get_message_content(event.message.id, _request_timeout=deadline.timeout(BLOB_TIMEOUT))
+        image_data = base64.b64encode(image_content).decode('utf-8')
+        user_content = [
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f'data:image/jpeg;base64,{image_data}',
+                    "detail": image_detail  # low, high, or auto
+                }
+            },
+            {
+                "type": "text",
+                "text": "仔細觀察圖片上面的所有細節包含文字。詳細描述圖片上的內容並說明；如果你覺得他是個meme，說明他想傳達的情境，如果不是就不用特別說明"
+            }
+        ]
+        memory.append(user_id, 'user', user_content)
         if not model_management.get(user_id):
             raise ValueError('Invalid API token')
         else:
             # is_successful, response, error_message = model_management[user_id].image_recognition(image_data, os.getenv('OPENAI_MODEL_ENGINE'))
-            is_successful, response, error_message = model_management[user_id].chat_completions(memory.get(user_id), os.getenv('OPENAI_MODEL_ENGINE'))
+            is_successful, response, error_message = model_management[user_id].chat_completions(memory.get(user_id, deadline=deadline), os.getenv('OPENAI_MODEL_ENGINE'), deadline=deadline, task='chat')
             if not is_successful:
                 raise Exception(error_message)
             role, response = get_role_and_content(response)
             memory.append(user_id, role, response)
-            msg = TextMessage(text=response)
+            msg = messaging.TextMessage(text=response)
     except ValueError:
-        msg = TextMessage(text='請先註冊你的 API Token，格式為 /註冊 [API TOKEN]')
+        msg = messaging.TextMessage(text='請先註冊你的 API Token，格式為 /註冊 [API TOKEN]')
     except KeyError:
-        msg = TextMessage(text='請先註冊 Token，格式為 /註冊 sk-xxxxx')
+        msg = messaging.TextMessage(text='請先註冊 Token，格式為 /註冊 sk-xxxxx')
+    except AdmissionRejected as e:
+        msg = messaging.TextMessage(text=str(e))
+    except (DeadlineExceeded, TimeoutError):
+        msg = messaging.TextMessage(text=DEADLINE_MESSAGE)
     except Exception as e:
         memory.remove(user_id)
         if str(e).startswith('Incorrect API key provided'):
-            msg = TextMessage(text='OpenAI API Token 有誤，請重新註冊。')
+            msg = messaging.TextMessage(text='OpenAI API Token 有誤，請重新註冊。')
         else:
-            msg = TextMessage(text=str(e))
-    # print(f'{response=}')   
+            msg = messaging.TextMessage(text=str(e))
+    # print(f'{response=}')
     # print(f'{msg=}')        
-    line_bot_api.reply_message_with_http_info(
-        ReplyMessageRequest(reply_token=event.reply_token, messages=[msg]))
+    reply_message(event, msg, deadline)
 
 
 @app.route("/", methods=['GET'])
@@ -270,6 +528,31 @@ def home():
     return 'Hello World'
 
 
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def check_profile_access():
+    # 只接受 header，query string 會被記進 access log
+    if not profiler.is_requested(request.headers):
+        abort(404)
+
+
+@app.route("/profiles", methods=['GET'])
+def list_profiles():
+    check_profile_access()
+    return jsonify(profiler.list_profiles())
+
+
+@app.route("/profiles/<path:filename>", methods=['GET'])
+def download_profile(filename):
+    check_profile_access()
+    if not filename.endswith(('.prof', '.json')):
+        abort(404)
+    return send_from_directory(profiler.directory, filename, as_attachment=True)
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     app.run(host='0.0.0.0', port=port)
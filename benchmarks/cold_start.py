@@ -0,0 +1,166 @@
+"""
+Cold-start benchmark for api/main.py.
+
+Each run starts a fresh interpreter and measures:
+    import_seconds          time to `import api.main`
+    first_get_seconds       first GET / through the Flask test client
+    first_webhook_seconds   first signed text-message webhook, end to end,
+                            against local OpenAI / LINE stubs
+
+Usage:
+    python benchmarks/cold_start.py --runs 5 --output cold_start.json
+    python benchmarks/cold_start.py --baseline cold_start.json --tolerance 0.2
+
+With --baseline the script exits with status 1 when a median regresses by
+more than the tolerance.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHANNEL_SECRET = 'cold-start-secret'
+METRICS = ('import_seconds', 'first_get_seconds', 'first_webhook_seconds')
+
+CHILD_SCRIPT = r'''
+import base64, hashlib, hmac, json, sys, time
+start = time.perf_counter()
+import api.main as main
+import_seconds = time.perf_counter() - start
+
+client = main.app.test_client()
+start = time.perf_counter()
+client.get('/')
+first_get_seconds = time.perf_counter() - start
+
+body = json.dumps({'destination': 'D', 'events': [{
+    'type': 'message', 'mode': 'active', 'timestamp': 0,
+    'source': {'type': 'user', 'userId': 'Ucoldstart'},
+    'webhookEventId': 'cold-start-event', 'deliveryContext': {'isRedelivery': False},
+    'replyToken': 'cold-start-reply',
+    'message': {'id': '1', 'type': 'text', 'text': 'hello', 'quoteToken': 'q'},
+}]})
+signature = base64.b64encode(hmac.new(sys.argv[1].encode(), body.encode(), hashlib.sha256).digest()).decode()
+start = time.perf_counter()
+response = client.post('/callback', data=body, headers={'X-Line-Signature': signature, 'Content-Type': 'application/json'})
+first_webhook_seconds = time.perf_counter() - start
+assert response.status_code == 200, response.status_code
+print(json.dumps({
+    'import_seconds': import_seconds,
+    'first_get_seconds': first_get_seconds,
+    'first_webhook_seconds': first_webhook_seconds,
+}))
+'''
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers OpenAI chat completions and LINE replies with canned bodies."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.endswith('/chat/completions'):
+            body = {
+                'model': 'stub', 'usage': {'prompt_tokens': 1, 'completion_tokens': 1},
+                'choices': [{'message': {'role': 'assistant', 'content': 'hi'}}],
+            }
+        else:
+            body = {'sentMessages': [{'id': '1', 'quoteToken': 'q'}]}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_once(stub_url):
+    env = dict(
+        os.environ,
+        LINE_CHANNEL_SECRET=CHANNEL_SECRET,
+        LINE_CHANNEL_ACCESS_TOKEN='cold-start-token',
+        LINE_API_HOST=stub_url,
+        OPENAI_BASE_URL=f'{stub_url}/v1',
+        OPENAI_API_KEY='sk-cold-start',
+        OPENAI_MODEL_ENGINE='stub',
+        LOG_LEVEL='WARNING',
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD_SCRIPT, CHANNEL_SECRET],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    return {
+        metric: {
+            'median': statistics.median(sample[metric] for sample in samples),
+            'min': min(sample[metric] for sample in samples),
+            'max': max(sample[metric] for sample in samples),
+        }
+        for metric in METRICS
+    }
+
+
+def compare(summary, baseline, tolerance):
+    regressions = []
+    for metric in METRICS:
+        before = baseline['summary'][metric]['median']
+        after = summary[metric]['median']
+        change = (after - before) / before if before else 0.0
+        print(f'{metric:<24} {before * 1000:9.1f} ms -> {after * 1000:9.1f} ms ({change:+.1%})')
+        if change > tolerance:
+            regressions.append(metric)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    parser.add_argument('--baseline', help='previous results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression of a median')
+    args = parser.parse_args()
+
+    stub = start_stub()
+    stub_url = f'http://127.0.0.1:{stub.server_address[1]}'
+    samples = [run_once(stub_url) for _ in range(args.runs)]
+    stub.shutdown()
+
+    summary = summarize(samples)
+    for metric in METRICS:
+        values = summary[metric]
+        print(f'{metric:<24} median {values["median"] * 1000:9.1f} ms  '
+              f'min {values["min"] * 1000:9.1f} ms  max {values["max"] * 1000:9.1f} ms')
+
+    results = {'python': sys.version.split()[0], 'runs': args.runs, 'samples': samples, 'summary': summary}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(summary, baseline, args.tolerance)
+        if regressions:
+            print(f'Regression beyond {args.tolerance:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+"""
+Offline micro-benchmarks for the hot pure-Python components.
+
+No network is used; every benchmark runs on fixed, deterministic fixtures:
+    memory.*                Memory.append / get / _drop_message with many users
+    documents.*             PassageIndex build and BM25 search on a synthesized document
+                            of DOCUMENT_CHARS characters
+    longterm.*              HashingEmbedder on one turn, and LongTermMemory.recall over
+                            a full per-user index (embed the query + top-k search)
+    website.<domain>        parse + selector extraction for each sites_info domain,
+                            from benchmarks/fixtures/html/<domain>.html when present,
+                            otherwise a synthesized page using that domain's selector
+    youtube.chunk_transcript
+                            Youtube.chunk_transcript on a large raw transcript
+    search.parse_*          OpenAIModel.parse_search_results on the Jina fixture
+    utils.get_role_and_content
+    utils.s2t.*             S2TConverter on benchmarks/fixtures/s2t_reply.txt: a cold
+                            conversion, a memoized repeat, streamed deltas, and the
+                            opencc package as reference
+
+Each benchmark reports ops/sec (best of --repeat timed batches) and, from a
+separate tracemalloc pass, the peak memory allocated during one op and the
+bytes / blocks still retained per op afterwards.
+
+Usage:
+    python benchmarks/components.py --output components.json
+    python benchmarks/components.py --filter website --baseline components.json --tolerance 0.2
+
+With --baseline the script exits with status 1 when ops/sec drops by more
+than the tolerance.
+"""
+import gc
+import os
+import sys
+import json
+import random
+import argparse
+import tracemalloc
+from timeit import default_timer
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+sys.path.insert(0, ROOT)
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from src.memory import Memory  # noqa: E402
+from src.documents import DocumentStore  # noqa: E402
+from src.longterm import HashingEmbedder, LongTermMemory  # noqa: E402
+from src.models import OpenAIModel  # noqa: E402
+from src.service.website import Website  # noqa: E402
+from src.service.youtube import Youtube  # noqa: E402
+from src.utils import get_role_and_content, get_s2t_converter  # noqa: E402
+
+
+SEED = 20240601
+MEMORY_USERS = 2000
+MEMORY_MESSAGE_COUNT = 20
+LONG_TERM_ITEMS = 500
+DOCUMENT_CHARS = 200000
+TRANSCRIPT_LINES = 120000
+HTML_PARAGRAPHS = 200
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a setup function that returns the callable to measure."""
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+def _text(rng, words):
+    vocabulary = ('台積電', '法說會', '營收', 'AI', 'GPU', '伺服器', '成長', 'market', 'latency', '摘要')
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+
+@benchmark('memory.append')
+def setup_memory_append():
+    memory = Memory('You are a helpful assistant.', MEMORY_MESSAGE_COUNT)
+    users = [f'U{i:05d}' for i in range(MEMORY_USERS)]
+    state = {'i': 0}
+
+    def run():
+        i = state['i'] = state['i'] + 1
+        memory.append(users[i % MEMORY_USERS], 'user', 'hello there, please summarize this')
+    return run
+
+
+@benchmark('memory.get')
+def setup_memory_get():
+    memory = Memory('You are a helpful assistant.', MEMORY_MESSAGE_COUNT)
+    users = [f'U{i:05d}' for i in range(MEMORY_USERS)]
+    for user_id in users:
+        for turn in range(MEMORY_MESSAGE_COUNT * 2):
+            memory.append(user_id, 'user' if turn % 2 == 0 else 'assistant', f'message {turn}')
+    state = {'i': 0}
+
+    def run():
+        i = state['i'] = state['i'] + 1
+        return memory.get(users[i % MEMORY_USERS])
+    return run
+
+
+@benchmark('memory.drop_message')
+def setup_memory_drop_message():
+    memory = Memory('You are a helpful assistant.', MEMORY_MESSAGE_COUNT)
+    full = [{'role': 'system', 'content': 'system'}] + [
+        {'role': 'user', 'content': f'message {turn}'}
+        for turn in range((MEMORY_MESSAGE_COUNT + 1) * 2)
+    ]
+
+    def run():
+        # 每次都從剛好需要截斷的長度開始
+        memory.storage['U'] = list(full)
+        memory._drop_message('U')
+    return run
+
+
+def _document(rng):
+    lines = []
+    size = 0
+    while size < DOCUMENT_CHARS:
+        lines.append(_text(rng, 30))
+        size += len(lines[-1]) + 1
+    return lines
+
+
+@benchmark('documents.build')
+def setup_documents_build():
+    store = DocumentStore()
+    lines = _document(random.Random(SEED))
+
+    def run():
+        return store.build('https://example.com', lines)
+    return run
+
+
+@benchmark('documents.search')
+def setup_documents_search():
+    rng = random.Random(SEED)
+    store = DocumentStore()
+    store.put('U', store.build('https://example.com', _document(rng)))
+    question = _text(rng, 8)
+
+    def run():
+        return store.search('U', question)
+    return run
+
+
+@benchmark('longterm.embed')
+def setup_longterm_embed():
+    embedder = HashingEmbedder()
+    text = _text(random.Random(SEED), 60)
+
+    def run():
+        return embedder.embed([text])
+    return run
+
+
+@benchmark('longterm.recall')
+def setup_longterm_recall():
+    rng = random.Random(SEED)
+    long_term = LongTermMemory(HashingEmbedder(), max_items=LONG_TERM_ITEMS)
+    long_term._add('U', [_text(rng, 60) for _ in range(LONG_TERM_ITEMS)])
+    query = _text(rng, 10)
+
+    def run():
+        return long_term.recall('U', query)
+    return run
+
+
+def load_html(domain, tag, attrs):
+    path = os.path.join(FIXTURES, 'html', f'{domain}.html')
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+    rng = random.Random(f'{SEED}-{domain}')
+    css_class = attrs.get('class', '')
+    paragraphs = ''.join(f'<p>{_text(rng, 40)}</p>\n' for _ in range(HTML_PARAGRAPHS))
+    noise = ''.join(
+        f'<div class="sidebar"><a href="/item/{i}">{_text(rng, 6)}</a></div>\n' for i in range(HTML_PARAGRAPHS // 2)
+    )
+    return (
+        f'<html><head><title>{domain}</title><script>var x = 1;</script></head><body>\n'
+        f'<nav>{noise}</nav>\n<{tag} class="{css_class}">\n{paragraphs}</{tag}>\n{noise}</body></html>'
+    )
+
+
+def register_website_benchmarks():
+    website = Website()
+    for domain, info in website.sites_info.items():
+        tag, attrs = info['selector']
+
+        def setup(domain=domain, tag=tag, attrs=attrs):
+            html = load_html(domain, tag, attrs)
+
+            def run():
+                chunks = website.select_chunks(website.parse_html(html), tag, attrs)
+                assert chunks, domain
+                return chunks
+            return run
+
+        BENCHMARKS[f'website.{domain}'] = setup
+
+
+register_website_benchmarks()
+
+
+@benchmark('youtube.chunk_transcript')
+def setup_youtube_chunk_transcript():
+    rng = random.Random(SEED)
+    raw_data = [
+        {'text': _text(rng, 8), 'start': i * 2.5, 'duration': 2.5}
+        for i in range(TRANSCRIPT_LINES)
+    ]
+    youtube = Youtube(step=1, retries=1)
+
+    def run():
+        return youtube.chunk_transcript(raw_data)
+    return run
+
+
+def _search_fixture():
+    with open(os.path.join(FIXTURES, 'jina_search.json'), encoding='utf-8') as f:
+        return f.read()
+
+
+@benchmark('search.parse_json')
+def setup_search_parse_json():
+    model = OpenAIModel(api_key='sk-benchmark')
+    text = _search_fixture()
+
+    def run():
+        return model.parse_search_results('台積電 法說會', text)
+    return run
+
+
+@benchmark('search.parse_text')
+def setup_search_parse_text():
+    model = OpenAIModel(api_key='sk-benchmark')
+    # 非 JSON 回應會走純文字的 fallback
+    text = '\n\n'.join(
+        f'[{i}] Title: {item["title"]}\n[{i}] URL Source: {item["url"]}\n[{i}] Description: {item["description"]}'
+        for i, item in enumerate(json.loads(_search_fixture())['data'])
+    )
+
+    def run():
+        return model.parse_search_results('台積電 法說會', text)
+    return run
+
+
+@benchmark('utils.get_role_and_content')
+def setup_get_role_and_content():
+    response = {
+        'id': 'chatcmpl-benchmark', 'model': 'gpt-benchmark',
+        'usage': {'prompt_tokens': 120, 'completion_tokens': 80},
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': '  ' + '摘要內容 ' * 200 + '\n'}}],
+    }
+
+    def run():
+        return get_role_and_content(response)
+    return run
+
+
+def _s2t_fixture():
+    with open(os.path.join(FIXTURES, 's2t_reply.txt'), encoding='utf-8') as f:
+        return f.read()
+
+
+def _s2t_converter():
+    converter = get_s2t_converter()
+    if converter is None:
+        raise SystemExit('utils.s2t benchmarks need the OpenCC dictionaries (pip install opencc-python-reimplemented)')
+    return converter
+
+
+@benchmark('utils.s2t.uncached')
+def setup_s2t_uncached():
+    converter = _s2t_converter()
+    text = _s2t_fixture()
+
+    def run():
+        converter.convert_line.cache_clear()
+        return converter.convert(text)
+    return run
+
+
+@benchmark('utils.s2t.cached')
+def setup_s2t_cached():
+    converter = _s2t_converter()
+    text = _s2t_fixture()
+
+    def run():
+        return converter.convert(text)
+    return run
+
+
+@benchmark('utils.s2t.stream')
+def setup_s2t_stream():
+    converter = _s2t_converter()
+    text = _s2t_fixture()
+    # 模擬串流回應，每個 delta 約為一個 token
+    deltas = [text[i:i + 3] for i in range(0, len(text), 3)]
+
+    def run():
+        stream = converter.stream()
+        return ''.join(map(stream.feed, deltas)) + stream.flush()
+    return run
+
+
+@benchmark('utils.s2t.opencc')
+def setup_s2t_opencc():
+    import opencc
+    converter = opencc.OpenCC('s2t')
+    text = _s2t_fixture()
+
+    def run():
+        return converter.convert(text)
+    return run
+
+
+def measure(fn, min_time, repeat):
+    fn()
+    # 先估計一批需要幾次呼叫才能跑滿 min_time
+    loops = 1
+    while True:
+        start = default_timer()
+        for _ in range(loops):
+            fn()
+        elapsed = default_timer() - start
+        if elapsed >= min_time or loops >= 10 ** 7:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    timings = [elapsed]
+    for _ in range(repeat - 1):
+        start = default_timer()
+        for _ in range(loops):
+            fn()
+        timings.append(default_timer() - start)
+
+    alloc_loops = min(loops, 1000)
+    tracemalloc.start()
+    # 單次呼叫的暫時性峰值
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    # 多次呼叫後仍留在記憶體中的配置
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    for _ in range(alloc_loops):
+        fn()
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = [stat for stat in after.compare_to(before, 'lineno') if stat.size_diff > 0]
+
+    best = min(timings)
+    return {
+        'ops_per_sec': loops / best,
+        'us_per_op': best / loops * 1e6,
+        'loops': loops,
+        'retained_bytes_per_op': sum(stat.size_diff for stat in allocated) / alloc_loops,
+        'retained_blocks_per_op': sum(stat.count_diff for stat in allocated) / alloc_loops,
+        'peak_bytes_per_op': peak - current,
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, values in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        change = (values['ops_per_sec'] - before['ops_per_sec']) / before['ops_per_sec']
+        print(f'{name:<40} {before["ops_per_sec"]:12.1f} -> {values["ops_per_sec"]:12.1f} ops/s ({change:+.1%})')
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this string')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per timed batch')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    parser.add_argument('--baseline', help='previous results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative drop of ops/sec')
+    args = parser.parse_args()
+
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        values = results[name] = measure(setup(), args.min_time, args.repeat)
+        print(f'{name:<40} {values["ops_per_sec"]:12.1f} ops/s {values["us_per_op"]:10.2f} us/op '
+              f'peak {values["peak_bytes_per_op"] / 1024:9.1f} KiB/op '
+              f'retained {values["retained_bytes_per_op"]:8.0f} B/op {values["retained_blocks_per_op"]:6.1f} blocks/op')
+
+    output = {'python': sys.version.split()[0], 'seed': SEED, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'Regression beyond {args.tolerance:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
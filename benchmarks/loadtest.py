@@ -0,0 +1,355 @@
+"""
+End-to-end load test for the webhook, against local OpenAI and LINE stubs.
+
+The harness starts the stub servers from benchmarks/stubs.py, launches the
+Flask app in a subprocess with OPENAI_BASE_URL and LINE_API_HOST pointing at
+them, then replays correctly signed webhook payloads to /callback at a fixed
+(open-loop) request rate. Message types:
+    text                plain chat
+    image_generation    `圖像 ...` prompt (acknowledged, image pushed later)
+    image               image message (blob download + vision chat)
+    audio               audio message (blob download + transcription + chat)
+
+The report covers offered / achieved throughput and, per message type,
+p50 / p90 / p99 latency of the /callback request, HTTP errors, and the
+bot's replies as seen by the LINE stub (ok, rejected by admission or the
+deadline, error, missing), plus the images pushed for accepted image jobs.
+
+Usage:
+    python benchmarks/loadtest.py --rps 20 --duration 30
+    python benchmarks/loadtest.py --mix text=8,audio=1,image=1 --error-rate chat=0.05 --output load.json
+    python benchmarks/loadtest.py --latency chat=2.5,reply=0.2 --users 50
+
+Stub latency / error rates are given per endpoint: chat, transcription,
+image (OpenAI) and reply, push, blob (LINE). With --target the app is not
+spawned; the already running app must then use the printed stub URLs.
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stubs import (DEFAULT_LATENCY, STUB_CHAT_CONTENT, STUB_IMAGE_URL,  # noqa: E402
+                   start_openai_stub, start_line_stub)
+from src.admission import RATE_LIMITED_MESSAGE, BUSY_MESSAGE  # noqa: E402
+from src.deadline import DEADLINE_MESSAGE  # noqa: E402
+from src.jobs import IMAGE_ACCEPTED_MESSAGE, IMAGE_QUEUE_FULL_MESSAGE, IMAGE_USER_LIMIT_MESSAGE  # noqa: E402
+from src.accounting import QUOTA_EXCEEDED_MESSAGE  # noqa: E402
+
+
+CHANNEL_SECRET = 'loadtest-secret'
+MESSAGE_TYPES = ('text', 'image_generation', 'image', 'audio')
+DEFAULT_MIX = 'text=7,image_generation=1,image=1,audio=1'
+REJECTED_REPLIES = (RATE_LIMITED_MESSAGE, BUSY_MESSAGE, DEADLINE_MESSAGE,
+                    IMAGE_QUEUE_FULL_MESSAGE, IMAGE_USER_LIMIT_MESSAGE, QUOTA_EXCEEDED_MESSAGE)
+
+APP_SCRIPT = r'''
+import sys, logging
+from api.main import app
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)
+'''
+
+
+def parse_pairs(text, cast=float):
+    """`chat=0.5,reply=0.1` -> {'chat': 0.5, 'reply': 0.1}"""
+    pairs = {}
+    for item in (text or '').split(','):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            pairs[key.strip()] = cast(value)
+    return pairs
+
+
+def sign(body):
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+def build_event(kind, n, user_id, rng):
+    if kind == 'text':
+        message = {'type': 'text', 'text': f'壓力測試第 {n} 則訊息，請簡短回答。', 'quoteToken': 'q'}
+    elif kind == 'image_generation':
+        message = {'type': 'text', 'text': f'圖像 一隻在月球上喝咖啡的貓 {n}', 'quoteToken': 'q'}
+    elif kind == 'image':
+        message = {'type': 'image', 'quoteToken': 'q',
+                   'contentProvider': {'type': 'line'}}
+    else:
+        message = {'type': 'audio', 'duration': rng.randint(1000, 30000),
+                   'contentProvider': {'type': 'line'}}
+    message['id'] = str(10 ** 12 + n)
+    return {
+        'type': 'message', 'mode': 'active', 'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'webhookEventId': f'loadtest-{n}', 'deliveryContext': {'isRedelivery': False},
+        # replyToken 帶上訊息種類，方便從 LINE stub 收到的 reply 對回去
+        'replyToken': f'{kind}:{n}',
+        'message': message,
+    }
+
+
+class LoadGenerator:
+    def __init__(self, target, rps, duration, mix, users, concurrency, timeout, seed):
+        self.target = target.rstrip('/')
+        self.rps = rps
+        self.duration = duration
+        self.mix = mix
+        self.users = [f'Uloadtest{i:05d}' for i in range(users)]
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.samples = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def send(self, kind, body):
+        start = time.perf_counter()
+        try:
+            status = self.session().post(
+                f'{self.target}/callback', data=body.encode(), timeout=self.timeout,
+                headers={'X-Line-Signature': sign(body), 'Content-Type': 'application/json'},
+            ).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.samples.append((kind, status, latency))
+
+    def run(self):
+        kinds, weights = zip(*self.mix.items())
+        total = int(self.rps * self.duration)
+        lagging = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            start = time.perf_counter()
+            for n in range(total):
+                # open-loop：依照排定的時間送出，不等待前一個請求完成
+                delay = start + n / self.rps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -0.1:
+                    lagging += 1
+                kind = self.random.choices(kinds, weights)[0]
+                event = build_event(kind, n, self.random.choice(self.users), self.random)
+                body = json.dumps({'destination': 'Uloadtest', 'events': [event]}, ensure_ascii=False)
+                executor.submit(self.send, kind, body)
+            send_seconds = time.perf_counter() - start
+        elapsed = time.perf_counter() - start
+        return total, send_seconds, elapsed, lagging
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def classify_reply(message):
+    if message.get('type') == 'image':
+        return 'ok' if message.get('originalContentUrl') == STUB_IMAGE_URL else 'error'
+    text = message.get('text') or ''
+    # 圖像 的 reply 只是確認訊息，圖片之後以 push 送達
+    if text in (STUB_CHAT_CONTENT, IMAGE_ACCEPTED_MESSAGE):
+        return 'ok'
+    if text in REJECTED_REPLIES:
+        return 'rejected'
+    return 'error'
+
+
+def accepted_image_jobs(line_stub):
+    return sum(1 for name, body in list(line_stub.messages)
+               if name == 'reply' and (body.get('messages') or [{}])[0].get('text') == IMAGE_ACCEPTED_MESSAGE)
+
+
+def wait_for_pushes(line_stub, timeout):
+    """Wait until every accepted image job has pushed its result, or timeout."""
+    expected = accepted_image_jobs(line_stub)
+    give_up_at = time.monotonic() + timeout
+    while time.monotonic() < give_up_at:
+        if sum(1 for name, _ in list(line_stub.messages) if name == 'push') >= expected:
+            return
+        time.sleep(0.2)
+
+
+def build_report(samples, line_stub, openai_stub, total, send_seconds, elapsed, lagging, rps):
+    replies = {}
+    for name, body in line_stub.messages:
+        if name != 'reply':
+            continue
+        kind = body.get('replyToken', '').split(':', 1)[0]
+        outcome = classify_reply((body.get('messages') or [{}])[0])
+        replies.setdefault(kind, {}).setdefault(outcome, 0)
+        replies[kind][outcome] += 1
+
+    per_type = {}
+    for kind in MESSAGE_TYPES:
+        kind_samples = [sample for sample in samples if sample[0] == kind]
+        if not kind_samples:
+            continue
+        latencies = [latency for _, status, latency in kind_samples if status == 200]
+        http_errors = sum(1 for _, status, _ in kind_samples if status != 200)
+        outcomes = replies.get(kind, {})
+        replied = sum(outcomes.values())
+        per_type[kind] = {
+            'sent': len(kind_samples),
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies) if latencies else None,
+            'http_errors': http_errors,
+            'replies_ok': outcomes.get('ok', 0),
+            'replies_rejected': outcomes.get('rejected', 0),
+            'replies_error': outcomes.get('error', 0),
+            'replies_missing': max(0, len(kind_samples) - replied),
+            'error_rate': (http_errors + outcomes.get('error', 0)) / len(kind_samples),
+        }
+
+    pushes = {'expected': accepted_image_jobs(line_stub), 'ok': 0, 'error': 0}
+    for name, body in line_stub.messages:
+        if name == 'push':
+            pushes['ok' if classify_reply((body.get('messages') or [{}])[0]) == 'ok' else 'error'] += 1
+    pushes['missing'] = max(0, pushes['expected'] - pushes['ok'] - pushes['error'])
+
+    completed = sum(1 for _, status, _ in samples if status == 200)
+    return {
+        'offered_rps': rps,
+        'sent': total,
+        'completed': completed,
+        'achieved_rps': completed / elapsed if elapsed else 0.0,
+        'send_seconds': send_seconds,
+        'elapsed_seconds': elapsed,
+        'lagging_sends': lagging,
+        'per_type': per_type,
+        'image_pushes': pushes,
+        'stubs': {'openai': openai_stub.metrics(), 'line': line_stub.metrics()},
+    }
+
+
+def print_report(report):
+    print(f'offered {report["offered_rps"]:.1f} rps, sent {report["sent"]} in {report["send_seconds"]:.1f}s, '
+          f'completed {report["completed"]}, achieved {report["achieved_rps"]:.1f} rps '
+          f'({report["lagging_sends"]} sends late by >100 ms)')
+    print(f'{"type":<18}{"sent":>6}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}'
+          f'{"http err":>10}{"ok":>6}{"reject":>8}{"error":>7}{"missing":>9}{"err rate":>10}')
+
+    def ms(value):
+        return f'{value * 1000:10.0f}' if value is not None else f'{"-":>10}'
+
+    for kind, values in report['per_type'].items():
+        print(f'{kind:<18}{values["sent"]:>6}{ms(values["p50"])}{ms(values["p90"])}{ms(values["p99"])}'
+              f'{values["http_errors"]:>10}{values["replies_ok"]:>6}{values["replies_rejected"]:>8}'
+              f'{values["replies_error"]:>7}{values["replies_missing"]:>9}{values["error_rate"]:>10.1%}')
+    pushes = report['image_pushes']
+    if pushes['expected']:
+        print(f'image pushes: {pushes["expected"]} expected, {pushes["ok"]} ok, '
+              f'{pushes["error"]} error, {pushes["missing"]} missing')
+    for service, endpoints in report['stubs'].items():
+        print(f'{service} stub: ' + ', '.join(
+            f'{name} {stats["calls"]} calls / {stats["injected_errors"]} injected errors'
+            for name, stats in endpoints.items()))
+
+
+def start_app(openai_stub, line_stub, port, extra_env):
+    env = dict(
+        os.environ,
+        LINE_CHANNEL_SECRET=CHANNEL_SECRET,
+        LINE_CHANNEL_ACCESS_TOKEN='loadtest-token',
+        LINE_API_HOST=line_stub.url,
+        OPENAI_BASE_URL=f'{openai_stub.url}/v1',
+        OPENAI_API_KEY='sk-loadtest',
+        OPENAI_MODEL_ENGINE='stub',
+        LOG_LEVEL='WARNING',
+        WEBHOOK_DEDUP_MONGODB='false',
+    )
+    env.update(extra_env)
+    process = subprocess.Popen([sys.executable, '-c', APP_SCRIPT, str(port)], cwd=ROOT, env=env)
+    target = f'http://127.0.0.1:{port}'
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError(f'app exited with status {process.returncode}')
+        try:
+            if requests.get(target, timeout=1).status_code == 200:
+                return process, target
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('app did not become ready')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rps', type=float, default=10)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of sending')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'message type weights, default {DEFAULT_MIX}')
+    parser.add_argument('--users', type=int, default=500, help='distinct LINE user ids to spread events over')
+    parser.add_argument('--concurrency', type=int, default=256, help='max in-flight webhook requests')
+    parser.add_argument('--timeout', type=float, default=90, help='client timeout of one webhook request')
+    parser.add_argument('--latency', default='', help='stub latency overrides, e.g. chat=1.5,blob=0.3')
+    parser.add_argument('--error-rate', default='', help='stub error rates, e.g. chat=0.02,reply=0.01')
+    parser.add_argument('--jitter', type=float, default=0.2, help='relative stub latency jitter')
+    parser.add_argument('--env', action='append', default=[], help='extra KEY=VALUE for the app, repeatable')
+    parser.add_argument('--port', type=int, default=18080, help='port of the spawned app')
+    parser.add_argument('--target', help='base URL of an already running app; do not spawn one')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args()
+
+    mix = parse_pairs(args.mix)
+    unknown = set(mix) - set(MESSAGE_TYPES)
+    if unknown:
+        parser.error(f'unknown message types: {", ".join(sorted(unknown))}')
+    latency = dict(DEFAULT_LATENCY, **parse_pairs(args.latency))
+    error_rate = parse_pairs(args.error_rate)
+    stub_options = dict(latency=latency, error_rate=error_rate, jitter=args.jitter)
+    openai_stub = start_openai_stub(seed=args.seed, **stub_options)
+    line_stub = start_line_stub(seed=args.seed + 1, **stub_options)
+
+    process = None
+    if args.target:
+        target = args.target
+        print(f'OPENAI_BASE_URL={openai_stub.url}/v1 LINE_API_HOST={line_stub.url} '
+              f'LINE_CHANNEL_SECRET={CHANNEL_SECRET}')
+    else:
+        extra_env = dict(item.split('=', 1) for item in args.env)
+        process, target = start_app(openai_stub, line_stub, args.port, extra_env)
+
+    try:
+        generator = LoadGenerator(target, args.rps, args.duration, mix, args.users,
+                                  args.concurrency, args.timeout, args.seed)
+        total, send_seconds, elapsed, lagging = generator.run()
+        wait_for_pushes(line_stub, args.timeout)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        openai_stub.shutdown()
+        line_stub.shutdown()
+
+    report = build_report(generator.samples, line_stub, openai_stub, total, send_seconds, elapsed, lagging, args.rps)
+    report['config'] = {'mix': mix, 'users': args.users, 'latency': latency, 'error_rate': error_rate}
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+FileStorage benchmark: the append-only journal against the previous
+whole-file rewrite, as the number of stored users grows.
+
+For each size N the store is pre-filled with N users, then:
+    save_us     mean time of one single-user save()
+    load_ms     time of load() on the resulting file
+    file_kb     file size after the saves
+
+Usage:
+    python benchmarks/storage.py --sizes 100,1000,10000 --saves 200
+    python benchmarks/storage.py --no-fsync --output storage.json
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.storage import FileStorage  # noqa: E402
+
+
+class LegacyFileStorage:
+    """The previous FileStorage: merge, then rewrite the whole JSON file on every save."""
+
+    def __init__(self, file_name):
+        self.fine_name = file_name
+        self.history = {}
+
+    def save(self, data):
+        self.history.update(data)
+        with open(self.fine_name, 'w', newline='') as f:
+            json.dump(self.history, f)
+
+    def load(self):
+        with open(self.fine_name, newline='') as jsonfile:
+            data = json.load(jsonfile)
+        self.history = data
+        return self.history
+
+
+def api_key(i):
+    return f'sk-proj-{i:08d}' + 'x' * 40
+
+
+def run(factory, directory, size, saves):
+    path = os.path.join(directory, 'storage.db')
+    store = factory(path)
+    # 預先放入 size 位使用者，只計算之後的 save
+    store.save({f'U{i:08d}': api_key(i) for i in range(size)})
+
+    start = default_timer()
+    for i in range(saves):
+        store.save({f'U{i % size:08d}': api_key(i + size)})
+    save_seconds = (default_timer() - start) / saves
+    if hasattr(store, 'close'):
+        store.close()
+
+    start = default_timer()
+    loaded = factory(path).load()
+    load_seconds = default_timer() - start
+    assert len(loaded) == size
+    return {
+        'save_us': save_seconds * 1e6,
+        'load_ms': load_seconds * 1e3,
+        'file_kb': os.path.getsize(path) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,10000,50000')
+    parser.add_argument('--saves', type=int, default=200)
+    parser.add_argument('--no-fsync', action='store_true', help='do not fsync journal appends')
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    args = parser.parse_args()
+
+    implementations = {
+        'legacy': LegacyFileStorage,
+        'journal': lambda path: FileStorage(path, fsync=not args.no_fsync),
+    }
+    results = {}
+    print(f'{"users":>8} {"impl":<8} {"save us":>12} {"load ms":>10} {"file KiB":>10}')
+    for size in (int(size) for size in args.sizes.split(',')):
+        for name, factory in implementations.items():
+            directory = tempfile.mkdtemp(prefix='storage-bench-')
+            try:
+                values = run(factory, directory, size, args.saves)
+            finally:
+                shutil.rmtree(directory)
+            results.setdefault(str(size), {})[name] = values
+            print(f'{size:>8} {name:<8} {values["save_us"]:12.1f} {values["load_ms"]:10.2f} {values["file_kb"]:10.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'saves': args.saves,
+                       'fsync': not args.no_fsync, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
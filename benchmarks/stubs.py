@@ -0,0 +1,335 @@
+"""
+Local stub servers emulating the OpenAI and LINE endpoints used by the bot.
+
+Each endpoint has its own simulated latency (mean seconds, with uniform
+relative jitter) and injected error rate. Every call is counted per
+endpoint, and LINE reply / push bodies are kept so a load test can check
+what the bot actually answered.
+"""
+import re
+import json
+import time
+import random
+import threading
+import itertools
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+STUB_CHAT_CONTENT = 'stub reply'
+STUB_TRANSCRIPTION = 'stub transcription'
+STUB_IMAGE_URL = 'https://stub.invalid/image.png'
+STUB_BLOB = b'\xff\xd8\xff\xe0' + b'\x00' * 2048
+
+DEFAULT_LATENCY = {
+    'chat': 0.8,
+    'transcription': 1.0,
+    'image': 2.0,
+    'reply': 0.05,
+    'push': 0.05,
+    'blob': 0.1,
+}
+
+
+class EventStream:
+    """Server-sent events payload; the stub writes the events one by one."""
+
+    def __init__(self, events):
+        self.events = events
+
+
+def chat_stream(body, content):
+    # 以空白切成多個 delta，模擬逐字輸出
+    deltas = re.findall(r'\S+\s*|\s+', content)
+    base = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'model': body.get('model') or 'stub'}
+    events = [dict(base, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])]
+    events += [dict(base, choices=[{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}]) for delta in deltas]
+    events.append(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+    events.append(dict(base, choices=[], usage={'prompt_tokens': 10, 'completion_tokens': len(deltas), 'total_tokens': 10 + len(deltas)}))
+    return EventStream(events)
+
+
+def chat_response(body):
+    if body.get('stream'):
+        return 200, chat_stream(body, STUB_CHAT_CONTENT)
+    return 200, {
+        'id': 'chatcmpl-stub', 'object': 'chat.completion', 'model': body.get('model') or 'stub',
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15},
+        'choices': [{'index': 0, 'finish_reason': 'stop',
+                     'message': {'role': 'assistant', 'content': STUB_CHAT_CONTENT}}],
+    }
+
+
+def transcription_response(body):
+    return 200, {'text': STUB_TRANSCRIPTION}
+
+
+def image_response(body):
+    return 200, {'created': 0, 'data': [{'url': STUB_IMAGE_URL}]}
+
+
+def line_message_response(body):
+    return 200, {'sentMessages': [{'id': str(i), 'quoteToken': 'stub'} for i, _ in enumerate(body.get('messages') or [])]}
+
+
+def blob_response(body):
+    return 200, STUB_BLOB
+
+
+OPENAI_ROUTES = [
+    ('POST', re.compile(r'^/v1/chat/completions$'), 'chat', chat_response),
+    ('POST', re.compile(r'^/v1/audio/transcriptions$'), 'transcription', transcription_response),
+    ('POST', re.compile(r'^/v1/images/generations$'), 'image', image_response),
+]
+
+class BatchStub:
+    """
+    In-memory Files and Batches API. A batch reports `in_progress` until
+    `complete_after` seconds after it was created, then `completed`: every
+    input line is answered by chat_response, except a `line_error_rate`
+    share that goes to the error file.
+    """
+
+    def __init__(self, complete_after=0.5, line_error_rate=0.0, seed=None):
+        self.complete_after = complete_after
+        self.line_error_rate = line_error_rate
+        self.random = random.Random(seed)
+        self.files = {}
+        self.batches = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def routes(self):
+        return [
+            ('POST', re.compile(r'^/v1/files$'), 'files', self.upload),
+            ('GET', re.compile(r'^/v1/files/([^/]+)/content$'), 'files', self.content),
+            ('POST', re.compile(r'^/v1/batches$'), 'batches', self.create),
+            ('GET', re.compile(r'^/v1/batches/([^/]+)$'), 'batches', self.retrieve),
+        ]
+
+    def _add_file(self, data, purpose):
+        with self._lock:
+            file_id = f'file-stub{next(self._ids)}'
+            self.files[file_id] = data
+        return {'id': file_id, 'object': 'file', 'bytes': len(data), 'purpose': purpose}
+
+    def upload(self, body):
+        if not isinstance(body.get('file'), bytes):
+            return 400, {'error': {'message': 'stub: missing file'}}
+        return 200, self._add_file(body['file'], body.get('purpose') or 'batch')
+
+    def content(self, body, file_id):
+        if file_id not in self.files:
+            return 404, {'error': {'message': f'stub: no file {file_id}'}}
+        return 200, self.files[file_id]
+
+    def create(self, body):
+        if body.get('input_file_id') not in self.files:
+            return 400, {'error': {'message': 'stub: unknown input_file_id'}}
+        with self._lock:
+            batch_id = f'batch_stub{next(self._ids)}'
+            batch = self.batches[batch_id] = {
+                'id': batch_id, 'object': 'batch', 'endpoint': body.get('endpoint'),
+                'input_file_id': body['input_file_id'], 'completion_window': body.get('completion_window'),
+                'metadata': body.get('metadata'), 'status': 'in_progress', 'created_at': time.time(),
+                'output_file_id': None, 'error_file_id': None,
+                'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+            }
+        return 200, batch
+
+    def retrieve(self, body, batch_id):
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return 404, {'error': {'message': f'stub: no batch {batch_id}'}}
+        if batch['status'] == 'in_progress' and time.time() - batch['created_at'] >= self.complete_after:
+            self._complete(batch)
+        return 200, batch
+
+    def _complete(self, batch):
+        outputs, errors = [], []
+        for line in self.files[batch['input_file_id']].decode('utf-8').splitlines():
+            request = json.loads(line)
+            if self.random.random() < self.line_error_rate:
+                errors.append({'id': f'batch_req_{len(errors)}', 'custom_id': request['custom_id'], 'response': {
+                    'status_code': 500, 'body': {'error': {'message': 'stub injected error'}}}, 'error': None})
+                continue
+            _, response = chat_response(request['body'])
+            outputs.append({'id': f'batch_req_{len(outputs)}', 'custom_id': request['custom_id'],
+                            'response': {'status_code': 200, 'body': response}, 'error': None})
+        dump = lambda lines: ''.join(json.dumps(line, ensure_ascii=False) + '\n' for line in lines).encode('utf-8')
+        batch['output_file_id'] = self._add_file(dump(outputs), 'batch_output')['id'] if outputs else None
+        batch['error_file_id'] = self._add_file(dump(errors), 'batch_output')['id'] if errors else None
+        batch['request_counts'] = {'total': len(outputs) + len(errors), 'completed': len(outputs), 'failed': len(errors)}
+        batch['status'] = 'completed'
+
+
+def parse_multipart(raw, content_type):
+    """multipart/form-data -> {field: str, or bytes for file fields}"""
+    message = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + raw)
+    fields = {}
+    for part in message.get_payload():
+        name = part.get_param('name', header='content-disposition')
+        data = part.get_payload(decode=True)
+        fields[name] = data if part.get_filename() else data.decode('utf-8')
+    return fields
+
+
+LINE_ROUTES = [
+    ('POST', re.compile(r'^/v2/bot/message/reply$'), 'reply', line_message_response),
+    ('POST', re.compile(r'^/v2/bot/message/push$'), 'push', line_message_response),
+    ('GET', re.compile(r'^/v2/bot/message/[^/]+/content$'), 'blob', blob_response),
+]
+
+
+class EndpointStats:
+    def __init__(self):
+        self.calls = 0
+        self.injected_errors = 0
+
+    def to_dict(self):
+        return {'calls': self.calls, 'injected_errors': self.injected_errors}
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 預設的 listen backlog 只有 5，高併發時連線會被拒絕
+    request_queue_size = 1024
+
+    def __init__(self, routes, latency=None, error_rate=None, jitter=0.2, seed=None, host='127.0.0.1', port=0,
+                 stream_interval=0.0):
+        """
+        :param routes: [(method, path regex, endpoint name, responder(body, *path groups) -> (status, payload))]
+        :param latency: {endpoint name: mean seconds}
+        :param error_rate: {endpoint name: probability of answering 500}
+        :param jitter: relative latency jitter, e.g. 0.2 means ±20%
+        :param stream_interval: seconds between the events of a streamed response
+        """
+        super().__init__((host, port), StubRequestHandler)
+        self.routes = routes
+        self.latency = dict(latency or {})
+        self.error_rate = dict(error_rate or {})
+        self.jitter = jitter
+        self.stream_interval = stream_interval
+        self.random = random.Random(seed)
+        self.stats = {name: EndpointStats() for _, _, name, _ in routes}
+        # (endpoint name, request body) of every LINE reply / push
+        self.messages = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def match(self, method, path):
+        """Return (endpoint name, responder, path parameters)."""
+        for route_method, pattern, name, responder in self.routes:
+            match = pattern.match(path) if route_method == method else None
+            if match:
+                return name, responder, match.groups()
+        return None, None, ()
+
+    def plan(self, name):
+        """Return (delay seconds, inject error) for one call, and count it."""
+        with self._lock:
+            stats = self.stats[name]
+            stats.calls += 1
+            mean = self.latency.get(name, 0.0)
+            delay = mean * (1 + self.random.uniform(-self.jitter, self.jitter)) if mean else 0.0
+            failed = self.random.random() < self.error_rate.get(name, 0.0)
+            if failed:
+                stats.injected_errors += 1
+        return max(0.0, delay), failed
+
+    def record_message(self, name, body):
+        with self._lock:
+            self.messages.append((name, body))
+
+    def metrics(self):
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_stub('GET')
+
+    def do_POST(self):
+        self.handle_stub('POST')
+
+    def handle_stub(self, method):
+        raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = self.path.split('?', 1)[0]
+        name, responder, params = self.server.match(method, path)
+        if name is None:
+            return self.send_payload(404, {'error': {'message': f'stub: no route for {method} {path}'}})
+
+        delay, failed = self.server.plan(name)
+        if delay:
+            time.sleep(delay)
+        if failed:
+            # OpenAI 與 LINE 的錯誤格式不同，兩種欄位都放
+            return self.send_payload(500, {'error': {'message': 'stub injected error'}, 'message': 'stub injected error'})
+
+        body = {}
+        content_type = self.headers.get('Content-Type') or ''
+        if raw and 'json' in content_type:
+            body = json.loads(raw)
+        elif raw and content_type.startswith('multipart/form-data'):
+            body = parse_multipart(raw, content_type)
+        if name in ('reply', 'push'):
+            self.server.record_message(name, body)
+        status, payload = responder(body, *params)
+        self.send_payload(status, payload)
+
+    def send_payload(self, status, payload):
+        if isinstance(payload, EventStream):
+            return self.send_event_stream(status, payload)
+        if isinstance(payload, bytes):
+            data, content_type = payload, 'application/octet-stream'
+        else:
+            data, content_type = json.dumps(payload).encode(), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_event_stream(self, status, stream):
+        # 與 OpenAI 相同使用 chunked transfer encoding，每個 event 一個 chunk
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for event in stream.events + ['[DONE]']:
+                data = event if isinstance(event, str) else json.dumps(event, ensure_ascii=False)
+                chunk = f'data: {data}\n\n'.encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.flush()
+                if self.server.stream_interval:
+                    time.sleep(self.server.stream_interval)
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # client 在 deadline 時提早關閉連線
+            self.close_connection = True
+
+
+def start_openai_stub(batches=None, **kwargs):
+    """:param batches: BatchStub serving the Files / Batches endpoints; a fresh one by default"""
+    batches = batches or BatchStub(seed=kwargs.get('seed'))
+    server = StubServer(OPENAI_ROUTES + batches.routes(), **kwargs).start()
+    server.batches = batches
+    return server
+
+
+def start_line_stub(**kwargs):
+    return StubServer(LINE_ROUTES, **kwargs).start()
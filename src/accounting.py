@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import sqlite3
+import datetime
+import threading
+
+from .admission import AdmissionRejected
+from .logger import get_logger
+
+
+logger = get_logger('accounting')
+
+QUOTA_EXCEEDED_MESSAGE = '今日的使用額度已用完，請明天再試'
+# 沒有對應使用者的呼叫（例如背景的對話摘要）記在這個 user_id 底下
+SYSTEM_USER = 'system'
+# 未指定 task 時，依 endpoint 區分呼叫類型
+ENDPOINT_TASKS = {
+    '/chat/completions': 'chat',
+    '/audio/transcriptions': 'audio',
+    '/images/generations': 'image',
+    '/embeddings': 'embedding',
+    '/models': 'models',
+    '/files': 'batch',
+    '/batches': 'batch',
+}
+FIELDS = ('calls', 'failures', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'latency_seconds', 'cost')
+
+
+class QuotaExceeded(AdmissionRejected):
+    pass
+
+
+def today():
+    return time.strftime('%Y-%m-%d')
+
+
+def task_for(endpoint, task=None):
+    return task or ENDPOINT_TASKS.get(endpoint, endpoint)
+
+
+class UsageAccounting:
+    """
+    Per-user, per-day accounting of every OpenAI call: calls, failures,
+    prompt / cached / completion tokens, latency and estimated cost, keyed
+    by (day, user_id, model, task).
+
+    record() only adds to an in-memory aggregate; a background thread
+    flushes the increments to `store` every `flush_interval` seconds, or as
+    soon as `batch_size` keys are pending. Without a store only today's
+    aggregate is kept, in memory.
+
+    check() enforces the optional daily quotas before a call is issued, on
+    the user's totals for today (read from the store once per user and day,
+    so the quota survives restarts).
+
+    ACCOUNTING_PRICES is a JSON object of USD per million tokens, e.g.
+    {"gpt-5-mini": {"prompt": 0.25, "cached": 0.025, "completion": 2.0}};
+    models without a price count tokens but no cost.
+
+    Environment Variables:
+        ACCOUNTING_BACKEND
+        ACCOUNTING_SQLITE_PATH
+        ACCOUNTING_FLUSH_INTERVAL
+        ACCOUNTING_BATCH_SIZE
+        ACCOUNTING_DAILY_TOKEN_QUOTA
+        ACCOUNTING_DAILY_COST_QUOTA
+        ACCOUNTING_PRICES
+    """
+
+    def __init__(self, store=None, flush_interval=30.0, batch_size=500,
+                 daily_token_quota=None, daily_cost_quota=None, prices=None):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.daily_token_quota = daily_token_quota
+        self.daily_cost_quota = daily_cost_quota
+        self.prices = dict(prices or {})
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        # user_id -> [day, tokens, cost]，只保留當天
+        self._totals = {}
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._counters = {
+            'recorded': 0,
+            'quota_rejected': 0,
+            'flushes': 0,
+            'flushed_rows': 0,
+            'flush_failures': 0,
+        }
+
+    @classmethod
+    def from_env(cls, db=None):
+        """
+        :param db: Mongo database for ACCOUNTING_BACKEND=mongodb; defaults to the shared `mongodb` connection
+        """
+        backend = os.getenv('ACCOUNTING_BACKEND', '').lower()
+        if backend == 'mongodb':
+            if db is None:
+                from .mongodb import mongodb
+                if getattr(mongodb, 'db', None) is None:
+                    mongodb.connect_to_database()
+                db = mongodb.db
+            store = MongoUsageStore(db)
+        elif backend == 'sqlite':
+            store = SQLiteUsageStore(os.getenv('ACCOUNTING_SQLITE_PATH', 'usage.sqlite3'))
+        else:
+            store = None
+        token_quota = os.getenv('ACCOUNTING_DAILY_TOKEN_QUOTA')
+        cost_quota = os.getenv('ACCOUNTING_DAILY_COST_QUOTA')
+        return cls(
+            store,
+            flush_interval=float(os.getenv('ACCOUNTING_FLUSH_INTERVAL', '30')),
+            batch_size=int(os.getenv('ACCOUNTING_BATCH_SIZE', '500')),
+            daily_token_quota=int(token_quota) if token_quota else None,
+            daily_cost_quota=float(cost_quota) if cost_quota else None,
+            prices=json.loads(os.getenv('ACCOUNTING_PRICES') or '{}'),
+        )
+
+    def cost(self, model, prompt_tokens, cached_tokens, completion_tokens):
+        price = self.prices.get(model)
+        if not price:
+            return 0.0
+        # cached_tokens 包含在 prompt_tokens 裡，以較低的價格計算
+        return (
+            (prompt_tokens - cached_tokens) * price.get('prompt', 0)
+            + cached_tokens * price.get('cached', price.get('prompt', 0))
+            + completion_tokens * price.get('completion', 0)
+        ) / 1e6
+
+    def _user_totals(self, user_id, day):
+        with self._lock:
+            totals = self._totals.get(user_id)
+            if totals is not None and totals[0] == day:
+                return totals
+        # 讀取期間不能 flush，否則剛寫入的部分會同時不在 store 與 pending 的數字裡
+        with self._flush_lock:
+            tokens, cost = self.store.totals(day, user_id) if self.store is not None else (0, 0.0)
+            with self._lock:
+                totals = self._totals.get(user_id)
+                if totals is None or totals[0] != day:
+                    # store 的數字只包含 flush 過的部分，還在 pending 的另外加上
+                    for (pending_day, pending_user, _, _), row in self._pending.items():
+                        if pending_day == day and pending_user == user_id:
+                            tokens += row['prompt_tokens'] + row['completion_tokens']
+                            cost += row['cost']
+                    totals = self._totals[user_id] = [day, tokens, cost]
+                return totals
+
+    @property
+    def has_quota(self) -> bool:
+        return self.daily_token_quota is not None or self.daily_cost_quota is not None
+
+    def check(self, user_id):
+        """
+        Raise QuotaExceeded when `user_id` has used up today's quota.
+
+        The first check per user and day reads the store (and may wait for a
+        running flush); async callers run it in a worker thread.
+        """
+        if user_id is None or not self.has_quota:
+            return
+        _, tokens, cost = self._user_totals(user_id, today())
+        if ((self.daily_token_quota is not None and tokens >= self.daily_token_quota)
+                or (self.daily_cost_quota is not None and cost >= self.daily_cost_quota)):
+            with self._lock:
+                self._counters['quota_rejected'] += 1
+            raise QuotaExceeded(QUOTA_EXCEEDED_MESSAGE)
+
+    def record(self, user_id, model, task, seconds, usage=None, is_successful=True, cost_factor=1.0):
+        """:param cost_factor: multiplier on the listed prices, e.g. 0.5 for Batch API results"""
+        usage = usage or {}
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        completion_tokens = usage.get('completion_tokens') or 0
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        cost = self.cost(model, prompt_tokens, cached_tokens, completion_tokens) * cost_factor
+        user_id = user_id or SYSTEM_USER
+        day = today()
+        with self._lock:
+            row = self._pending.get((day, user_id, model, task))
+            if row is None:
+                row = self._pending[(day, user_id, model, task)] = dict.fromkeys(FIELDS, 0)
+            row['calls'] += 1
+            row['failures'] += 0 if is_successful else 1
+            row['prompt_tokens'] += prompt_tokens
+            row['cached_tokens'] += cached_tokens
+            row['completion_tokens'] += completion_tokens
+            row['latency_seconds'] += seconds
+            row['cost'] += cost
+            totals = self._totals.get(user_id)
+            if totals is not None and totals[0] == day:
+                totals[1] += prompt_tokens + completion_tokens
+                totals[2] += cost
+            self._counters['recorded'] += 1
+            full = self.store is not None and len(self._pending) >= self.batch_size
+        self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        if self._thread is not None or self._closed:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='usage-accounting', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('failed to flush usage')
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                # 換日後不再需要前一天的 totals
+                day = today()
+                for user_id in [u for u, totals in self._totals.items() if totals[0] != day]:
+                    del self._totals[user_id]
+                if self.store is None:
+                    # 沒有 store 時只在記憶體保留當天的統計
+                    self._pending = {key: row for key, row in self._pending.items() if key[0] == day}
+                    return
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                self.store.add(pending)
+            except Exception:
+                with self._lock:
+                    # 寫入失敗時合併回 pending，下次 flush 再試
+                    self._counters['flush_failures'] += 1
+                    for key, row in pending.items():
+                        current = self._pending.setdefault(key, dict.fromkeys(FIELDS, 0))
+                        for field in FIELDS:
+                            current[field] += row[field]
+                raise
+            with self._lock:
+                self._counters['flushes'] += 1
+                self._counters['flushed_rows'] += len(pending)
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'pending': len(self._pending),
+                'users_today': len(self._totals),
+            }
+
+
+class MongoUsageStore:
+    """Daily usage rows in the `usage` collection, one per (day, user_id, model, task)."""
+
+    def __init__(self, db, collection='usage'):
+        self.collection = db[collection]
+        self.collection.create_index([('day', 1), ('user_id', 1), ('model', 1), ('task', 1)], unique=True)
+
+    def add(self, rows):
+        from pymongo import UpdateOne
+        now = datetime.datetime.utcnow()
+        requests = [UpdateOne(
+            {'day': day, 'user_id': user_id, 'model': model, 'task': task},
+            {'$inc': row, '$set': {'updated_at': now}},
+            upsert=True,
+        ) for (day, user_id, model, task), row in rows.items()]
+        self.collection.bulk_write(requests, ordered=False)
+
+    def totals(self, day, user_id):
+        tokens, cost = 0, 0.0
+        for doc in self.collection.find({'day': day, 'user_id': user_id},
+                                        {'_id': 0, 'prompt_tokens': 1, 'completion_tokens': 1, 'cost': 1}):
+            tokens += doc.get('prompt_tokens', 0) + doc.get('completion_tokens', 0)
+            cost += doc.get('cost', 0.0)
+        return tokens, cost
+
+
+class SQLiteUsageStore:
+    """The same rows in a local SQLite file, for deployments without MongoDB."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS usage ('
+                'day TEXT NOT NULL, user_id TEXT NOT NULL, model TEXT NOT NULL, task TEXT NOT NULL, '
+                'calls INTEGER NOT NULL DEFAULT 0, failures INTEGER NOT NULL DEFAULT 0, '
+                'prompt_tokens INTEGER NOT NULL DEFAULT 0, cached_tokens INTEGER NOT NULL DEFAULT 0, '
+                'completion_tokens INTEGER NOT NULL DEFAULT 0, latency_seconds REAL NOT NULL DEFAULT 0, '
+                'cost REAL NOT NULL DEFAULT 0, '
+                'PRIMARY KEY (day, user_id, model, task))')
+
+    def add(self, rows):
+        columns = ', '.join(FIELDS)
+        placeholders = ', '.join('?' for _ in FIELDS)
+        updates = ', '.join(f'{field} = {field} + excluded.{field}' for field in FIELDS)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f'INSERT INTO usage (day, user_id, model, task, {columns}) VALUES (?, ?, ?, ?, {placeholders}) '
+                f'ON CONFLICT (day, user_id, model, task) DO UPDATE SET {updates}',
+                [(*key, *(row[field] for field in FIELDS)) for key, row in rows.items()])
+
+    def totals(self, day, user_id):
+        with self._lock:
+            tokens, cost = self._conn.execute(
+                'SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0), COALESCE(SUM(cost), 0) '
+                'FROM usage WHERE day = ? AND user_id = ?', (day, user_id)).fetchone()
+        return tokens, cost
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
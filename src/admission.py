@@ -0,0 +1,197 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+
+
+RATE_LIMITED_MESSAGE = '訊息傳送太頻繁，請稍後再試'
+BUSY_MESSAGE = '目前使用人數眾多，請稍後再試'
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """
+        :param rate: 每秒補充的 token 數
+        :param capacity: bucket 最大容量（可允許的瞬間爆量）
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def try_consume(self, tokens: float = 1) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+
+class AdmissionController:
+    """
+    Admission layer in front of every OpenAI call.
+
+    - admit(): per-user token bucket, checked once per incoming message.
+    - slot(): global concurrency limit with a bounded wait queue, held for the
+      duration of each upstream request.
+    - async_slot(): the same for the async serving path. It has its own
+      max_concurrency slots on an asyncio.Semaphore, since coroutines must not
+      block the event loop on the thread semaphore.
+
+    Environment Variables:
+        ADMISSION_MAX_CONCURRENCY
+        ADMISSION_MAX_QUEUE
+        ADMISSION_QUEUE_TIMEOUT
+        ADMISSION_USER_RATE
+        ADMISSION_USER_BURST
+    """
+
+    def __init__(self, max_concurrency=8, max_queue=32, queue_timeout=30.0,
+                 user_rate=0.2, user_burst=3, max_users=10000, wait_sample_size=1024):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_users = max_users
+
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._async_semaphore = None
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._waiting = 0
+        self._in_flight = 0
+        self._wait_times = deque(maxlen=wait_sample_size)
+        self._wait_time_total = 0.0
+        self._counters = {
+            'admitted': 0,
+            'rate_limited': 0,
+            'queue_full': 0,
+            'queue_timeout': 0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrency=int(os.getenv('ADMISSION_MAX_CONCURRENCY', '8')),
+            max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', '32')),
+            queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '30')),
+            user_rate=float(os.getenv('ADMISSION_USER_RATE', '0.2')),
+            user_burst=float(os.getenv('ADMISSION_USER_BURST', '3')),
+        )
+
+    def _get_bucket(self, user_id: str) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+            self._buckets[user_id] = bucket
+            # 只保留最近活躍的使用者，避免 bucket 無限增長
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    def admit(self, user_id: str, cost: float = 1) -> None:
+        """Consume `cost` tokens from the user's bucket or raise AdmissionRejected."""
+        with self._lock:
+            if self._get_bucket(user_id).try_consume(cost):
+                return
+            self._counters['rate_limited'] += 1
+        raise AdmissionRejected(RATE_LIMITED_MESSAGE)
+
+    @contextmanager
+    def slot(self, timeout: float = None):
+        """Hold one global concurrency slot; reject fast when the wait queue is full."""
+        start = time.monotonic()
+        if not self._semaphore.acquire(blocking=False):
+            with self._lock:
+                if self._waiting >= self.max_queue:
+                    self._counters['queue_full'] += 1
+                    raise AdmissionRejected(BUSY_MESSAGE)
+                self._waiting += 1
+            try:
+                wait_timeout = self.queue_timeout if timeout is None else min(self.queue_timeout, timeout)
+                acquired = self._semaphore.acquire(timeout=wait_timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if not acquired:
+                with self._lock:
+                    self._counters['queue_timeout'] += 1
+                raise AdmissionRejected(BUSY_MESSAGE)
+
+        self._record_admitted(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def async_slot(self, timeout: float = None):
+        """Async version of slot(); the wait queue and counters are shared with it."""
+        if self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+        semaphore = self._async_semaphore
+        start = time.monotonic()
+        if semaphore.locked():
+            with self._lock:
+                if self._waiting >= self.max_queue:
+                    self._counters['queue_full'] += 1
+                    raise AdmissionRejected(BUSY_MESSAGE)
+                self._waiting += 1
+            try:
+                wait_timeout = self.queue_timeout if timeout is None else min(self.queue_timeout, timeout)
+                await asyncio.wait_for(semaphore.acquire(), wait_timeout)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self._counters['queue_timeout'] += 1
+                raise AdmissionRejected(BUSY_MESSAGE)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+        else:
+            await semaphore.acquire()
+
+        self._record_admitted(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            semaphore.release()
+
+    def _record_admitted(self, wait_time):
+        with self._lock:
+            self._in_flight += 1
+            self._counters['admitted'] += 1
+            self._wait_times.append(wait_time)
+            self._wait_time_total += wait_time
+
+    def metrics(self) -> dict:
+        with self._lock:
+            wait_times = sorted(self._wait_times)
+            result = {
+                'queue_depth': self._waiting,
+                'in_flight': self._in_flight,
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'tracked_users': len(self._buckets),
+                'wait_time_seconds_total': self._wait_time_total,
+                **self._counters,
+            }
+        if wait_times:
+            result['wait_time_p50'] = wait_times[len(wait_times) // 2]
+            result['wait_time_p95'] = wait_times[min(len(wait_times) - 1, int(len(wait_times) * 0.95))]
+            result['wait_time_max'] = wait_times[-1]
+        return result
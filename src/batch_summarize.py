@@ -0,0 +1,353 @@
+"""
+Offline bulk summarization of article and YouTube URLs.
+
+Reads one URL per line (blank lines and lines starting with # are skipped)
+and summarizes them with the same Website / Youtube fetchers and readers as
+the bot, `--concurrency` at a time. Every result is appended to the JSONL
+output as soon as it finishes:
+    {"url": ..., "kind": "website" | "youtube", "ok": true, "summary": ..., "seconds": ..., "usage": {...}}
+    {"url": ..., "kind": ..., "ok": false, "error": ..., "seconds": ...}
+
+The output doubles as the checkpoint: re-running with the same --output
+skips every URL that already has a successful line (and, unless
+--retry-failed, every URL that already failed), so an interrupted run
+resumes where it stopped.
+
+With --batch the summaries go through the OpenAI Batch API instead (half
+price, off the live rate limit, done within 24 hours): pages and
+transcripts are fetched `--concurrency` at a time, then one batch holds
+every single-step summary and every YouTube part summary, and a second
+batch the YouTube final summaries. The batch in flight is kept in
+<output>.batch.json, so an interrupted run picks it up again instead of
+submitting a new one.
+
+Usage:
+    python -m src.batch_summarize urls.txt --output summaries.jsonl --concurrency 8
+    cat urls.txt | python -m src.batch_summarize - --output summaries.jsonl --retry-failed
+    python -m src.batch_summarize urls.txt --output summaries.jsonl --batch --poll-interval 60
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+
+from dotenv import load_dotenv
+
+# src 模組在 import 時會讀取環境變數（例如 logger 設定），需先載入 .env
+load_dotenv('.env')
+
+from .models import OpenAIModel  # noqa: E402
+from .routing import ModelRouter  # noqa: E402
+from .accounting import UsageAccounting, QuotaExceeded  # noqa: E402
+from .deadline import Deadline  # noqa: E402
+from .utils import get_role_and_content  # noqa: E402
+from .logger import get_logger  # noqa: E402
+from .service.website import Website, WebsiteReader  # noqa: E402
+from .service.youtube import Youtube, YoutubeTranscriptReader  # noqa: E402
+
+
+logger = get_logger('batch_summarize')
+
+# 用量記錄在這個 user_id 底下，與 LINE 使用者分開
+BATCH_USER = 'batch'
+
+
+def read_urls(path):
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def read_checkpoint(path):
+    """Return {url: ok} for the results already in the output file."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中斷時最後一行可能只寫了一半
+                continue
+            done[record['url']] = done.get(record['url']) or record.get('ok', False)
+    return done
+
+
+class BatchSummarizer:
+    def __init__(self, model, model_engine, timeout=300.0):
+        self.model = model
+        self.model_engine = model_engine
+        self.timeout = timeout
+        self.website = Website()
+        self.youtube = Youtube()
+
+    def kind(self, url):
+        return 'youtube' if self.youtube.retrieve_video_id(url) else 'website'
+
+    def reader(self, kind):
+        if kind == 'youtube':
+            return YoutubeTranscriptReader(self.model, self.model_engine)
+        return WebsiteReader(self.model, self.model_engine)
+
+    def fetch(self, kind, url, deadline=None):
+        """Return the text chunks of `url`; raise with the reason when there are none."""
+        if kind == 'youtube':
+            is_successful, chunks, error_message = self.youtube.get_transcript_chunks(
+                self.youtube.retrieve_video_id(url), deadline=deadline)
+            if not is_successful:
+                raise Exception(error_message)
+            return chunks
+        chunks = self.website.get_content_from_url(url, deadline=deadline)
+        if not chunks:
+            raise Exception('無法撈取此網站文字')
+        return chunks
+
+    def summarize(self, url):
+        """Summarize one URL; return the JSONL record."""
+        deadline = Deadline(self.timeout)
+        start = time.perf_counter()
+        record = {'url': url, 'kind': self.kind(url)}
+        try:
+            chunks = self.fetch(record['kind'], url, deadline=deadline)
+            is_successful, response, error_message = self.reader(record['kind']).summarize(chunks, deadline=deadline)
+            if not is_successful:
+                raise Exception(error_message)
+            _, content = get_role_and_content(response)
+            record.update(ok=True, summary=content, usage=response.get('usage'))
+        except Exception as e:
+            record.update(ok=False, error=str(e) or type(e).__name__)
+        record['seconds'] = round(time.perf_counter() - start, 3)
+        return record
+
+
+class BatchApiSummarizer:
+    """
+    --batch mode: the same summaries as BatchSummarizer, as OpenAI Batch API
+    jobs. Each job is one URL; its requests use custom_id "<job>" for the
+    summary returned to the user and "<job>:<part>" for YouTube part
+    summaries, which feed the job's second-stage request.
+    """
+
+    def __init__(self, summarizer: BatchSummarizer, state_path, poll_interval=30.0, batch_timeout=None):
+        self.summarizer = summarizer
+        self.model = summarizer.model
+        self.state_path = state_path
+        self.poll_interval = poll_interval
+        self.batch_timeout = batch_timeout
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    def clear_state(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def prepare(self, url):
+        """Fetch one URL; return (job, requests) or a failure record."""
+        summarizer = self.summarizer
+        kind = summarizer.kind(url)
+        try:
+            chunks = summarizer.fetch(kind, url, deadline=Deadline(summarizer.timeout))
+        except Exception as e:
+            return {'url': url, 'kind': kind, 'ok': False, 'error': str(e) or type(e).__name__, 'seconds': 0.0}
+        return {'url': url, 'kind': kind, 'parts': len(chunks) if kind == 'youtube' and len(chunks) > 1 else 0,
+                'started_at': time.time()}, chunks
+
+    def first_stage_requests(self, job_id, job, chunks):
+        reader = self.summarizer.reader(job['kind'])
+        engine = self.summarizer.model_engine
+        if job['kind'] == 'website':
+            return [self.model.batch_request(job_id, reader.build_messages(chunks), engine, task='reduce')]
+        if not job['parts']:
+            return [self.model.batch_request(job_id, reader.build_single_messages(chunks), engine, task='reduce')]
+        return [self.model.batch_request(f'{job_id}:{i}', reader.build_part_messages(i, chunk), engine, task='map')
+                for i, chunk in enumerate(chunks)]
+
+    def record(self, job, ok, batch_id, response=None, error=None):
+        record = {'url': job['url'], 'kind': job['kind'], 'ok': ok}
+        if ok:
+            _, content = get_role_and_content(response)
+            record.update(summary=content, usage=response.get('usage'))
+        else:
+            record['error'] = error
+        record.update(seconds=round(time.time() - job['started_at'], 3), batch_id=batch_id)
+        return record
+
+    def run_stage(self, state):
+        """Wait for the state's batch; return (records, next stage requests, next stage jobs)."""
+        batch_id = state['batch_id']
+        logger.info('waiting for batch %s (stage %d, %d jobs)', batch_id, state['stage'], len(state['jobs']))
+        is_successful, results, error_message = self.model.collect_batch(
+            batch_id, poll_interval=self.poll_interval, timeout=self.batch_timeout)
+        if not is_successful:
+            raise RuntimeError(f'batch {batch_id}: {error_message}')
+        records, requests, jobs = [], [], {}
+        reader = YoutubeTranscriptReader(self.model, self.summarizer.model_engine)
+        for job_id, job in state['jobs'].items():
+            if state['stage'] == 2 or not job['parts']:
+                result = results.get(job_id) or (False, None, 'batch 未完成這個請求')
+                records.append(self.record(job, result[0], batch_id, result[1], result[2]))
+                continue
+            parts = [results.get(f'{job_id}:{i}') or (False, None, 'batch 未完成這個請求') for i in range(job['parts'])]
+            failed = next((part for part in parts if not part[0]), None)
+            if failed is not None:
+                records.append(self.record(job, False, batch_id, error=failed[2]))
+                continue
+            summaries = [get_role_and_content(response)[1] for _, response, _ in parts]
+            requests.append(self.model.batch_request(
+                job_id, reader.build_whole_messages(summaries), self.summarizer.model_engine, task='reduce'))
+            jobs[job_id] = job
+        return records, requests, jobs
+
+    def submit(self, stage, requests, jobs):
+        is_successful, batch, error_message = self.model.submit_batch(requests, metadata={'stage': str(stage)})
+        if not is_successful:
+            raise RuntimeError(f'failed to submit batch: {error_message}')
+        state = {'stage': stage, 'batch_id': batch['id'], 'jobs': jobs}
+        self.save_state(state)
+        logger.info('submitted batch %s: %d requests', batch['id'], len(requests))
+        return state
+
+    def resume(self, write):
+        """Finish the batch left by an interrupted run, if any."""
+        state = self.load_state()
+        while state is not None:
+            records, requests, jobs = self.run_stage(state)
+            for record in records:
+                write(record)
+            state = self.submit(2, requests, jobs) if requests else None
+        self.clear_state()
+
+    def run(self, urls, concurrency, write):
+        jobs, requests = {}, []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for i, prepared in enumerate(executor.map(self.prepare, urls)):
+                if isinstance(prepared, dict):
+                    write(prepared)
+                    continue
+                job, chunks = prepared
+                jobs[str(i)] = job
+                requests.extend(self.first_stage_requests(str(i), job, chunks))
+        if requests:
+            self.submit(1, requests, jobs)
+            self.resume(write)
+
+
+def print_stats(records, skipped, elapsed, interrupted=False):
+    succeeded = [r for r in records if r['ok']]
+    failed = [r for r in records if not r['ok']]
+    latencies = sorted(r['seconds'] for r in records)
+    prompt_tokens = sum((r.get('usage') or {}).get('prompt_tokens') or 0 for r in succeeded)
+    completion_tokens = sum((r.get('usage') or {}).get('completion_tokens') or 0 for r in succeeded)
+    print(f'{"interrupted after" if interrupted else "finished in"} {elapsed:.1f}s: '
+          f'{len(records)} processed, {len(succeeded)} ok, {len(failed)} failed, {skipped} skipped (checkpoint)')
+    if records:
+        print(f'throughput {len(records) / elapsed * 60:.1f} urls/min, '
+              f'latency p50 {statistics.median(latencies):.1f}s '
+              f'p90 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]:.1f}s '
+              f'max {latencies[-1]:.1f}s')
+        print(f'tokens: {prompt_tokens} prompt, {completion_tokens} completion (last call of each summary)')
+    for kind in ('website', 'youtube'):
+        kind_records = [r for r in records if r['kind'] == kind]
+        if kind_records:
+            print(f'  {kind:<8} {len(kind_records):5d} processed, '
+                  f'{sum(1 for r in kind_records if not r["ok"]):5d} failed')
+    for error, count in Counter(r['error'] for r in failed).most_common(5):
+        print(f'  {count:5d} x {error[:120]}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help="file with one URL per line, or '-' for stdin")
+    parser.add_argument('--output', required=True, help='JSONL results, also used as the resume checkpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds allowed per URL')
+    parser.add_argument('--model', default=os.getenv('OPENAI_MODEL_ENGINE'), help='default: OPENAI_MODEL_ENGINE')
+    parser.add_argument('--retry-failed', action='store_true', help='process URLs that failed in an earlier run again')
+    parser.add_argument('--batch', action='store_true', help='summarize through the OpenAI Batch API')
+    parser.add_argument('--poll-interval', type=float, default=30.0, help='seconds between batch status checks')
+    parser.add_argument('--batch-timeout', type=float, help='give up waiting for a batch after this many seconds')
+    args = parser.parse_args(argv)
+
+    website = Website()
+    urls, seen = [], set()
+    for url in read_urls(args.input):
+        key = website.normalize_url(url)
+        if key not in seen:
+            seen.add(key)
+            urls.append(url)
+
+    accounting = UsageAccounting.from_env()
+    model = OpenAIModel(api_key=os.getenv('OPENAI_API_KEY'), router=ModelRouter.from_env(),
+                        accounting=accounting, user_id=BATCH_USER)
+    summarizer = BatchSummarizer(model, args.model, timeout=args.timeout)
+
+    records = []
+    skipped = 0
+    interrupted = failed_batch = False
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    try:
+        with open(args.output, 'a+', encoding='utf-8') as out:
+            if out.tell():
+                out.seek(out.tell() - 1)
+                if out.read(1) != '\n':
+                    # 上次中斷在一行的中間，先換行以免下一筆接在壞掉的那行後面
+                    out.write('\n')
+
+            def write(record):
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                # 每筆寫完就 flush，中斷時最多只會少掉正在處理中的幾筆
+                out.flush()
+                records.append(record)
+                if not record['ok']:
+                    logger.warning('%s: %s', record['url'], record['error'])
+
+            batch_summarizer = None
+            if args.batch:
+                batch_summarizer = BatchApiSummarizer(
+                    summarizer, args.output + '.batch.json',
+                    poll_interval=args.poll_interval, batch_timeout=args.batch_timeout)
+                batch_summarizer.resume(write)
+            # 在續跑上次的 batch 之後才讀 checkpoint，才不會重送已有結果的 URL
+            done = read_checkpoint(args.output)
+            todo = [url for url in urls if url not in done or (args.retry_failed and not done[url])]
+            skipped = len(urls) - len(todo) - len({record['url'] for record in records})
+            if batch_summarizer is not None:
+                batch_summarizer.run(todo, args.concurrency, write)
+            else:
+                futures = [executor.submit(summarizer.summarize, url) for url in todo]
+                for future in as_completed(futures):
+                    write(future.result())
+    except KeyboardInterrupt:
+        interrupted = True
+    except (RuntimeError, QuotaExceeded) as e:
+        # batch 失敗、等待逾時或額度用完；進行中的 batch 仍留在 state 檔，下次執行會接續
+        logger.error('%s', e)
+        failed_batch = True
+    finally:
+        executor.shutdown(wait=not interrupted, cancel_futures=True)
+        accounting.close()
+    print_stats(records, skipped, time.perf_counter() - start, interrupted)
+    return 130 if interrupted else (1 if failed_batch else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+import os
+import time
+import contextvars
+
+
+DEADLINE_MESSAGE = '處理時間過長，請稍後再試'
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, message=DEADLINE_MESSAGE):
+        super().__init__(message)
+
+
+class Deadline:
+    """
+    Wall-clock budget for handling one webhook request.
+
+    Created when the request arrives and shared by all of its events (see
+    `request_deadline`), then passed down to every outbound call, which
+    derives its timeout from the remaining budget instead of using a fixed
+    value.
+
+    Environment Variables:
+        WEBHOOK_DEADLINE_SECONDS
+    """
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    @classmethod
+    def from_env(cls):
+        # vercel.json 的 maxDuration 為 60 秒，保留時間給最後的 LINE reply
+        return cls(float(os.getenv('WEBHOOK_DEADLINE_SECONDS', '50')))
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def has_budget(self, seconds: float) -> bool:
+        return self.remaining() >= seconds
+
+    def timeout(self, default: float = None) -> float:
+        """Timeout for the next call: the remaining budget, capped at `default`."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return remaining if default is None else min(default, remaining)
+
+
+# 整個 webhook request 共用一個 Deadline：同一位使用者的多個事件依序執行，
+# 各自計時會讓整批超過 function 的執行上限
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+def current_deadline() -> Deadline:
+    """The current webhook request's Deadline, or a fresh one outside a request."""
+    deadline = request_deadline.get()
+    return deadline if deadline is not None else Deadline.from_env()
+
+
+def timeout_for(deadline, default):
+    """Timeout derived from an optional deadline, falling back to `default`."""
+    if deadline is None:
+        return default
+    return deadline.timeout(default)
@@ -0,0 +1,224 @@
+import os
+import math
+import time
+import heapq
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Union
+
+from . import metrics
+from .utils import message_text, search_terms
+
+
+PASSAGES_PREFIX = 'Passages from the document the user shared earlier ({}), most relevant to their question:\n'
+# 幾乎每段都會出現的英文虛詞；單一中文字（是、的）也一樣不足以判斷相關
+STOP_WORDS = frozenset('''
+a about an and are as at be been but by can could did do does for from had has have how i if in into is it
+its just like me my no not of on or our please so tell that the their them then there these they this to
+want was we were what when where which who why will with would you your
+'''.split())
+
+
+def is_content_term(term: str) -> bool:
+    """Whether a search term says something about the topic: not a single character or a stop word."""
+    return len(term) > 1 and term not in STOP_WORDS
+
+
+class PassageIndex:
+    """
+    BM25 index over the passages of one document. Built once per fetched
+    document and read-only afterwards, so the users sharing a summary can
+    share the index.
+
+    Only content terms (see `is_content_term`) are scored: a question that
+    shares nothing but 是, 的 or "the" with the document matches nothing.
+    """
+
+    def __init__(self, source: str, passages: List[str], k1=1.2, b=0.75):
+        self.source = source
+        self.passages = passages
+        self.chars = sum(map(len, passages))
+        self.k1 = k1
+        self.b = b
+        self.lengths = []
+        # term -> [(passage, term frequency)]
+        self.postings = {}
+        for i, passage in enumerate(passages):
+            terms = Counter(search_terms(passage))
+            self.lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self.postings.setdefault(term, []).append((i, tf))
+        self.avg_length = sum(self.lengths) / len(passages) if passages else 0.0
+        n = len(passages)
+        self.idf = {term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in self.postings.items()}
+
+    @staticmethod
+    def split(text: str, passage_chars: int) -> List[str]:
+        """Split text into passages of about `passage_chars`, at line breaks where possible."""
+        passages = []
+        current = []
+        size = 0
+        for line in text.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            # 單行過長（例如整段無換行的網頁文字）直接切開
+            while len(line) > passage_chars:
+                if current:
+                    passages.append('\n'.join(current))
+                    current, size = [], 0
+                passages.append(line[:passage_chars])
+                line = line[passage_chars:]
+            if size + len(line) > passage_chars and current:
+                passages.append('\n'.join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line) + 1
+        if current:
+            passages.append('\n'.join(current))
+        return passages
+
+    def search(self, query: str, k: int, min_score: float = 0.0) -> List[str]:
+        """
+        Return the `k` highest-scoring passages, in document order.
+
+        :param min_score: minimum BM25 score per content term of the query;
+            passages below it are not relevant enough to send
+        """
+        terms = {term for term in search_terms(query) if is_content_term(term)}
+        if not terms:
+            return []
+        scores = {}
+        k1, b, avg_length, lengths = self.k1, self.b, self.avg_length, self.lengths
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            idf = self.idf[term]
+            for i, tf in postings:
+                norm = k1 * (1 - b + b * lengths[i] / avg_length)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+        threshold = min_score * len(terms)
+        top = heapq.nlargest(k, ((i, score) for i, score in scores.items() if score >= threshold),
+                             key=lambda item: item[1])
+        return [self.passages[i] for i, _ in sorted(top)]
+
+
+class DocumentStore:
+    """
+    The most recently summarized document of each user, kept as a
+    PassageIndex so follow-up questions can be answered from the full
+    extracted text (not just the summary, nor the 45000 characters the
+    summarizer sees). `augment` adds the top-ranked passages for the
+    latest user message to the prompt, if any passage scores at least
+    `min_score` (see PassageIndex.search).
+
+    Documents are truncated to `max_chars`, expire after `ttl` seconds, and
+    at most `max_users` are kept (least recently used are dropped).
+
+    Environment Variables:
+        DOCUMENT_QA
+        DOCUMENT_QA_MAX_CHARS
+        DOCUMENT_QA_PASSAGE_CHARS
+        DOCUMENT_QA_TOP_K
+        DOCUMENT_QA_MAX_USERS
+        DOCUMENT_QA_TTL
+        DOCUMENT_QA_MIN_SCORE
+    """
+
+    def __init__(self, max_chars=500000, passage_chars=800, top_k=4, max_users=500, ttl=3600, min_score=0.2):
+        self.max_chars = max_chars
+        self.passage_chars = passage_chars
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_users = max_users
+        self.ttl = ttl
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'documents_indexed': 0,
+            'searches': 0,
+            'passages_sent': 0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        """:return: None unless DOCUMENT_QA=true"""
+        if os.getenv('DOCUMENT_QA', 'false').lower() != 'true':
+            return None
+        return cls(
+            max_chars=int(os.getenv('DOCUMENT_QA_MAX_CHARS', '500000')),
+            passage_chars=int(os.getenv('DOCUMENT_QA_PASSAGE_CHARS', '800')),
+            top_k=int(os.getenv('DOCUMENT_QA_TOP_K', '4')),
+            max_users=int(os.getenv('DOCUMENT_QA_MAX_USERS', '500')),
+            ttl=float(os.getenv('DOCUMENT_QA_TTL', '3600')),
+            min_score=float(os.getenv('DOCUMENT_QA_MIN_SCORE', '0.2')),
+        )
+
+    def build(self, source: str, chunks: List[str]) -> Union[PassageIndex, None]:
+        text = '\n'.join(chunks)[:self.max_chars]
+        passages = PassageIndex.split(text, self.passage_chars)
+        if not passages:
+            return None
+        with metrics.track('document_index'):
+            index = PassageIndex(source, passages)
+        with self._lock:
+            self._counters['documents_indexed'] += 1
+        return index
+
+    def put(self, user_id: str, index: Union[PassageIndex, None]):
+        with self._lock:
+            # 新的連結取代舊文件；抓不到內文時也不要留著上一份
+            self._documents.pop(user_id, None)
+            if index is None:
+                return
+            self._documents[user_id] = (time.monotonic() + self.ttl, index)
+            while len(self._documents) > self.max_users:
+                self._documents.popitem(last=False)
+
+    def get(self, user_id: str) -> Union[PassageIndex, None]:
+        with self._lock:
+            entry = self._documents.get(user_id)
+            if entry is None:
+                return None
+            expires, index = entry
+            if time.monotonic() >= expires:
+                del self._documents[user_id]
+                return None
+            self._documents.move_to_end(user_id)
+            return index
+
+    def search(self, user_id: str, question: str) -> List[str]:
+        index = self.get(user_id)
+        if index is None or not question.strip():
+            return []
+        with metrics.track('document_search'):
+            passages = index.search(question, self.top_k, self.min_score)
+        with self._lock:
+            self._counters['searches'] += 1
+            self._counters['passages_sent'] += len(passages)
+        return passages
+
+    def augment(self, user_id: str, messages: List[Dict]) -> List[Dict]:
+        """Insert the passages relevant to the last (user) message right before it."""
+        if not messages or messages[-1]['role'] != 'user':
+            return messages
+        passages = self.search(user_id, message_text(messages[-1]['content']))
+        if not passages:
+            return messages
+        index = self.get(user_id)
+        source = index.source if index is not None else ''
+        context = {'role': 'system', 'content': PASSAGES_PREFIX.format(source) + '\n---\n'.join(passages)}
+        return messages[:-1] + [context, messages[-1]]
+
+    def remove(self, user_id: str):
+        with self._lock:
+            self._documents.pop(user_id, None)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'documents': len(self._documents),
+                'chars': sum(index.chars for _, index in self._documents.values()),
+            }
@@ -0,0 +1,38 @@
+import os
+
+from .lazy import LazyModule
+
+httpx = LazyModule('httpx')
+
+_client = None
+
+
+def get_async_client():
+    """
+    Shared httpx.AsyncClient for the async serving path (OpenAI, Jina, scraping).
+
+    One connection pool per process; created on first use inside the running
+    event loop and closed by `aclose_async_client()` on shutdown.
+
+    Environment Variables:
+        ASYNC_HTTP_MAX_CONNECTIONS
+        ASYNC_HTTP_MAX_KEEPALIVE
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(os.getenv('ASYNC_HTTP_MAX_CONNECTIONS', '1000')),
+                max_keepalive_connections=int(os.getenv('ASYNC_HTTP_MAX_KEEPALIVE', '100')),
+            ),
+            # 與 requests 的預設行為一致
+            follow_redirects=True,
+        )
+    return _client
+
+
+async def aclose_async_client():
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
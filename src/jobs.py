@@ -0,0 +1,150 @@
+import os
+import threading
+
+from . import metrics
+from .admission import AdmissionRejected
+from .deadline import Deadline
+from .logger import get_logger
+
+
+logger = get_logger('jobs')
+
+IMAGE_ACCEPTED_MESSAGE = '圖片產生中，完成後會傳送給你'
+IMAGE_QUEUE_FULL_MESSAGE = '目前排隊產生的圖片太多，請稍後再試'
+IMAGE_USER_LIMIT_MESSAGE = '你還有圖片正在產生中，請等完成後再試'
+
+
+def background_jobs_enabled() -> bool:
+    """
+    Whether work may outlive the webhook request: queued image jobs, memory
+    compaction and usage flushes on background threads. Serverless
+    platforms freeze or recycle the instance once the response is sent, so
+    it is off by default on Vercel (which sets VERCEL); the app then does
+    that work inside the request, bounded by its deadline.
+
+    Environment Variables:
+        BACKGROUND_JOBS
+    """
+    default = 'false' if os.getenv('VERCEL') else 'true'
+    return os.getenv('BACKGROUND_JOBS', default).lower() == 'true'
+
+
+class ImageJob:
+    def __init__(self, prompt: str, model):
+        self.prompt = prompt
+        self.model = model
+        # (user_id, push target) of everyone waiting for this image
+        self.recipients = []
+
+
+class ImageJobQueue:
+    """
+    Image generation as queued jobs, so the webhook handler only replies
+    with an acknowledgement and the image is pushed when it is ready.
+
+    Jobs run on the scheduler's `lane`. An identical prompt that is already
+    queued or running is not generated again; the new requester is added to
+    the recipients of that job. The number of pending jobs is bounded
+    overall and per user.
+
+    Environment Variables:
+        IMAGE_JOB_MAX_QUEUE
+        IMAGE_JOB_MAX_PER_USER
+        IMAGE_JOB_TIMEOUT
+    """
+
+    def __init__(self, scheduler, deliver, lane='media', max_queue=32, max_per_user=2, timeout=120.0):
+        """
+        :param scheduler: LaneScheduler the jobs are submitted to
+        :param deliver: deliver(user_id, to, prompt, is_successful, response, error_message),
+            called once per recipient when the job finishes
+        """
+        self.scheduler = scheduler
+        self.deliver = deliver
+        self.lane = lane
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._per_user = {}
+        self._counters = {
+            'submitted': 0,
+            'deduplicated': 0,
+            'queue_full': 0,
+            'user_limit': 0,
+            'completed': 0,
+            'failed': 0,
+            'delivery_failed': 0,
+        }
+
+    @classmethod
+    def from_env(cls, scheduler, deliver, lane='media'):
+        return cls(
+            scheduler, deliver, lane=lane,
+            max_queue=int(os.getenv('IMAGE_JOB_MAX_QUEUE', '32')),
+            max_per_user=int(os.getenv('IMAGE_JOB_MAX_PER_USER', '2')),
+            timeout=float(os.getenv('IMAGE_JOB_TIMEOUT', '120')),
+        )
+
+    @staticmethod
+    def job_key(prompt: str) -> str:
+        return ' '.join(prompt.split()).casefold()
+
+    def submit(self, user_id: str, to: str, prompt: str, model) -> bool:
+        """
+        Queue `prompt` for `user_id`, pushing the result to `to`.
+
+        :return: False if an identical prompt was already pending and this request joined it
+        :raises AdmissionRejected: when the queue or the user's pending jobs are full
+        """
+        key = self.job_key(prompt)
+        with self._lock:
+            if self._per_user.get(user_id, 0) >= self.max_per_user:
+                self._counters['user_limit'] += 1
+                raise AdmissionRejected(IMAGE_USER_LIMIT_MESSAGE)
+            job = self._jobs.get(key)
+            if job is None and len(self._jobs) >= self.max_queue:
+                self._counters['queue_full'] += 1
+                raise AdmissionRejected(IMAGE_QUEUE_FULL_MESSAGE)
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+            if job is not None:
+                job.recipients.append((user_id, to))
+                self._counters['deduplicated'] += 1
+                return False
+            job = self._jobs[key] = ImageJob(prompt, model)
+            job.recipients.append((user_id, to))
+            self._counters['submitted'] += 1
+        self.scheduler.submit(self.lane, self._run, key, job)
+        return True
+
+    def _run(self, key, job):
+        try:
+            with metrics.track('image_job'):
+                is_successful, response, error_message = job.model.image_generations(
+                    job.prompt, deadline=Deadline(self.timeout))
+        except Exception as e:
+            is_successful, response, error_message = False, None, str(e)
+        with self._lock:
+            # 移出後相同的 prompt 會重新產生，recipients 不再增加
+            del self._jobs[key]
+            for user_id, _ in job.recipients:
+                self._per_user[user_id] -= 1
+                if not self._per_user[user_id]:
+                    del self._per_user[user_id]
+            self._counters['completed' if is_successful else 'failed'] += 1
+        for user_id, to in job.recipients:
+            try:
+                self.deliver(user_id, to, job.prompt, is_successful, response, error_message)
+            except Exception:
+                logger.exception('failed to deliver image to %s', to)
+                with self._lock:
+                    self._counters['delivery_failed'] += 1
+
+    def metrics(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'pending': len(self._jobs),
+                'waiting_users': len(self._per_user),
+            }
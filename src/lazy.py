@@ -0,0 +1,27 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    """
+    Module proxy that imports the real module on first attribute access.
+
+    Used for heavy dependencies (LINE messaging SDK, bs4,
+    youtube_transcript_api) so a cold start only pays for what the first
+    request actually needs.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
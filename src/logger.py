@@ -1,8 +1,17 @@
 import os
+import json
+import queue
+import atexit
 import logging
 import logging.handlers
 
 
+LOGGER_NAME = 'chatgpt_logger'
+
+# LogRecord 內建欄位，JSON 輸出時其餘欄位視為 extra 一併輸出
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
 class CustomFormatter(logging.Formatter):
     __LEVEL_COLORS = [
         (logging.DEBUG, '\x1b[40;1m'),
@@ -38,29 +47,104 @@ class CustomFormatter(logging.Formatter):
         return output
 
 
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                payload[key] = value
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc_info'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class FileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, log_file, max_bytes=10 * 1024 * 1024, backup_count=5):
+        log_dir = os.path.dirname(log_file)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        super().__init__(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+
+
+class ConsoleHandler(logging.StreamHandler):
+    pass
+
+
 class LoggerFactory:
+    """
+    Environment Variables:
+        LOG_LEVEL
+        LOG_LEVELS   per-module levels, e.g. `models=DEBUG,website=WARNING`
+        LOG_FORMAT   `text` (colored) or `json`
+        LOG_FILE     enables a size-rotated log file
+        LOG_MAX_BYTES
+        LOG_BACKUP_COUNT
+        LOG_QUEUE_SIZE
+    """
+
     @staticmethod
-    def create_logger(formatter, handlers):
-        logger = logging.getLogger('chatgpt_logger')
-        logger.setLevel(logging.INFO)
+    def create_logger(formatter, handlers, level=logging.INFO, queue_size=10000):
         for handler in handlers:
             handler.setLevel(logging.DEBUG)
             handler.setFormatter(formatter)
-            logger.addHandler(handler)
-        return logger
+        # handler thread 只負責把 record 放進 queue，實際 I/O 由背景的 QueueListener 處理
+        queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+        listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
 
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.setLevel(level)
+        logger.propagate = False
+        logger.addHandler(queue_handler)
+        return logger, listener
 
-class FileHandler(logging.FileHandler):
-    def __init__(self, log_file):
-        os.makedirs(os.path.dirname(log_file), exist_ok=True)
-        super().__init__(log_file)
+    @staticmethod
+    def apply_module_levels(levels: str):
+        for item in levels.split(','):
+            if '=' not in item:
+                continue
+            name, level = item.split('=', 1)
+            logging.getLogger(f'{LOGGER_NAME}.{name.strip()}').setLevel(level.strip().upper())
 
 
-class ConsoleHandler(logging.StreamHandler):
-    pass
+def get_logger(name: str) -> logging.Logger:
+    """Module logger under the shared queue-backed logger, e.g. get_logger('models')."""
+    return logging.getLogger(f'{LOGGER_NAME}.{name}')
 
 
-formatter = CustomFormatter()
-file_handler = FileHandler('./logs')
-console_handler = ConsoleHandler()
-logger = LoggerFactory.create_logger(formatter, [file_handler, console_handler])
+formatter = JsonFormatter() if os.getenv('LOG_FORMAT', 'text').lower() == 'json' else CustomFormatter()
+handlers = [ConsoleHandler()]
+if os.getenv('LOG_FILE'):
+    handlers.append(FileHandler(
+        os.getenv('LOG_FILE'),
+        max_bytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+        backup_count=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+    ))
+logger, listener = LoggerFactory.create_logger(
+    formatter, handlers,
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    queue_size=int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+)
+LoggerFactory.apply_module_levels(os.getenv('LOG_LEVELS', ''))
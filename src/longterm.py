@@ -0,0 +1,324 @@
+import os
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List
+
+from . import metrics
+from .deadline import Deadline
+from .lazy import LazyModule
+from .logger import get_logger
+from .utils import message_text, search_terms
+
+
+logger = get_logger('longterm')
+np = LazyModule('numpy')
+
+RECALL_PREFIX = 'Earlier conversation with this user that may be relevant:\n'
+# 單筆記憶最多保留的字元數，避免一則長回答佔滿 prompt
+MAX_ENTRY_CHARS = 1200
+EMBEDDING_TIMEOUT = 10
+# 檢索之後還要留時間給回答本身，剩餘時間不足時不呼叫遠端 embedding
+RECALL_MIN_BUDGET = 20
+
+
+class HashingEmbedder:
+    """
+    Local, deterministic embedding: words and CJK character uni/bigrams are
+    hashed (CRC32, stable across processes) into `dim` signed buckets and
+    L2-normalized. No model, no network; good enough for keyword-level
+    recall and for tests.
+    """
+
+    remote = False
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def embed(self, texts: List[str], deadline: Deadline = None):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.fromiter((zlib.crc32(f.encode('utf-8')) for f in search_terms(text)), dtype=np.uint32)
+            if not len(hashes):
+                continue
+            # 最低位元決定正負號，其餘決定 bucket
+            signs = np.where(hashes & 1, 1.0, -1.0).astype(np.float32)
+            vectors[row] = np.bincount((hashes >> 1) % self.dim, weights=signs, minlength=self.dim)
+        return _normalize(vectors)
+
+
+class OpenAIEmbedder:
+    """Embeddings from the OpenAI embeddings endpoint, through an OpenAIModel."""
+
+    remote = True
+
+    def __init__(self, model, model_engine='text-embedding-3-small', dim=256, timeout=EMBEDDING_TIMEOUT):
+        self.model = model
+        self.model_engine = model_engine
+        # text-embedding-3 可以直接回傳縮短的向量
+        self.dim = dim
+        self.timeout = timeout
+
+    def embed(self, texts: List[str], deadline: Deadline = None):
+        """:param deadline: the caller's budget; the request is bounded by it as well as by `timeout`"""
+        timeout = self.timeout if deadline is None else deadline.timeout(self.timeout)
+        is_successful, response, error_message = self.model.embeddings(
+            texts, self.model_engine, deadline=Deadline(timeout), dimensions=self.dim)
+        if not is_successful:
+            raise RuntimeError(error_message)
+        data = sorted(response['data'], key=lambda item: item['index'])
+        return _normalize(np.array([item['embedding'] for item in data], dtype=np.float32))
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    """
+    One user's memories: a float32 matrix of unit vectors (one row per
+    entry, oldest first) and the entry texts. Holds at most `max_items`
+    entries; the oldest are dropped first.
+
+    The matrix and the texts are kept as one tuple that `add` replaces as a
+    whole, so a search running on another thread always sees a matching
+    pair without taking a lock.
+    """
+
+    def __init__(self, dim, max_items, vectors=None, texts=None):
+        self.dim = dim
+        self.max_items = max_items
+        vectors = vectors if vectors is not None else np.zeros((0, dim), dtype=np.float32)
+        self._entries = (vectors, list(texts or []))
+
+    @property
+    def vectors(self):
+        return self._entries[0]
+
+    @property
+    def texts(self) -> List[str]:
+        return self._entries[1]
+
+    def __len__(self):
+        return len(self._entries[1])
+
+    def add(self, vectors, texts: List[str]):
+        current_vectors, current_texts = self._entries
+        self._entries = (
+            np.concatenate([current_vectors, vectors.astype(np.float32, copy=False)])[-self.max_items:],
+            (current_texts + list(texts))[-self.max_items:],
+        )
+
+    def search(self, query, k, min_score=0.0):
+        """Return [(score, position, text)] of the `k` most similar entries, best first."""
+        vectors, texts = self._entries
+        if not texts:
+            return []
+        scores = vectors @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(i), texts[i]) for i in top if scores[i] >= min_score]
+
+    def save(self, path):
+        """Write an .npz archive: `vectors` (float16) and `texts` (unicode, no pickle)."""
+        vectors, texts = self._entries
+        # 先寫暫存檔再替換，中斷時不會留下寫了一半的索引
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, vectors=vectors.astype(np.float16), texts=np.array(texts, dtype=str))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, dim, max_items):
+        with np.load(path) as archive:
+            vectors = archive['vectors'].astype(np.float32)
+            texts = archive['texts'].tolist()
+        if vectors.shape[1:] != (dim,) or len(vectors) != len(texts):
+            # 換了 embedding 後舊的索引不能再用
+            logger.warning('discarding long-term memory index %s: dimension changed', path)
+            return cls(dim, max_items)
+        return cls(dim, max_items, vectors[-max_items:], texts[-max_items:])
+
+
+class LongTermMemory:
+    """
+    Per-user long-term memory for the turns that no longer fit in Memory's
+    window. Turns handed to `add` are grouped into user/assistant exchanges,
+    embedded on a background worker and appended to the user's VectorIndex;
+    `recall` embeds the latest user message and returns the top-k most
+    similar exchanges (cosine similarity, one matrix-vector product).
+
+    With a `directory`, each user's index is persisted there after every
+    update and loaded on first use; at most `max_users` indexes are kept in
+    memory (least recently used are dropped, their files remain).
+
+    The query embedding runs on the caller's thread; with the OpenAI backend
+    that is one embeddings request per recall, bounded by the caller's
+    deadline. With a remote embedder, recall is skipped when less than
+    RECALL_MIN_BUDGET seconds remain.
+
+    Environment Variables:
+        LONG_TERM_MEMORY
+        LONG_TERM_MEMORY_EMBEDDING
+        LONG_TERM_MEMORY_EMBEDDING_MODEL
+        LONG_TERM_MEMORY_EMBEDDING_DIM
+        LONG_TERM_MEMORY_DIR
+        LONG_TERM_MEMORY_MAX_ITEMS
+        LONG_TERM_MEMORY_MAX_USERS
+        LONG_TERM_MEMORY_TOP_K
+        LONG_TERM_MEMORY_MIN_SCORE
+    """
+
+    def __init__(self, embedder, directory=None, max_items=500, max_users=1000, top_k=3, min_score=0.2):
+        self.embedder = embedder
+        self.dim = embedder.dim
+        self.directory = directory
+        self.max_items = max_items
+        self.max_users = max_users
+        self.top_k = top_k
+        self.min_score = min_score
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        # 單一 worker，同一使用者的新增依序寫入
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='long-term-memory')
+        self._counters = {
+            'entries_added': 0,
+            'recalls': 0,
+            'recall_hits': 0,
+            'recalls_skipped': 0,
+            'failures': 0,
+        }
+
+    @classmethod
+    def from_env(cls, model=None):
+        """
+        :param model: OpenAIModel for LONG_TERM_MEMORY_EMBEDDING=openai
+        :return: None unless LONG_TERM_MEMORY=true
+        """
+        if os.getenv('LONG_TERM_MEMORY', 'false').lower() != 'true':
+            return None
+        dim = int(os.getenv('LONG_TERM_MEMORY_EMBEDDING_DIM', '256'))
+        if os.getenv('LONG_TERM_MEMORY_EMBEDDING', 'hashing').lower() == 'openai':
+            embedder = OpenAIEmbedder(model, os.getenv('LONG_TERM_MEMORY_EMBEDDING_MODEL') or 'text-embedding-3-small', dim)
+        else:
+            embedder = HashingEmbedder(dim)
+        return cls(
+            embedder,
+            directory=os.getenv('LONG_TERM_MEMORY_DIR') or None,
+            max_items=int(os.getenv('LONG_TERM_MEMORY_MAX_ITEMS', '500')),
+            max_users=int(os.getenv('LONG_TERM_MEMORY_MAX_USERS', '1000')),
+            top_k=int(os.getenv('LONG_TERM_MEMORY_TOP_K', '3')),
+            min_score=float(os.getenv('LONG_TERM_MEMORY_MIN_SCORE', '0.2')),
+        )
+
+    def _path(self, user_id):
+        # user_id 不直接當檔名
+        return os.path.join(self.directory, hashlib.sha1(user_id.encode('utf-8')).hexdigest() + '.npz')
+
+    def _index(self, user_id, create=False):
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None:
+                self._indexes.move_to_end(user_id)
+                return index
+        index = None
+        if self.directory and os.path.exists(self._path(user_id)):
+            index = VectorIndex.load(self._path(user_id), self.dim, self.max_items)
+        elif create:
+            index = VectorIndex(self.dim, self.max_items)
+        if index is None:
+            return None
+        with self._lock:
+            index = self._indexes.setdefault(user_id, index)
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+        return index
+
+    @staticmethod
+    def entries(turns: List[Dict]) -> List[str]:
+        """Group turns into one text per exchange (a user message and the replies after it)."""
+        entries = []
+        for turn in turns:
+            if turn['role'] == 'system':
+                continue
+            line = f"{turn['role']}: {message_text(turn['content'])}"
+            if turn['role'] == 'user' or not entries:
+                entries.append(line)
+            else:
+                entries[-1] += '\n' + line
+        return [entry[:MAX_ENTRY_CHARS] for entry in entries]
+
+    def add(self, user_id: str, turns: List[Dict]):
+        """Index `turns` (dropped from the short-term window) in the background."""
+        texts = self.entries(turns)
+        if texts:
+            return self._executor.submit(self._add, user_id, texts)
+
+    def _add(self, user_id, texts):
+        try:
+            with metrics.track('long_term_memory_add'):
+                vectors = self.embedder.embed(texts)
+                index = self._index(user_id, create=True)
+                index.add(vectors, texts)
+                if self.directory:
+                    index.save(self._path(user_id))
+        except Exception:
+            logger.exception('failed to index long-term memory')
+            with self._lock:
+                self._counters['failures'] += 1
+            return
+        with self._lock:
+            self._counters['entries_added'] += len(texts)
+
+    def recall(self, user_id: str, query: str, deadline: Deadline = None) -> List[str]:
+        """Return up to top_k stored exchanges relevant to `query`, oldest first."""
+        index = self._index(user_id)
+        if index is None or not len(index) or not query.strip():
+            return []
+        if deadline is not None and self.embedder.remote and not deadline.has_budget(RECALL_MIN_BUDGET):
+            with self._lock:
+                self._counters['recalls_skipped'] += 1
+            return []
+        try:
+            with metrics.track('long_term_memory_recall'):
+                query_vector = self.embedder.embed([query], deadline=deadline)[0]
+                hits = index.search(query_vector, self.top_k, self.min_score)
+        except Exception:
+            logger.exception('failed to recall long-term memory')
+            with self._lock:
+                self._counters['failures'] += 1
+            return []
+        with self._lock:
+            self._counters['recalls'] += 1
+            self._counters['recall_hits'] += bool(hits)
+        # 依原本的先後順序放進 prompt
+        return [text for _, _, text in sorted(hits, key=lambda hit: hit[1])]
+
+    def drain(self, timeout=None) -> bool:
+        """Wait for the queued updates; return False if they are still running after `timeout`."""
+        # 單一 worker 依序執行，空工作完成時之前排入的都已完成
+        _, not_done = wait([self._executor.submit(lambda: None)], timeout=timeout)
+        return not not_done
+
+    def remove(self, user_id: str):
+        def _remove():
+            with self._lock:
+                self._indexes.pop(user_id, None)
+            if self.directory and os.path.exists(self._path(user_id)):
+                os.remove(self._path(user_id))
+        # 排在尚未完成的新增之後，避免刪除後又被寫回
+        return self._executor.submit(_remove)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'users_loaded': len(self._indexes),
+                'entries_loaded': sum(len(index) for index in self._indexes.values()),
+            }
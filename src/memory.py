@@ -1,7 +1,30 @@
+import os
+import time
+import threading
 from typing import Dict, List, Union, Any
 from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 
+from . import metrics
+from .deadline import Deadline
+from .longterm import LongTermMemory, RECALL_PREFIX
+from .logger import get_logger
+from .utils import get_role_and_content, message_text
+
+
+logger = get_logger('memory')
+
+SUMMARY_PREFIX = 'Summary of the earlier conversation with this user:\n'
+COMPACTION_PROMPT = (
+    'You maintain the long-term memory of a chat assistant. Merge the previous summary (if any) '
+    'and the conversation below into one compact summary. Keep facts about the user, their '
+    'preferences, decisions, open questions and anything they may refer back to; drop small talk '
+    'and details already answered. Write in the language of the conversation, as short bullet '
+    'points, and output only the summary.'
+)
+
 
 class MemoryInterface:
     def append(self, user_id: str, message: Dict) -> None:
@@ -14,12 +37,172 @@ class MemoryInterface:
         pass
 
 
+class MemoryCompactor:
+    """
+    Folds the older turns of a conversation into a rolling summary with a
+    cheap model. Runs on its own worker threads, outside the reply path.
+
+    Environment Variables:
+        COMPACTION_MODEL_ENGINE
+        MEMORY_COMPACTION_TRIGGER
+        MEMORY_COMPACTION_KEEP_RECENT
+        MEMORY_COMPACTION_TIMEOUT
+        MEMORY_COMPACTION_WORKERS
+    """
+
+    def __init__(self, model, model_engine, trigger_messages=16, keep_recent=8,
+                 timeout=60.0, max_workers=2, max_summary_tokens=1024):
+        """
+        :param trigger_messages: compact once a user has more turns (messages) than this
+        :param keep_recent: most recent messages kept verbatim after compaction
+        """
+        self.model = model
+        self.model_engine = model_engine
+        self.trigger_messages = trigger_messages
+        self.keep_recent = keep_recent
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.max_summary_tokens = max_summary_tokens
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._futures = set()
+        self._counters = {
+            'compactions': 0,
+            'failures': 0,
+            'discarded': 0,
+            'messages_folded': 0,
+            'input_chars': 0,
+            'output_chars': 0,
+        }
+        self._last_latency = 0.0
+
+    @classmethod
+    def from_env(cls, model):
+        return cls(
+            model,
+            os.getenv('COMPACTION_MODEL_ENGINE'),
+            trigger_messages=int(os.getenv('MEMORY_COMPACTION_TRIGGER', '16')),
+            keep_recent=int(os.getenv('MEMORY_COMPACTION_KEEP_RECENT', '8')),
+            timeout=float(os.getenv('MEMORY_COMPACTION_TIMEOUT', '60')),
+            max_workers=int(os.getenv('MEMORY_COMPACTION_WORKERS', '2')),
+        )
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='memory-compaction')
+            self._pending += 1
+            future = self._executor.submit(self._run, fn, *args)
+            self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    def drain(self, timeout=None) -> bool:
+        """Wait for the submitted compactions; return False if some are still running after `timeout`."""
+        with self._lock:
+            futures = list(self._futures)
+        _, not_done = wait(futures, timeout=timeout)
+        return not not_done
+
+    def _run(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception('memory compaction failed')
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def build_messages(self, summary: str, turns: List[Dict]) -> List[Dict]:
+        transcript = '\n'.join(f"{turn['role']}: {message_text(turn['content'])}" for turn in turns)
+        content = f'Previous summary:\n{summary}\n\nConversation:\n{transcript}' if summary else f'Conversation:\n{transcript}'
+        return [
+            {'role': 'system', 'content': COMPACTION_PROMPT},
+            {'role': 'user', 'content': content},
+        ]
+
+    def summarize(self, summary: str, turns: List[Dict]) -> Union[str, None]:
+        """Return the new rolling summary, or None if the model call failed."""
+        messages = self.build_messages(summary, turns)
+        start = time.perf_counter()
+        with metrics.track('memory_compaction'):
+            is_successful, response, error_message = self.model.chat_completions(
+                messages, self.model_engine, deadline=Deadline(self.timeout),
+                max_completion_tokens=self.max_summary_tokens)
+        latency = time.perf_counter() - start
+        if not is_successful:
+            logger.warning(f'memory compaction failed: {error_message}')
+            with self._lock:
+                self._counters['failures'] += 1
+            return None
+        _, content = get_role_and_content(response)
+        with self._lock:
+            self._last_latency = latency
+            self._counters['input_chars'] += len(messages[1]['content'])
+            self._counters['output_chars'] += len(content)
+        return content
+
+    def record(self, folded: int):
+        with self._lock:
+            if folded:
+                self._counters['compactions'] += 1
+                self._counters['messages_folded'] += folded
+            else:
+                self._counters['discarded'] += 1
+
+    def metrics(self):
+        with self._lock:
+            output_chars = self._counters['output_chars']
+            return {
+                **self._counters,
+                'pending': self._pending,
+                # 摘要前後的字元數比，越大代表壓縮越多
+                'compaction_ratio': self._counters['input_chars'] / output_chars if output_chars else 0.0,
+                'last_latency_seconds': self._last_latency,
+            }
+
+
 class Memory(MemoryInterface):
-    def __init__(self, system_message, memory_message_count):
+    """
+    Per-user conversation history.
+
+    Every read and write holds that user's lock, so concurrent handlers
+    (e.g. a multi-event webhook batch) never interleave one user's history.
+    `get` returns a copy; use `lock(user_id)` around read-modify-write
+    sequences that must not be interleaved with other writers. Users share
+    a fixed pool of `lock_stripes` locks (by hash of the user id), so the
+    locks do not grow with the number of users.
+
+    With a `compactor`, once a user's history grows past its trigger the
+    older turns are replaced by a rolling summary message (right after the
+    system message), computed in the background. Turns that changed while
+    the summary was being written are left untouched.
+
+    With a `long_term` memory, turns leaving the window (dropped or folded
+    into the summary) are indexed per user, and `get` adds the stored
+    exchanges most relevant to the latest user message as a system message
+    after the head. `remove` only resets the window; `forget` also deletes
+    the long-term memory.
+    """
+
+    def __init__(self, system_message, memory_message_count, compactor: MemoryCompactor = None,
+                 long_term: LongTermMemory = None, lock_stripes=64):
         self.storage = defaultdict(list)
         self.system_messages = defaultdict(str)
+        self.summaries = {}
         self.default_system_message = system_message
         self.memory_message_count = memory_message_count
+        self.compactor = compactor
+        self.long_term = long_term
+        self._compacting = set()
+        # 同一個 stripe 的使用者共用一把鎖；每個方法只會持有一位使用者的鎖，不會互相等待而死結
+        self._locks = [threading.RLock() for _ in range(lock_stripes)]
+
+    @contextmanager
+    def lock(self, user_id: str):
+        with self._locks[hash(user_id) % len(self._locks)]:
+            yield
 
     def _get_current_time_prefix(self):
         """獲取當前時間前綴"""
@@ -37,34 +220,106 @@ class Memory(MemoryInterface):
             'content': self._get_system_message_with_time(user_id)
         }]
 
+    def _head_size(self, user_id: str) -> int:
+        # system message，以及有摘要時緊接在後的摘要訊息
+        return 2 if user_id in self.summaries else 1
+
     def _drop_message(self, user_id: str):
-        if len(self.storage.get(user_id)) >= (self.memory_message_count + 1) * 2 + 1:
-            self.storage[user_id] = [self.storage[user_id][0]] + self.storage[user_id][-(self.memory_message_count * 2):]
+        head = self._head_size(user_id)
+        if len(self.storage.get(user_id)) >= (self.memory_message_count + 1) * 2 + head:
+            history = self.storage[user_id]
+            keep = len(history) - self.memory_message_count * 2
+            if self.long_term is not None:
+                self.long_term.add(user_id, history[head:keep])
+            self.storage[user_id] = history[:head] + history[keep:]
+
+    def _maybe_compact(self, user_id: str):
+        history = self.storage[user_id]
+        head = self._head_size(user_id)
+        if len(history) - head <= self.compactor.trigger_messages or user_id in self._compacting:
+            return
+        fold = history[head:len(history) - self.compactor.keep_recent]
+        summary = self.summaries.get(user_id)
+        self._compacting.add(user_id)
+        self.compactor.submit(self._compact, user_id, summary, fold)
+
+    def _compact(self, user_id: str, summary, fold: List[Dict]):
+        content = None
+        try:
+            previous = summary['content'][len(SUMMARY_PREFIX):] if summary else ''
+            content = self.compactor.summarize(previous, fold)
+        finally:
+            with self.lock(user_id):
+                self._compacting.discard(user_id)
+                if content is not None:
+                    self._apply_summary(user_id, summary, fold, content)
+
+    def _apply_summary(self, user_id: str, summary, fold: List[Dict], content: str):
+        history = self.storage[user_id]
+        head = self._head_size(user_id)
+        current = history[head:head + len(fold)]
+        # 摘要期間若被清除或截斷，這份摘要已不對應目前的歷史
+        if self.summaries.get(user_id) is not summary or len(current) != len(fold) \
+                or any(a is not b for a, b in zip(current, fold)):
+            self.compactor.record(0)
+            return
+        new_summary = {'role': 'system', 'content': SUMMARY_PREFIX + content}
+        self.storage[user_id] = [history[0], new_summary] + history[head + len(fold):]
+        self.summaries[user_id] = new_summary
+        self.compactor.record(len(fold))
+        if self.long_term is not None:
+            self.long_term.add(user_id, fold)
 
     def change_system_message(self, user_id, system_message):
-        self.system_messages[user_id] = system_message
-        # 如果用戶已經有對話歷史，更新系統訊息
-        if len(self.storage[user_id]) > 0:
-            self.storage[user_id][0]['content'] = self._get_system_message_with_time(user_id)
+        with self.lock(user_id):
+            self.system_messages[user_id] = system_message
+            # 如果用戶已經有對話歷史，更新系統訊息
+            if len(self.storage[user_id]) > 0:
+                self.storage[user_id][0]['content'] = self._get_system_message_with_time(user_id)
         # self.remove(user_id)
    
             
 
     def append(self, user_id: str, role: str, content: Union[str, List[Dict[str, Any]]]) -> None:
-        if len(self.storage[user_id]) == 0:
-            self._initialize(user_id)
-        else:
-            # 在每次 append 時更新系統訊息的時間
-            self.storage[user_id][0]['content'] = self._get_system_message_with_time(user_id)
-        
-        self.storage[user_id].append({
-            'role': role,
-            'content': content
-        })
-        self._drop_message(user_id)
+        with self.lock(user_id):
+            if len(self.storage[user_id]) == 0:
+                self._initialize(user_id)
+            else:
+                # 在每次 append 時更新系統訊息的時間
+                self.storage[user_id][0]['content'] = self._get_system_message_with_time(user_id)
 
-    def get(self, user_id: str) -> List[Dict]:
-        return self.storage[user_id]
+            self.storage[user_id].append({
+                'role': role,
+                'content': content
+            })
+            self._drop_message(user_id)
+            if self.compactor is not None:
+                self._maybe_compact(user_id)
+
+    def get(self, user_id: str, deadline: Deadline = None) -> List[Dict]:
+        """:param deadline: bounds the long-term memory recall; it is skipped when little budget is left"""
+        with self.lock(user_id):
+            history = list(self.storage[user_id])
+            head = self._head_size(user_id)
+        if self.long_term is None:
+            return history
+        # 檢索不持有使用者的鎖
+        query = next((message_text(turn['content']) for turn in reversed(history) if turn['role'] == 'user'), '')
+        recalled = self.long_term.recall(user_id, query, deadline=deadline)
+        if not recalled:
+            return history
+        recall = {'role': 'system', 'content': RECALL_PREFIX + '\n\n'.join(recalled)}
+        return history[:head] + [recall] + history[head:]
 
     def remove(self, user_id: str) -> None:
-        self.storage[user_id] = []
+        """Reset the short-term window (history and summary); long-term memory is kept."""
+        with self.lock(user_id):
+            self.storage[user_id] = []
+            self.summaries.pop(user_id, None)
+
+    def forget(self, user_id: str) -> None:
+        """Reset the window and delete the user's long-term memory."""
+        with self.lock(user_id):
+            self.remove(user_id)
+            if self.long_term is not None:
+                self.long_term.remove(user_id)
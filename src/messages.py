@@ -0,0 +1,15 @@
+HELP_MESSAGE = """指令：
+/註冊 + API Token
+👉 API Token 請先到 https://platform.openai.com/ 註冊登入後取得\n
+/系統訊息 + Prompt
+👉 Prompt 可以命令機器人扮演某個角色，例如：請你扮演擅長做總結的人\n
+忘記
+👉 當前每一次都會紀錄最後兩筆歷史紀錄，這個指令能夠清除歷史訊息\n
+圖像 + Prompt
+👉 會調用 DALL∙E 2 Model，以文字生成圖像\n
+語音輸入
+👉 會調用 Whisper 模型，先將語音轉換成文字，再調用 ChatGPT 以文字回覆\n
+其他文字輸入
+👉 調用 ChatGPT 以文字回覆\n
+貼上連結可以總結
+👉 Youtube 影片內容、新聞文章（支援：聯合報、Yahoo 新聞、三立新聞網、中央通訊社、風傳媒、TVBS、自由時報、ETtoday、中時新聞網、Line 新聞、台視新聞網）"""
@@ -0,0 +1,189 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(state[-2])}')
+            lines.append(f'{self.name}_count{labels} {state[-1]}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, prefix, collect, label=None):
+        """
+        Export the numeric values of a component's metrics() dict as gauges.
+
+        :param prefix: metric name prefix, e.g. `linebot_admission`
+        :param collect: callable returning the metrics dict
+        :param label: if set, collect() returns {label_value: metrics dict}
+        """
+        self._collectors.append((prefix, collect, label))
+
+    @staticmethod
+    def _flatten(values, parent=''):
+        for key, value in values.items():
+            name = f'{parent}_{key}' if parent else str(key)
+            if isinstance(value, dict):
+                yield from MetricsRegistry._flatten(value, name)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield name, value
+
+    def _render_collector(self, prefix, collect, label):
+        groups = collect() if label else {None: collect()}
+        samples = {}
+        for label_value, values in groups.items():
+            for name, value in self._flatten(values):
+                samples.setdefault(name, []).append((label_value, value))
+        lines = []
+        for name, values in samples.items():
+            metric_name = f'{prefix}_{name}'
+            lines.append(f'# TYPE {metric_name} gauge')
+            for label_value, value in values:
+                labels = _format_labels((label,), (label_value,)) if label else ''
+                lines.append(f'{metric_name}{labels} {_format_value(value)}')
+        return lines
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, collect, label in self._collectors:
+            lines.extend(self._render_collector(prefix, collect, label))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+stage_latency = registry.histogram(
+    'linebot_stage_duration_seconds', 'Latency of each processing stage.', ['stage'])
+handler_latency = registry.histogram(
+    'linebot_handler_duration_seconds', 'End-to-end latency of each webhook handler.', ['handler'])
+errors = registry.counter(
+    'linebot_errors_total', 'Errors by processing stage.', ['stage'])
+retries = registry.counter(
+    'linebot_retries_total', 'Retries by processing stage.', ['stage'])
+tokens = registry.counter(
+    'linebot_openai_tokens_total', 'OpenAI tokens used, from the usage block of each response.', ['model', 'kind'])
+
+
+# callables(stage, seconds) notified of every tracked stage, e.g. the request profiler
+stage_listeners = []
+
+
+@contextmanager
+def track(stage):
+    """Time a stage and count it as an error if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        errors.inc(stage=stage)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_latency.observe(duration, stage=stage)
+        for listener in stage_listeners:
+            listener(stage, duration)
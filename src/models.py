@@ -2,7 +2,27 @@ from typing import List, Dict
 import requests
 import os
 import json
-from .utils import get_role_and_content, get_tool_calls
+import time
+import asyncio
+from .utils import get_role_and_content, get_tool_calls, s2t_stream
+from .accounting import task_for
+from .deadline import DeadlineExceeded, DEADLINE_MESSAGE, timeout_for
+from . import metrics
+from .logger import get_logger
+from .http_client import get_async_client, httpx
+from .streaming import SectionSplitter, PARTIAL_ANSWER_NOTICE, DEFAULT_MIN_SECTION_CHARS
+
+logger = get_logger('models')
+
+# 未指定 deadline 時，單次 OpenAI API 呼叫的最長等待秒數
+DEFAULT_REQUEST_TIMEOUT = 120
+# multi-turn tool calling 開始新一輪前，至少需要剩餘的秒數
+TOOL_ROUND_MIN_BUDGET = 15
+# Batch API：24 小時內完成，價格為同步呼叫的一半
+BATCH_ENDPOINT = '/v1/chat/completions'
+BATCH_COMPLETION_WINDOW = '24h'
+BATCH_COST_FACTOR = 0.5
+BATCH_TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
 
 class ModelInterface:
     def check_token_valid(self) -> bool:
@@ -14,36 +34,97 @@ class ModelInterface:
     def audio_transcriptions(self, file, model_engine: str) -> str:
         pass
 
-    def image_generations(self, prompt: str) -> str:
+    def image_generations(self, prompt: str, deadline=None) -> str:
         pass
 
 
 class OpenAIModel(ModelInterface):
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, admission=None, router=None, accounting=None, user_id=None):
+        """
+        :param accounting: UsageAccounting every call is recorded in, and whose quota
+            is checked for `user_id` before each call
+        """
         self.api_key = api_key
-        self.base_url = 'https://api.openai.com/v1'
+        self.admission = admission
+        self.router = router
+        self.accounting = accounting
+        self.user_id = user_id
+        self.base_url = os.getenv('OPENAI_BASE_URL') or 'https://api.openai.com/v1'
         self.available_functions = {
             "search_web": self.search_web,
         }
 
-    def _request(self, method, endpoint, body=None, files=None):
+    def _request(self, method, endpoint, body=None, files=None, deadline=None, task=None):
+        """
+        :return: (is_successful, response, error_message)
+        :raises AdmissionRejected: no slot was free in time, or QuotaExceeded; the call was not sent
+        """
+        start = time.perf_counter()
+        with metrics.track('openai'):
+            try:
+                self._check_quota()
+                if self.admission is None:
+                    result = self._send_request(method, endpoint, body=body, files=files, deadline=deadline)
+                else:
+                    with self.admission.slot(timeout=timeout_for(deadline, None)):
+                        result = self._send_request(method, endpoint, body=body, files=files, deadline=deadline)
+            except DeadlineExceeded as e:
+                result = False, None, str(e)
+        is_successful, response, _ = result
+        if not is_successful:
+            metrics.errors.inc(stage='openai')
+        elif isinstance(response, dict) and response.get('usage'):
+            self._record_usage(response.get('model') or (body or {}).get('model', ''), response['usage'])
+        self._account(task_for(endpoint, task), body, time.perf_counter() - start, result)
+        return result
+
+    @staticmethod
+    def _record_usage(model, usage):
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        completion_tokens = usage.get('completion_tokens') or 0
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        metrics.tokens.inc(prompt_tokens, model=model, kind='prompt')
+        metrics.tokens.inc(completion_tokens, model=model, kind='completion')
+        if cached_tokens:
+            metrics.tokens.inc(cached_tokens, model=model, kind='cached')
+
+    def _check_quota(self):
+        if self.accounting is not None:
+            self.accounting.check(self.user_id)
+
+    def _account(self, task, body, seconds, result):
+        if self.accounting is None:
+            return
+        is_successful, response, _ = result
+        model = (response or {}).get('model') if is_successful and isinstance(response, dict) else None
+        self.accounting.record(
+            self.user_id, model or (body or {}).get('model') or '', task, seconds,
+            usage=(response or {}).get('usage') if is_successful and isinstance(response, dict) else None,
+            is_successful=is_successful)
+
+    def _send_request(self, method, endpoint, body=None, files=None, deadline=None):
         self.headers = {
             'Authorization': f'Bearer {self.api_key}'
         }
+        timeout = timeout_for(deadline, DEFAULT_REQUEST_TIMEOUT)
         try:
             if method == 'GET':
-                r = requests.get(f'{self.base_url}{endpoint}', headers=self.headers)
+                r = requests.get(f'{self.base_url}{endpoint}', headers=self.headers, timeout=timeout)
             elif method == 'POST':
                 if files:
                     # For file uploads, don't set Content-Type (let requests handle it)
-                    r = requests.post(f'{self.base_url}{endpoint}', headers=self.headers, files=files)
+                    r = requests.post(f'{self.base_url}{endpoint}', headers=self.headers, files=files, timeout=timeout)
                 else:
                     # For JSON data
                     self.headers['Content-Type'] = 'application/json'
-                    r = requests.post(f'{self.base_url}{endpoint}', headers=self.headers, json=body)
+                    r = requests.post(f'{self.base_url}{endpoint}', headers=self.headers, json=body, timeout=timeout)
             r = r.json()
             if r.get('error'):
                 return False, None, r.get('error', {}).get('message')
+        except requests.Timeout:
+            if deadline is not None and deadline.expired():
+                return False, None, DEADLINE_MESSAGE
+            return False, None, 'OpenAI API 系統不穩定，請稍後再試'
         except Exception:
             return False, None, 'OpenAI API 系統不穩定，請稍後再試'
         return True, r, None
@@ -51,30 +132,181 @@ class OpenAIModel(ModelInterface):
     def check_token_valid(self):
         return self._request('GET', '/models')
 
-    def chat_completions(self, messages, model_engine, **kwargs) -> str:
+    def chat_completions(self, messages, model_engine, deadline=None, task=None, **kwargs) -> str:
+        """
+        :param task: routing task type (chat, tool, map, reduce); with a router, the
+            route decides the engine, max_completion_tokens, verbosity and fallback
+        """
+        if task is None or self.router is None:
+            return self._request('POST', '/chat/completions', body=self._chat_body(messages, model_engine, **kwargs),
+                                 deadline=deadline, task=task)
+        return self._routed_chat_completions(task, messages, model_engine, deadline, kwargs)
+
+    @staticmethod
+    def _chat_body(messages, model_engine, route=None, **kwargs):
         json_body = {
             'model': model_engine,
             'messages': messages,
             'max_completion_tokens': 4096,
             'verbosity': 'low',
-            **kwargs
         }
-        return self._request('POST', '/chat/completions', body=json_body)
+        if route is not None:
+            json_body['max_completion_tokens'] = route.max_completion_tokens
+            if route.verbosity:
+                json_body['verbosity'] = route.verbosity
+            else:
+                del json_body['verbosity']
+        json_body.update(kwargs)
+        return json_body
+
+    def _routed_chat_completions(self, task, messages, model_engine, deadline, kwargs):
+        route = self.router.route(task)
+        for attempt, engine in enumerate(route.engines(model_engine)):
+            if attempt:
+                logger.warning('route %s: falling back to %s (%s)', task, engine, result[2])
+            start = time.perf_counter()
+            result = self._request('POST', '/chat/completions', body=self._chat_body(messages, engine, route, **kwargs),
+                                   deadline=deadline, task=task)
+            self.router.record(task, engine, time.perf_counter() - start, result, fallback=attempt > 0)
+            if result[0] or not self.router.should_fallback(result[2], deadline):
+                break
+        return result
+
+    def chat_completions_stream(self, messages, model_engine, on_section=None, deadline=None, task=None,
+                                min_section_chars=DEFAULT_MIN_SECTION_CHARS, **kwargs):
+        """
+        Streamed chat completion: SSE deltas are consumed as they arrive and
+        every complete section of the answer is passed to on_section(text).
+
+        Returns (is_successful, response, error_message) like chat_completions,
+        with the whole answer in response. If the deadline cuts the stream,
+        the answer so far ends with PARTIAL_ANSWER_NOTICE and finish_reason
+        is 'deadline'. A route's fallback is not used once output has started.
+        """
+        body = self._stream_body(messages, model_engine, task, kwargs)
+        splitter = SectionSplitter(min_section_chars, convert=s2t_stream())
+        start = time.perf_counter()
+        with metrics.track('openai_stream'):
+            try:
+                self._check_quota()
+                if self.admission is None:
+                    result = self._send_stream_request(body, splitter, on_section, deadline)
+                else:
+                    with self.admission.slot(timeout=timeout_for(deadline, None)):
+                        result = self._send_stream_request(body, splitter, on_section, deadline)
+            except DeadlineExceeded as e:
+                result = False, None, str(e)
+        self._record_stream(task, body, time.perf_counter() - start, result)
+        return result
+
+    def _stream_body(self, messages, model_engine, task, kwargs):
+        route = None
+        if task is not None and self.router is not None:
+            route = self.router.route(task)
+            model_engine = route.engines(model_engine)[0]
+        return self._chat_body(messages, model_engine, route, stream=True,
+                               stream_options={'include_usage': True}, **kwargs)
+
+    def _record_stream(self, task, body, seconds, result):
+        is_successful, response, _ = result
+        if not is_successful:
+            metrics.errors.inc(stage='openai')
+        elif response.get('usage'):
+            self._record_usage(response['model'], response['usage'])
+        if task is not None and self.router is not None:
+            self.router.record(task, body['model'], seconds, result)
+        self._account(task_for('/chat/completions', task), body, seconds, result)
+
+    @staticmethod
+    def _consume_sse_line(line, splitter, state):
+        """Parse one SSE line into `state`; return the completed sections, or None at [DONE]."""
+        if not line or not line.startswith('data:'):
+            return []
+        data = line[5:].strip()
+        if data == '[DONE]':
+            return None
+        chunk = json.loads(data)
+        state['model'] = chunk.get('model') or state['model']
+        if chunk.get('usage'):
+            state['usage'] = chunk['usage']
+        sections = []
+        for choice in chunk.get('choices') or []:
+            state['finish_reason'] = choice.get('finish_reason') or state['finish_reason']
+            content = (choice.get('delta') or {}).get('content')
+            if content:
+                sections.extend(splitter.feed(content))
+        return sections
 
-    def audio_transcriptions(self, file_path, model_engine) -> str:
+    @staticmethod
+    def _stream_result(body, splitter, state):
+        """Return (result, last section) once the stream has ended or been cut."""
+        if state['truncated'] and not splitter.text:
+            return (False, None, DEADLINE_MESSAGE), None
+        last_section = splitter.finish(PARTIAL_ANSWER_NOTICE if state['truncated'] else '')
+        response = {
+            'object': 'chat.completion',
+            'model': state['model'] or body['model'],
+            'usage': state['usage'],
+            'choices': [{
+                'index': 0,
+                'finish_reason': 'deadline' if state['truncated'] else state['finish_reason'],
+                'message': {'role': 'assistant', 'content': splitter.text},
+            }],
+        }
+        return (True, response, None), last_section
+
+    @staticmethod
+    def _new_stream_state():
+        return {'model': None, 'usage': None, 'finish_reason': None, 'truncated': False}
+
+    def _send_stream_request(self, body, splitter, on_section, deadline):
+        headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json',
+        }
+        state = self._new_stream_state()
         try:
-            with open(file_path, 'rb') as audio_file:
-                files = {
-                    'file': audio_file,
-                    'model': (None, model_engine),
-                }
-                return self._request('POST', '/audio/transcriptions', files=files)
+            with requests.post(f'{self.base_url}/chat/completions', headers=headers, json=body,
+                               timeout=timeout_for(deadline, DEFAULT_REQUEST_TIMEOUT), stream=True) as r:
+                if r.status_code != 200:
+                    return False, None, (r.json().get('error') or {}).get('message') or 'OpenAI API 系統不穩定，請稍後再試'
+                # chunk_size=None：收到多少就處理多少，不等湊滿固定大小
+                for line in r.iter_lines(chunk_size=None):
+                    sections = self._consume_sse_line(line.decode('utf-8'), splitter, state)
+                    if sections is None:
+                        break
+                    for section in sections:
+                        if on_section is not None:
+                            on_section(section)
+                    if deadline is not None and deadline.expired():
+                        state['truncated'] = True
+                        break
+        except (requests.RequestException, ValueError) as e:
+            # 已經有部分內容時，回傳目前為止的回答
+            if not splitter.text:
+                if isinstance(e, requests.Timeout) and deadline is not None and deadline.expired():
+                    return False, None, DEADLINE_MESSAGE
+                return False, None, 'OpenAI API 系統不穩定，請稍後再試'
+            state['truncated'] = True
+        result, last_section = self._stream_result(body, splitter, state)
+        if last_section is not None and on_section is not None:
+            on_section(last_section)
+        return result
+
+    def audio_transcriptions(self, file_path, model_engine, deadline=None) -> str:
+        try:
+            content = _read_file(file_path)
         except FileNotFoundError:
             return False, None, f'找不到檔案: {file_path}'
         except Exception as e:
             return False, None, f'讀取音訊檔案時發生錯誤: {str(e)}'
+        files = {
+            'file': (os.path.basename(file_path), content),
+            'model': (None, model_engine),
+        }
+        return self._request('POST', '/audio/transcriptions', files=files, deadline=deadline)
 
-    def image_generations(self, prompt: str) -> str:
+    def image_generations(self, prompt: str, deadline=None) -> str:
         json_body = {
             "model":"dall-e-3",
             "prompt": prompt,
@@ -82,7 +314,126 @@ class OpenAIModel(ModelInterface):
             "size": "1024x1024",
             'quality':"standard"
         }
-        return self._request('POST', '/images/generations', body=json_body)
+        return self._request('POST', '/images/generations', body=json_body, deadline=deadline)
+
+    def embeddings(self, texts, model_engine, deadline=None, **kwargs):
+        json_body = {
+            'model': model_engine,
+            'input': texts,
+            **kwargs,
+        }
+        return self._request('POST', '/embeddings', body=json_body, deadline=deadline)
+
+    def batch_request(self, custom_id, messages, model_engine, task=None, **kwargs):
+        """One line of a Batch API input file: a chat completion routed like chat_completions (without fallback)."""
+        route = None
+        if task is not None and self.router is not None:
+            route = self.router.route(task)
+            model_engine = route.engines(model_engine)[0]
+        return {
+            'custom_id': custom_id,
+            'method': 'POST',
+            'url': BATCH_ENDPOINT,
+            'body': self._chat_body(messages, model_engine, route, **kwargs),
+        }
+
+    def submit_batch(self, batch_requests, metadata=None):
+        """Upload `batch_requests` (from batch_request) as a JSONL file and create a batch over it."""
+        data = ''.join(json.dumps(request, ensure_ascii=False) + '\n' for request in batch_requests).encode('utf-8')
+        files = {
+            'purpose': (None, 'batch'),
+            'file': ('batch.jsonl', data, 'application/jsonl'),
+        }
+        is_successful, response, error_message = self._request('POST', '/files', files=files, task='batch')
+        if not is_successful:
+            return is_successful, response, error_message
+        body = {
+            'input_file_id': response['id'],
+            'endpoint': BATCH_ENDPOINT,
+            'completion_window': BATCH_COMPLETION_WINDOW,
+        }
+        if metadata:
+            body['metadata'] = metadata
+        return self._request('POST', '/batches', body=body, task='batch')
+
+    def retrieve_batch(self, batch_id):
+        return self._request('GET', f'/batches/{batch_id}', task='batch')
+
+    def wait_batch(self, batch_id, poll_interval=30.0, timeout=None):
+        """Poll until the batch reaches a terminal status; return (is_successful, batch, error_message)."""
+        started = time.monotonic()
+        while True:
+            is_successful, batch, error_message = self.retrieve_batch(batch_id)
+            if not is_successful:
+                return is_successful, batch, error_message
+            if batch['status'] in BATCH_TERMINAL_STATUSES:
+                return True, batch, None
+            if timeout is not None and time.monotonic() - started + poll_interval > timeout:
+                return False, batch, f'batch {batch_id} is still {batch["status"]}'
+            time.sleep(poll_interval)
+
+    def _download(self, endpoint):
+        try:
+            r = requests.get(f'{self.base_url}{endpoint}', headers={'Authorization': f'Bearer {self.api_key}'},
+                             timeout=DEFAULT_REQUEST_TIMEOUT)
+            r.raise_for_status()
+        except requests.RequestException:
+            return False, None, 'OpenAI API 系統不穩定，請稍後再試'
+        return True, r.content.decode('utf-8'), None
+
+    def batch_results(self, batch):
+        """
+        Map a finished batch's output and error files back to
+        {custom_id: (is_successful, response, error_message)}. Requests the
+        batch never ran (expired or cancelled) are missing from the result.
+        """
+        results = {}
+        for file_id in (batch.get('output_file_id'), batch.get('error_file_id')):
+            if not file_id:
+                continue
+            is_successful, text, error_message = self._download(f'/files/{file_id}/content')
+            if not is_successful:
+                return is_successful, None, error_message
+            for line in text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get('response') or {}
+                body = response.get('body') or {}
+                if response.get('status_code') == 200:
+                    result = True, body, None
+                else:
+                    error = body.get('error') or item.get('error') or {}
+                    result = False, None, error.get('message') or 'OpenAI API 系統不穩定，請稍後再試'
+                results[item['custom_id']] = result
+                if self.accounting is not None:
+                    self.accounting.record(self.user_id, body.get('model') or '', 'batch', 0.0, usage=body.get('usage'),
+                                           is_successful=result[0], cost_factor=BATCH_COST_FACTOR)
+        return True, results, None
+
+    def run_batch(self, batch_requests, poll_interval=30.0, timeout=None, metadata=None, on_submitted=None):
+        """
+        Submit, wait for and collect one batch. Sync OpenAIModel only.
+
+        :param on_submitted: on_submitted(batch) right after creation, e.g. to checkpoint the batch id
+        :return: (is_successful, {custom_id: (is_successful, response, error_message)}, error_message)
+        """
+        is_successful, batch, error_message = self.submit_batch(batch_requests, metadata=metadata)
+        if not is_successful:
+            return is_successful, None, error_message
+        if on_submitted is not None:
+            on_submitted(batch)
+        return self.collect_batch(batch['id'], poll_interval=poll_interval, timeout=timeout)
+
+    def collect_batch(self, batch_id, poll_interval=30.0, timeout=None):
+        """Wait for an already submitted batch and return its results like run_batch."""
+        is_successful, batch, error_message = self.wait_batch(batch_id, poll_interval=poll_interval, timeout=timeout)
+        if not is_successful:
+            return is_successful, None, error_message
+        if batch['status'] == 'failed':
+            errors = (batch.get('errors') or {}).get('data') or [{}]
+            return False, None, errors[0].get('message') or f'batch {batch_id} failed'
+        return self.batch_results(batch)
     
     def image_recognition(self, image_data: str, model_engine: str = "gpt-4o") -> str:
         json_body = {
@@ -114,7 +465,7 @@ class OpenAIModel(ModelInterface):
 
         return self._request('POST', '/chat/completions', body=json_body)
 
-    def search_web(self, query):
+    def search_web(self, query, deadline=None):
         """Search the web via Jina Search (Bing deprecated).
 
         Reference:
@@ -126,14 +477,37 @@ class OpenAIModel(ModelInterface):
         Normalized return shape: list[{'name': str, 'snippet': str, 'url': str}].
         This matches expectations in chat_with_ext_second_response().
         """
-        jina_key = os.getenv('JINA_API_KEY', '').strip()
-        if not jina_key:
+        request = self._jina_request(query)
+        if request is None:
             return [{
                 'name': query,
                 'snippet': 'Jina API key not found in environment variables',
                 'url': ''
             }]
-            
+        base_url, headers, params = request
+        try:
+            with metrics.track('jina_search'):
+                resp = requests.get(base_url, headers=headers, params=params, timeout=timeout_for(deadline, 20))
+                resp.raise_for_status()
+        except Exception as e:
+            # Return a single synthetic result on failure
+            return [{
+                'name': query,
+                'snippet': f'Jina search failed: {e}',
+                'url': ''
+            }]
+
+        results = self.parse_search_results(query, resp.text)
+        logger.info('Jina search params=%s results_count=%d', params, len(results))
+        return results
+
+    @staticmethod
+    def _jina_request(query):
+        """(url, headers, params) of a Jina Search request, or None without JINA_API_KEY."""
+        jina_key = os.getenv('JINA_API_KEY', '').strip()
+        if not jina_key:
+            return None
+
         # print(f'Jina API Key: {jina_key[:4]}...{jina_key[-4:]}')  # Debugging only, do not log full key
         base_url = "https://s.jina.ai/"
         headers = {
@@ -144,22 +518,14 @@ class OpenAIModel(ModelInterface):
             # Request minimal/no extra content (can remove if full content desired)
             "X-Respond-With": "no-content",
         }
-        params = {"q": query}
-        try:
-            resp = requests.get(base_url, headers=headers, params=params, timeout=20)
-            resp.raise_for_status()
-        except Exception as e:
-            # Return a single synthetic result on failure
-            return [{
-                'name': query,
-                'snippet': f'Jina search failed: {e}',
-                'url': ''
-            }]
+        return base_url, headers, {"q": query}
 
+    def parse_search_results(self, query, text):
+        """Normalize a Jina Search response body into list[{'name', 'snippet', 'url'}]."""
         # Parse documented JSON format first; fallback to plain text
         results = []
         try:
-            data = resp.json()
+            data = json.loads(text)
             candidates = []
             # Primary key in documented response
             if isinstance(data, dict):
@@ -185,22 +551,20 @@ class OpenAIModel(ModelInterface):
                 results.append({'name': title, 'snippet': snippet, 'url': url})
         except ValueError:
             # Non-JSON response fallback
-            text = resp.text.strip()
-            if text:
-                preview_lines = [l for l in text.splitlines() if l.strip()] or [text]
+            stripped = text.strip()
+            if stripped:
+                preview_lines = [l for l in stripped.splitlines() if l.strip()] or [stripped]
                 first = preview_lines[0][:80]
-                snippet = text[:200].replace('\n', ' ')
+                snippet = stripped[:200].replace('\n', ' ')
                 results.append({'name': first, 'snippet': snippet, 'url': ''})
 
         if not results:
             # Final safety fallback
-            body_preview = (resp.text or '')[:200].replace('\n', ' ')
+            body_preview = (text or '')[:200].replace('\n', ' ')
             results = [{'name': query, 'snippet': body_preview, 'url': ''}]
-
-        print(f'Jina search params={params} results_count={len(results)}')
         return results
 
-    def chat_with_ext(self, messages, model_engine, **kwargs):
+    def chat_with_ext(self, messages, model_engine, deadline=None, **kwargs):
         tools = [
             {
                 "type": "function",
@@ -221,55 +585,34 @@ class OpenAIModel(ModelInterface):
             }
         ]
 
-        return self.chat_completions(messages=messages, model_engine=model_engine, tools=tools, tool_choice="auto", parallel_tool_calls=False, **kwargs)
+        return self.chat_completions(messages=messages, model_engine=model_engine, deadline=deadline, task='tool', tools=tools, tool_choice="auto", parallel_tool_calls=False, **kwargs)
 
 
-    def chat_with_ext_second_response(self, messages, response, tool_calls, model_engine):
+    def chat_with_ext_second_response(self, messages, response, tool_calls, model_engine, deadline=None):
         # 建立臨時 messages 副本，確保原始對話不會被意外修改
         updated_messages = list(messages)
 
         response_message = response['choices'][0]['message']
         updated_messages.append(response_message)
 
-        print(f"🔧 Processing {len(tool_calls)} tool call(s):")
+        logger.info('🔧 Processing %d tool call(s):', len(tool_calls))
 
         for i, tool_call in enumerate(tool_calls):
             function_name = tool_call['function']['name']
             function_args = json.loads(tool_call['function']['arguments'])
             query = function_args.get("query", "")
 
-            print(f"   {i+1}. Function: {function_name}")
-            print(f"      Query: {query}")
+            logger.info('   %d. Function: %s', i + 1, function_name)
+            logger.debug('      Query: %s', query)
 
             function_to_call = self.available_functions[function_name]
-            function_response = function_to_call(query=query)
-
-            # 整理查詢結果摘要供模型閱讀
-            search_summary = ""
-            result_count = len(function_response) if function_response else 0
-
-            for result in function_response:
-                search_summary += f"- {result['name']}: {result['snippet']} (URL: {result['url']})\n"
-
-            if not search_summary.strip():
-                search_summary = "（查無相關搜尋結果）"
-
-            print(f"      Results: {result_count} items found")
-            if result_count > 0:
-                print(f"      First result: {function_response[0]['name'][:50]}...")
+            function_response = function_to_call(query=query, deadline=deadline)
 
             # 回傳工具結果給模型
-            updated_messages.append(
-                {
-                    "tool_call_id": tool_call['id'],
-                    "role": "tool",
-                    "name": function_name,
-                    "content": search_summary,
-                }
-            )
+            updated_messages.append(self._tool_message(tool_call, function_name, function_response))
 
-        print(f"📤 Sending final request with {len(updated_messages)} messages")
-        is_successful, final_response, error_message = self.chat_completions(messages=updated_messages, model_engine=model_engine)
+        logger.info('📤 Sending final request with %d messages', len(updated_messages))
+        is_successful, final_response, error_message = self.chat_completions(messages=updated_messages, model_engine=model_engine, deadline=deadline, task='chat')
         if not is_successful:
             return False, None, error_message, updated_messages
 
@@ -279,14 +622,46 @@ class OpenAIModel(ModelInterface):
         return True, final_response, None, updated_messages
 
 
-    def _finalize_with_tool_limit(self, current_messages, model_engine, max_tool_calls):
+    @staticmethod
+    def _tool_message(tool_call, function_name, function_response):
+        # 整理查詢結果摘要供模型閱讀
+        search_summary = ""
+        result_count = len(function_response) if function_response else 0
+
+        for result in function_response:
+            search_summary += f"- {result['name']}: {result['snippet']} (URL: {result['url']})\n"
+
+        if not search_summary.strip():
+            search_summary = "（查無相關搜尋結果）"
+
+        logger.info('      Results: %d items found', result_count)
+        if result_count > 0:
+            logger.debug('      First result: %.50s...', function_response[0]['name'])
+
+        return {
+            "tool_call_id": tool_call['id'],
+            "role": "tool",
+            "name": function_name,
+            "content": search_summary,
+        }
+
+    def _finalize_with_tool_limit(self, current_messages, model_engine, max_tool_calls, deadline=None):
         """Guide the model to answer with existing information once the tool limit is reached."""
+        notice = f"已達到搜尋工具次數上限（{max_tool_calls} 次）。請改用目前掌握的資訊整理回答，並向使用者說明無法再搜尋。"
+        return self._finalize_with_notice(current_messages, model_engine, notice, deadline)
+
+    def _finalize_with_deadline(self, current_messages, model_engine, deadline):
+        """Answer with existing information when there is no time left for another tool round."""
+        notice = "處理時間即將用盡，請不要再使用搜尋工具，改用目前掌握的資訊整理回答。"
+        return self._finalize_with_notice(current_messages, model_engine, notice, deadline)
+
+    def _finalize_with_notice(self, current_messages, model_engine, notice, deadline=None):
         current_messages.append({
             "role": "system",
-            "content": f"已達到搜尋工具次數上限（{max_tool_calls} 次）。請改用目前掌握的資訊整理回答，並向使用者說明無法再搜尋。"
+            "content": notice
         })
 
-        is_successful, response, error_message = self.chat_completions(current_messages, model_engine)
+        is_successful, response, error_message = self.chat_completions(current_messages, model_engine, deadline=deadline, task='chat')
         if not is_successful:
             return False, None, error_message, current_messages
 
@@ -298,7 +673,7 @@ class OpenAIModel(ModelInterface):
 
         return True, {'role': final_role, 'content': final_content}, None, current_messages
 
-    def chat_with_ext_multi_turn(self, messages, model_engine, max_iterations=15, max_tool_calls=10, **kwargs):
+    def chat_with_ext_multi_turn(self, messages, model_engine, max_iterations=15, max_tool_calls=10, deadline=None, **kwargs):
         """
         處理多輪 tool calling，支援 AI 進行多次工具調用直到獲得最終回應
         
@@ -307,45 +682,51 @@ class OpenAIModel(ModelInterface):
             model_engine: 模型引擎名稱
             max_iterations: 最大迭代次數，避免無限循環
             max_tool_calls: 最大工具調用總次數，避免過度使用
+            deadline: 本次事件的 Deadline，剩餘時間不足時不再進行新一輪工具調用
             **kwargs: 其他傳遞給 chat_completions 的參數
             
         Returns:
             tuple: (is_successful, final_response, error_message)
         """
-        print(f"🚀 Starting multi-turn tool calling (max iterations: {max_iterations}, max tool calls: {max_tool_calls})")
+        logger.info('🚀 Starting multi-turn tool calling (max iterations: %d, max tool calls: %d)', max_iterations, max_tool_calls)
         
         iteration_count = 0
         total_tool_calls = 0
         current_messages = list(messages)
         
         while iteration_count < max_iterations:
+            if iteration_count > 0 and deadline is not None and not deadline.has_budget(TOOL_ROUND_MIN_BUDGET):
+                logger.warning('⏱️ Time budget low (%.1fs left). Responding with gathered information.', deadline.remaining())
+                is_successful, result, error_message, _ = self._finalize_with_deadline(current_messages, model_engine, deadline)
+                return is_successful, result, error_message
+
             iteration_count += 1
-            print(f"🔄 Tool calling iteration {iteration_count}/{max_iterations}")
+            logger.info('🔄 Tool calling iteration %d/%d', iteration_count, max_iterations)
             
             # 發送帶有工具的請求
-            is_successful, response, error_message = self.chat_with_ext(current_messages, model_engine, **kwargs)
+            is_successful, response, error_message = self.chat_with_ext(current_messages, model_engine, deadline=deadline, **kwargs)
             if not is_successful:
                 return False, None, error_message
             
             # 檢查是否有工具調用
             tool_calls = get_tool_calls(response)
             if not tool_calls:
-                print(f"✅ No tool calls needed. Completed in {iteration_count} iteration(s)")
+                logger.info('✅ No tool calls needed. Completed in %d iteration(s)', iteration_count)
                 role, response_content = get_role_and_content(response)
                 return True, {'role': role, 'content': response_content}, None
             
             # 檢查工具調用次數限制
             remaining_tool_calls = max_tool_calls - total_tool_calls
             if remaining_tool_calls <= 0:
-                print(f"⚠️ Tool call limit reached ({total_tool_calls}/{max_tool_calls}). Forcing response with existing information.")
-                is_successful, result, error_message, _ = self._finalize_with_tool_limit(current_messages, model_engine, max_tool_calls)
+                logger.warning('⚠️ Tool call limit reached (%d/%d). Forcing response with existing information.', total_tool_calls, max_tool_calls)
+                is_successful, result, error_message, _ = self._finalize_with_tool_limit(current_messages, model_engine, max_tool_calls, deadline)
                 return is_successful, result, error_message
 
             tool_calls_to_process = tool_calls[:remaining_tool_calls]
             limit_reached_this_round = len(tool_calls_to_process) < len(tool_calls)
 
             total_tool_calls += len(tool_calls_to_process)
-            print(f"🔧 Found {len(tool_calls_to_process)} tool call(s) in iteration {iteration_count} (total: {total_tool_calls}/{max_tool_calls}):")
+            logger.info('🔧 Found %d tool call(s) in iteration %d (total: %d/%d):', len(tool_calls_to_process), iteration_count, total_tool_calls, max_tool_calls)
             for i, tool_call in enumerate(tool_calls_to_process):
                 function_name = tool_call.get('function', {}).get('name', 'unknown')
                 function_args = tool_call.get('function', {}).get('arguments', '{}')
@@ -353,45 +734,307 @@ class OpenAIModel(ModelInterface):
                     args_dict = json.loads(function_args)
                     query = args_dict.get('query', '')
                     display_query = query[:50] + '...' if len(query) > 50 else query
-                    print(f"   {i+1}. {function_name}(query='{display_query}')")
+                    logger.info("   %d. %s(query='%s')", i + 1, function_name, display_query)
                 except:
-                    print(f"   {i+1}. {function_name}")
+                    logger.info('   %d. %s', i + 1, function_name)
 
             # 處理工具調用
-            is_successful, response, error_message, updated_messages = self.chat_with_ext_second_response(current_messages, response, tool_calls_to_process, model_engine)
+            is_successful, response, error_message, updated_messages = self.chat_with_ext_second_response(current_messages, response, tool_calls_to_process, model_engine, deadline)
             if not is_successful:
                 return False, None, error_message
 
             current_messages = updated_messages
 
             if limit_reached_this_round or total_tool_calls >= max_tool_calls:
-                print(f"⚠️ Tool call limit reached ({total_tool_calls}/{max_tool_calls}). Responding with gathered information.")
-                is_successful, result, error_message, _ = self._finalize_with_tool_limit(current_messages, model_engine, max_tool_calls)
+                logger.warning('⚠️ Tool call limit reached (%d/%d). Responding with gathered information.', total_tool_calls, max_tool_calls)
+                is_successful, result, error_message, _ = self._finalize_with_tool_limit(current_messages, model_engine, max_tool_calls, deadline)
                 return is_successful, result, error_message
 
-            print(f"📝 Tool call results processed for iteration {iteration_count}")
+            logger.info('📝 Tool call results processed for iteration %d', iteration_count)
 
             # 檢查新的回應是否還包含 tool calls
             new_tool_calls = get_tool_calls(response)
             if not new_tool_calls:
-                print(f"✅ Final response received. Total iterations: {iteration_count}, Total tool calls: {total_tool_calls}")
+                logger.info('✅ Final response received. Total iterations: %d, Total tool calls: %d', iteration_count, total_tool_calls)
                 role, response_content = get_role_and_content(response)
-                print(f"🏁 Tool calling completed. Total iterations: {iteration_count}, Total tool calls: {total_tool_calls}")
+                logger.info('🏁 Tool calling completed. Total iterations: %d, Total tool calls: %d', iteration_count, total_tool_calls)
                 return True, {'role': role, 'content': response_content}, None
             else:
-                print(f"🔄 Response contains {len(new_tool_calls)} more tool call(s), continuing...")
+                logger.info('🔄 Response contains %d more tool call(s), continuing...', len(new_tool_calls))
                 # 更新 current_messages，注意這裡 chat_with_ext_second_response 已經更新了對話
                 # 我們需要重新構建 messages 包含所有的工具調用歷史
                 # 但由於 memory 管理在外部，這裡我們暫時使用原始 messages
                 pass
         
         # 達到最大迭代次數
-        print(f"⚠️ Reached maximum iterations ({max_iterations}). Stopping tool calling.")
+        logger.warning('⚠️ Reached maximum iterations (%d). Stopping tool calling.', max_iterations)
         role, response_content = get_role_and_content(response)
         final_content = f"處理完成（達到最大迭代次數 {max_iterations}）：\n{response_content}"
-        print(f"🏁 Tool calling completed with max iterations. Total iterations: {iteration_count}, Total tool calls: {total_tool_calls}")
+        logger.info('🏁 Tool calling completed with max iterations. Total iterations: %d, Total tool calls: %d', iteration_count, total_tool_calls)
         return True, {'role': role, 'content': final_content}, None
            
 
 
 
+
+
+class AsyncOpenAIModel(OpenAIModel):
+    """
+    OpenAIModel for the async serving path, on the shared httpx.AsyncClient.
+
+    `_request` is a coroutine, so the methods that only build a request body
+    (chat_completions, chat_with_ext, image_generations, ...) are inherited
+    as-is and return awaitables. Methods that post-process results or call
+    tools are overridden with async versions.
+    """
+
+    def __init__(self, api_key: str, admission=None, router=None, accounting=None, user_id=None):
+        super().__init__(api_key, admission, router, accounting, user_id)
+        self.available_functions = {
+            "search_web": self.search_web,
+        }
+
+    async def _check_quota_async(self):
+        if self.accounting is None or self.user_id is None or not self.accounting.has_quota:
+            return
+        # 每位使用者每天第一次檢查要從 store 讀取（也可能等待 flush），不在 event loop 上執行
+        await asyncio.to_thread(self.accounting.check, self.user_id)
+
+    async def _request(self, method, endpoint, body=None, files=None, deadline=None, task=None):
+        start = time.perf_counter()
+        with metrics.track('openai'):
+            try:
+                await self._check_quota_async()
+                if self.admission is None:
+                    result = await self._send_request(method, endpoint, body=body, files=files, deadline=deadline)
+                else:
+                    async with self.admission.async_slot(timeout=timeout_for(deadline, None)):
+                        result = await self._send_request(method, endpoint, body=body, files=files, deadline=deadline)
+            except DeadlineExceeded as e:
+                result = False, None, str(e)
+        is_successful, response, _ = result
+        if not is_successful:
+            metrics.errors.inc(stage='openai')
+        elif isinstance(response, dict) and response.get('usage'):
+            self._record_usage(response.get('model') or (body or {}).get('model', ''), response['usage'])
+        self._account(task_for(endpoint, task), body, time.perf_counter() - start, result)
+        return result
+
+    async def _send_request(self, method, endpoint, body=None, files=None, deadline=None):
+        headers = {
+            'Authorization': f'Bearer {self.api_key}'
+        }
+        timeout = timeout_for(deadline, DEFAULT_REQUEST_TIMEOUT)
+        client = get_async_client()
+        try:
+            if method == 'GET':
+                r = await client.get(f'{self.base_url}{endpoint}', headers=headers, timeout=timeout)
+            elif files:
+                r = await client.post(f'{self.base_url}{endpoint}', headers=headers, files=files, timeout=timeout)
+            else:
+                r = await client.post(f'{self.base_url}{endpoint}', headers=headers, json=body, timeout=timeout)
+            r = r.json()
+            if r.get('error'):
+                return False, None, r.get('error', {}).get('message')
+        except httpx.TimeoutException:
+            if deadline is not None and deadline.expired():
+                return False, None, DEADLINE_MESSAGE
+            return False, None, 'OpenAI API 系統不穩定，請稍後再試'
+        except Exception:
+            return False, None, 'OpenAI API 系統不穩定，請稍後再試'
+        return True, r, None
+
+    async def _routed_chat_completions(self, task, messages, model_engine, deadline, kwargs):
+        route = self.router.route(task)
+        for attempt, engine in enumerate(route.engines(model_engine)):
+            if attempt:
+                logger.warning('route %s: falling back to %s (%s)', task, engine, result[2])
+            start = time.perf_counter()
+            result = await self._request('POST', '/chat/completions', body=self._chat_body(messages, engine, route, **kwargs),
+                                         deadline=deadline, task=task)
+            self.router.record(task, engine, time.perf_counter() - start, result, fallback=attempt > 0)
+            if result[0] or not self.router.should_fallback(result[2], deadline):
+                break
+        return result
+
+    async def chat_completions_stream(self, messages, model_engine, on_section=None, deadline=None, task=None,
+                                      min_section_chars=DEFAULT_MIN_SECTION_CHARS, **kwargs):
+        """Async OpenAIModel.chat_completions_stream; on_section is a coroutine function."""
+        body = self._stream_body(messages, model_engine, task, kwargs)
+        splitter = SectionSplitter(min_section_chars, convert=s2t_stream())
+        start = time.perf_counter()
+        with metrics.track('openai_stream'):
+            try:
+                await self._check_quota_async()
+                if self.admission is None:
+                    result = await self._send_stream_request(body, splitter, on_section, deadline)
+                else:
+                    async with self.admission.async_slot(timeout=timeout_for(deadline, None)):
+                        result = await self._send_stream_request(body, splitter, on_section, deadline)
+            except DeadlineExceeded as e:
+                result = False, None, str(e)
+        self._record_stream(task, body, time.perf_counter() - start, result)
+        return result
+
+    async def _send_stream_request(self, body, splitter, on_section, deadline):
+        headers = {
+            'Authorization': f'Bearer {self.api_key}'
+        }
+        state = self._new_stream_state()
+        try:
+            async with get_async_client().stream(
+                    'POST', f'{self.base_url}/chat/completions', headers=headers, json=body,
+                    timeout=timeout_for(deadline, DEFAULT_REQUEST_TIMEOUT)) as r:
+                if r.status_code != 200:
+                    await r.aread()
+                    return False, None, (r.json().get('error') or {}).get('message') or 'OpenAI API 系統不穩定，請稍後再試'
+                async for line in r.aiter_lines():
+                    sections = self._consume_sse_line(line, splitter, state)
+                    if sections is None:
+                        break
+                    for section in sections:
+                        if on_section is not None:
+                            await on_section(section)
+                    if deadline is not None and deadline.expired():
+                        state['truncated'] = True
+                        break
+        except (httpx.HTTPError, ValueError) as e:
+            if not splitter.text:
+                if isinstance(e, httpx.TimeoutException) and deadline is not None and deadline.expired():
+                    return False, None, DEADLINE_MESSAGE
+                return False, None, 'OpenAI API 系統不穩定，請稍後再試'
+            state['truncated'] = True
+        result, last_section = self._stream_result(body, splitter, state)
+        if last_section is not None and on_section is not None:
+            await on_section(last_section)
+        return result
+
+    async def audio_transcriptions(self, file_path, model_engine, deadline=None):
+        try:
+            content = await asyncio.to_thread(_read_file, file_path)
+        except FileNotFoundError:
+            return False, None, f'找不到檔案: {file_path}'
+        except Exception as e:
+            return False, None, f'讀取音訊檔案時發生錯誤: {str(e)}'
+        files = {
+            'file': (os.path.basename(file_path), content),
+            'model': (None, model_engine),
+        }
+        return await self._request('POST', '/audio/transcriptions', files=files, deadline=deadline)
+
+    async def search_web(self, query, deadline=None):
+        request = self._jina_request(query)
+        if request is None:
+            return [{
+                'name': query,
+                'snippet': 'Jina API key not found in environment variables',
+                'url': ''
+            }]
+        base_url, headers, params = request
+        try:
+            with metrics.track('jina_search'):
+                resp = await get_async_client().get(
+                    base_url, headers=headers, params=params, timeout=timeout_for(deadline, 20))
+                resp.raise_for_status()
+        except Exception as e:
+            return [{
+                'name': query,
+                'snippet': f'Jina search failed: {e}',
+                'url': ''
+            }]
+
+        results = self.parse_search_results(query, resp.text)
+        logger.info('Jina search params=%s results_count=%d', params, len(results))
+        return results
+
+    async def chat_with_ext_second_response(self, messages, response, tool_calls, model_engine, deadline=None):
+        updated_messages = list(messages)
+        updated_messages.append(response['choices'][0]['message'])
+
+        logger.info('🔧 Processing %d tool call(s):', len(tool_calls))
+        # 同一輪的多個 tool call 彼此獨立，可同時執行
+        calls = []
+        for tool_call in tool_calls:
+            function_name = tool_call['function']['name']
+            query = json.loads(tool_call['function']['arguments']).get("query", "")
+            calls.append(self.available_functions[function_name](query=query, deadline=deadline))
+        for tool_call, function_response in zip(tool_calls, await asyncio.gather(*calls)):
+            updated_messages.append(self._tool_message(tool_call, tool_call['function']['name'], function_response))
+
+        logger.info('📤 Sending final request with %d messages', len(updated_messages))
+        is_successful, final_response, error_message = await self.chat_completions(
+            messages=updated_messages, model_engine=model_engine, deadline=deadline, task='chat')
+        if not is_successful:
+            return False, None, error_message, updated_messages
+
+        updated_messages.append(final_response['choices'][0]['message'])
+        return True, final_response, None, updated_messages
+
+    async def _finalize_with_notice(self, current_messages, model_engine, notice, deadline=None):
+        current_messages.append({
+            "role": "system",
+            "content": notice
+        })
+
+        is_successful, response, error_message = await self.chat_completions(current_messages, model_engine, deadline=deadline, task='chat')
+        if not is_successful:
+            return False, None, error_message, current_messages
+
+        final_message = response['choices'][0]['message']
+        current_messages.append(final_message)
+        return True, {'role': final_message.get('role', 'assistant'), 'content': final_message.get('content', '')}, None, current_messages
+
+    async def chat_with_ext_multi_turn(self, messages, model_engine, max_iterations=15, max_tool_calls=10, deadline=None, **kwargs):
+        """Async version of OpenAIModel.chat_with_ext_multi_turn, with the same limits."""
+        iteration_count = 0
+        total_tool_calls = 0
+        current_messages = list(messages)
+
+        while iteration_count < max_iterations:
+            if iteration_count > 0 and deadline is not None and not deadline.has_budget(TOOL_ROUND_MIN_BUDGET):
+                logger.warning('⏱️ Time budget low (%.1fs left). Responding with gathered information.', deadline.remaining())
+                is_successful, result, error_message, _ = await self._finalize_with_deadline(current_messages, model_engine, deadline)
+                return is_successful, result, error_message
+
+            iteration_count += 1
+            is_successful, response, error_message = await self.chat_with_ext(current_messages, model_engine, deadline=deadline, **kwargs)
+            if not is_successful:
+                return False, None, error_message
+
+            tool_calls = get_tool_calls(response)
+            if not tool_calls:
+                role, response_content = get_role_and_content(response)
+                return True, {'role': role, 'content': response_content}, None
+
+            remaining_tool_calls = max_tool_calls - total_tool_calls
+            if remaining_tool_calls <= 0:
+                is_successful, result, error_message, _ = await self._finalize_with_tool_limit(current_messages, model_engine, max_tool_calls, deadline)
+                return is_successful, result, error_message
+
+            tool_calls_to_process = tool_calls[:remaining_tool_calls]
+            limit_reached_this_round = len(tool_calls_to_process) < len(tool_calls)
+            total_tool_calls += len(tool_calls_to_process)
+
+            is_successful, response, error_message, current_messages = await self.chat_with_ext_second_response(
+                current_messages, response, tool_calls_to_process, model_engine, deadline)
+            if not is_successful:
+                return False, None, error_message
+
+            if limit_reached_this_round or total_tool_calls >= max_tool_calls:
+                logger.warning('⚠️ Tool call limit reached (%d/%d). Responding with gathered information.', total_tool_calls, max_tool_calls)
+                is_successful, result, error_message, _ = await self._finalize_with_tool_limit(current_messages, model_engine, max_tool_calls, deadline)
+                return is_successful, result, error_message
+
+            if not get_tool_calls(response):
+                role, response_content = get_role_and_content(response)
+                logger.info('🏁 Tool calling completed. Total iterations: %d, Total tool calls: %d', iteration_count, total_tool_calls)
+                return True, {'role': role, 'content': response_content}, None
+
+        logger.warning('⚠️ Reached maximum iterations (%d). Stopping tool calling.', max_iterations)
+        role, response_content = get_role_and_content(response)
+        return True, {'role': role, 'content': f"處理完成（達到最大迭代次數 {max_iterations}）：\n{response_content}"}, None
+
+
+def _read_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()
@@ -1,21 +1,42 @@
 import os
 
-from pymongo import MongoClient
-
 
 class MongoDB():
     """
     Environment Variables:
         MONGODB__PATH
         MONGODB__DBNAME
+        MONGODB__MAX_POOL_SIZE
+        MONGODB__MIN_POOL_SIZE
+        MONGODB__MAX_IDLE_TIME_MS
+        MONGODB__CONNECT_TIMEOUT_MS
+        MONGODB__SOCKET_TIMEOUT_MS
+        MONGODB__SERVER_SELECTION_TIMEOUT_MS
+        MONGODB__WAIT_QUEUE_TIMEOUT_MS
     """
     client: None
     db: None
 
-    def connect_to_database(self, mongo_path=None, db_name=None):
+    @staticmethod
+    def client_options():
+        # 未設定的項目沿用 pymongo 預設值
+        options = {
+            'maxPoolSize': os.getenv('MONGODB__MAX_POOL_SIZE'),
+            'minPoolSize': os.getenv('MONGODB__MIN_POOL_SIZE'),
+            'maxIdleTimeMS': os.getenv('MONGODB__MAX_IDLE_TIME_MS'),
+            'connectTimeoutMS': os.getenv('MONGODB__CONNECT_TIMEOUT_MS'),
+            'socketTimeoutMS': os.getenv('MONGODB__SOCKET_TIMEOUT_MS'),
+            'serverSelectionTimeoutMS': os.getenv('MONGODB__SERVER_SELECTION_TIMEOUT_MS'),
+            'waitQueueTimeoutMS': os.getenv('MONGODB__WAIT_QUEUE_TIMEOUT_MS'),
+        }
+        return {key: int(value) for key, value in options.items() if value}
+
+    def connect_to_database(self, mongo_path=None, db_name=None, client_class=None):
         mongo_path = mongo_path or os.getenv('MONGODB__PATH')
         db_name = db_name or os.getenv('MONGODB__DBNAME')
-        self.client = MongoClient(mongo_path)
+        if client_class is None:
+            from pymongo import MongoClient as client_class
+        self.client = client_class(mongo_path, **self.client_options())
         assert self.client.config.command('ping')['ok'] == 1.0
         self.db = self.client[db_name]
 
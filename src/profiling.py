@@ -0,0 +1,144 @@
+import io
+import os
+import hmac
+import json
+import time
+import uuid
+import random
+import pstats
+import cProfile
+import threading
+from datetime import datetime
+
+from . import metrics
+
+
+PROFILE_HEADER = 'X-Debug-Profile'
+
+
+class RequestProfiler:
+    """
+    Opt-in per-request profiling.
+
+    A handler run is profiled when it is sampled, when its user is on the
+    allowlist, or when the webhook request carries the `X-Debug-Profile`
+    header matching PROFILE_TOKEN. Each profile is written as a cProfile
+    `.prof` file plus a `.json` summary (wall-clock stage breakdown and the
+    top functions) into a bounded on-disk ring.
+
+    Environment Variables:
+        PROFILE_SAMPLE_RATE
+        PROFILE_USER_ALLOWLIST
+        PROFILE_TOKEN
+        PROFILE_DIR
+        PROFILE_MAX_FILES
+    """
+
+    def __init__(self, sample_rate=0.0, user_allowlist=(), token=None,
+                 directory='/tmp/linebot-profiles', max_files=50):
+        self.sample_rate = sample_rate
+        self.user_allowlist = set(user_allowlist)
+        self.token = token
+        self.directory = directory
+        self.max_files = max_files
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        # cProfile 同一時間只能有一個 profiler 啟用
+        self._profile_lock = threading.Lock()
+        metrics.stage_listeners.append(self._record_stage)
+
+    @classmethod
+    def from_env(cls):
+        allowlist = os.getenv('PROFILE_USER_ALLOWLIST', '')
+        return cls(
+            sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', '0')),
+            user_allowlist=[user_id.strip() for user_id in allowlist.split(',') if user_id.strip()],
+            token=os.getenv('PROFILE_TOKEN') or None,
+            directory=os.getenv('PROFILE_DIR', '/tmp/linebot-profiles'),
+            max_files=int(os.getenv('PROFILE_MAX_FILES', '50')),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sample_rate > 0 or self.user_allowlist or self.token)
+
+    def is_requested(self, headers) -> bool:
+        """True when `headers` carry PROFILE_HEADER matching the token (compared in constant time)."""
+        if self.token is None or headers is None:
+            return False
+        token = headers.get(PROFILE_HEADER)
+        return token is not None and hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8'))
+
+    def should_profile(self, user_id=None, requested=False) -> bool:
+        if requested or user_id in self.user_allowlist:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _record_stage(self, stage, seconds):
+        stages = getattr(self._local, 'stages', None)
+        if stages is not None:
+            stages.append((stage, seconds))
+
+    def wrap(self, fn, name, user_id=None, requested=False):
+        """Return fn, or a wrapper that profiles it when this run is selected."""
+        if not self.enabled or not self.should_profile(user_id, requested):
+            return fn
+
+        def profiled(*args, **kwargs):
+            # 其他 request 正在被 profile 時直接執行，不等待
+            if not self._profile_lock.acquire(blocking=False):
+                return fn(*args, **kwargs)
+            profiler = cProfile.Profile()
+            self._local.stages = []
+            started_at = time.time()
+            start = time.perf_counter()
+            try:
+                return profiler.runcall(fn, *args, **kwargs)
+            finally:
+                wall_time = time.perf_counter() - start
+                stages, self._local.stages = self._local.stages, None
+                self._profile_lock.release()
+                self._save(profiler, name, user_id, started_at, wall_time, stages)
+
+        return profiled
+
+    def _save(self, profiler, name, user_id, started_at, wall_time, stages):
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = f'{datetime.fromtimestamp(started_at).strftime("%Y%m%d-%H%M%S")}-{name}-{uuid.uuid4().hex[:8]}'
+        stats_text = io.StringIO()
+        pstats.Stats(profiler, stream=stats_text).sort_stats('cumulative').print_stats(30)
+        summary = {
+            'id': profile_id,
+            'handler': name,
+            'user_id': user_id,
+            'started_at': started_at,
+            'wall_time': wall_time,
+            'stages': [{'stage': stage, 'seconds': seconds} for stage, seconds in stages],
+            'stats': stats_text.getvalue(),
+        }
+        with self._write_lock:
+            profiler.dump_stats(os.path.join(self.directory, f'{profile_id}.prof'))
+            with open(os.path.join(self.directory, f'{profile_id}.json'), 'w') as f:
+                json.dump(summary, f, ensure_ascii=False)
+            self._trim()
+
+    def _trim(self):
+        summaries = sorted(name for name in os.listdir(self.directory) if name.endswith('.json'))
+        for name in summaries[:max(0, len(summaries) - self.max_files)]:
+            for suffix in ('.json', '.prof'):
+                path = os.path.join(self.directory, name[:-len('.json')] + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def list_profiles(self):
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.directory, name)) as f:
+                summary = json.load(f)
+            summary.pop('stats', None)
+            profiles.append(summary)
+        return profiles
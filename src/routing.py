@@ -0,0 +1,124 @@
+import os
+import threading
+
+from . import metrics
+from .deadline import DEADLINE_MESSAGE
+
+
+# task 類型：
+#   chat    一般對話、vision、工具結果回來後的回答
+#   tool    ext 模式中決定是否呼叫工具的那一輪
+#   map     長字幕逐段摘要
+#   reduce  最後的整合摘要（YouTube 整合 / 單段字幕、網頁摘要）
+TASKS = ('chat', 'tool', 'map', 'reduce')
+
+DEFAULT_MAX_COMPLETION_TOKENS = 4096
+DEFAULT_VERBOSITY = 'low'
+
+route_latency = metrics.registry.histogram(
+    'linebot_route_duration_seconds', 'Latency of each routed chat completion.', ['route', 'model'])
+route_tokens = metrics.registry.counter(
+    'linebot_route_tokens_total', 'OpenAI tokens used per route.', ['route', 'kind'])
+
+
+class Route:
+    def __init__(self, engine=None, max_completion_tokens=DEFAULT_MAX_COMPLETION_TOKENS,
+                 verbosity=DEFAULT_VERBOSITY, fallback_engine=None):
+        """
+        :param engine: model engine; None uses the engine given by the caller
+        :param verbosity: None leaves it out of the request, for models that do not accept it
+        :param fallback_engine: engine retried once when the call fails
+        """
+        self.engine = engine
+        self.max_completion_tokens = max_completion_tokens
+        self.verbosity = verbosity
+        self.fallback_engine = fallback_engine
+
+    def engines(self, default_engine):
+        engine = self.engine or default_engine
+        if self.fallback_engine and self.fallback_engine != engine:
+            return [engine, self.fallback_engine]
+        return [engine]
+
+
+class ModelRouter:
+    """
+    Routing table from task type to model engine, max_completion_tokens and
+    verbosity, so cheap steps (map, tool decisions) do not have to run on
+    the flagship model.
+
+    A failed call is retried once on the route's fallback engine, unless it
+    failed on the deadline, on local admission or on the user's quota, where
+    another model would not help.
+
+    Environment Variables:
+        ROUTE_<TASK>_MODEL
+        ROUTE_<TASK>_MAX_COMPLETION_TOKENS
+        ROUTE_<TASK>_VERBOSITY
+        ROUTE_<TASK>_FALLBACK_MODEL
+        OPENAI_FALLBACK_MODEL_ENGINE
+    """
+
+    def __init__(self, routes: dict = None):
+        self.routes = dict(routes or {})
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @classmethod
+    def from_env(cls):
+        fallback_engine = os.getenv('OPENAI_FALLBACK_MODEL_ENGINE') or None
+        routes = {}
+        for task in TASKS:
+            prefix = f'ROUTE_{task.upper()}'
+            verbosity = os.getenv(f'{prefix}_VERBOSITY', DEFAULT_VERBOSITY)
+            routes[task] = Route(
+                engine=os.getenv(f'{prefix}_MODEL') or None,
+                max_completion_tokens=int(os.getenv(f'{prefix}_MAX_COMPLETION_TOKENS', str(DEFAULT_MAX_COMPLETION_TOKENS))),
+                # 設為空字串或 none 時不送出 verbosity
+                verbosity=None if verbosity.lower() in ('', 'none') else verbosity,
+                fallback_engine=os.getenv(f'{prefix}_FALLBACK_MODEL') or fallback_engine,
+            )
+        return cls(routes)
+
+    def route(self, task: str) -> Route:
+        route = self.routes.get(task)
+        if route is None:
+            route = self.routes[task] = Route()
+        return route
+
+    @staticmethod
+    def should_fallback(error_message, deadline=None) -> bool:
+        # admission / quota 拒絕以 AdmissionRejected 拋出，不會走到這裡
+        if error_message == DEADLINE_MESSAGE:
+            return False
+        return deadline is None or not deadline.expired()
+
+    def record(self, task, engine, seconds, result, fallback=False):
+        is_successful, response, _ = result
+        usage = ((response or {}).get('usage') or {}) if is_successful else {}
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        completion_tokens = usage.get('completion_tokens') or 0
+        route_latency.observe(seconds, route=task, model=engine)
+        route_tokens.inc(prompt_tokens, route=task, kind='prompt')
+        route_tokens.inc(completion_tokens, route=task, kind='completion')
+        with self._lock:
+            stats = self._stats.setdefault(task, {
+                'calls': 0,
+                'failures': 0,
+                'fallbacks': 0,
+                'latency_seconds_total': 0.0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+            })
+            stats['calls'] += 1
+            stats['latency_seconds_total'] += seconds
+            stats['prompt_tokens'] += prompt_tokens
+            stats['completion_tokens'] += completion_tokens
+            if not is_successful:
+                stats['failures'] += 1
+            if fallback:
+                stats['fallbacks'] += 1
+
+    def metrics(self):
+        with self._lock:
+            return {task: dict(stats) for task, stats in self._stats.items()}
@@ -0,0 +1,168 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+class Lane:
+    def __init__(self, name: str, weight: int, max_concurrency: int, sample_size: int = 1024):
+        self.name = name
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.queue = deque()
+        self.running = 0
+        self.current_weight = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_times = deque(maxlen=sample_size)
+        self.run_times = deque(maxlen=sample_size)
+        self.wait_time_total = 0.0
+        self.run_time_total = 0.0
+
+    def is_eligible(self) -> bool:
+        return bool(self.queue) and self.running < self.max_concurrency
+
+
+class LaneScheduler:
+    """
+    Run jobs on a shared worker pool split into priority lanes.
+
+    Each lane has its own concurrency budget so long jobs cannot occupy every
+    worker, and free workers pick the next job by smooth weighted round robin
+    across the lanes that have work and spare budget.
+
+    Environment Variables:
+        SCHEDULER_WORKERS
+        LANE_<NAME>_WEIGHT
+        LANE_<NAME>_CONCURRENCY
+    """
+
+    def __init__(self, lanes: dict, workers: int = None):
+        """
+        :param lanes: {lane_name: (weight, max_concurrency)}
+        :param workers: worker thread 數量，預設為所有 lane 的 concurrency 總和
+        """
+        self.lanes = {
+            name: Lane(name, weight, max_concurrency)
+            for name, (weight, max_concurrency) in lanes.items()
+        }
+        self.workers = workers or sum(lane.max_concurrency for lane in self.lanes.values())
+        self._cond = threading.Condition()
+        self._threads = []
+        self._shutdown = False
+
+    @classmethod
+    def from_env(cls, lanes: dict):
+        configured = {
+            name: (
+                int(os.getenv(f'LANE_{name.upper()}_WEIGHT', weight)),
+                int(os.getenv(f'LANE_{name.upper()}_CONCURRENCY', max_concurrency)),
+            )
+            for name, (weight, max_concurrency) in lanes.items()
+        }
+        workers = os.getenv('SCHEDULER_WORKERS')
+        return cls(configured, workers=int(workers) if workers else None)
+
+    def _start_workers(self):
+        # 第一次提交工作時才啟動 worker，避免 import 時就建立 thread
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'lane-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, lane_name: str, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('scheduler has been shut down')
+            if not self._threads:
+                self._start_workers()
+            self.lanes[lane_name].queue.append((future, fn, args, kwargs, time.monotonic()))
+            self._cond.notify()
+        return future
+
+    def run(self, lane_name: str, fn, *args, **kwargs):
+        """Submit a job and block until it finishes, re-raising its exception."""
+        return self.submit(lane_name, fn, *args, **kwargs).result()
+
+    def _pick_lane(self):
+        eligible = [lane for lane in self.lanes.values() if lane.is_eligible()]
+        if not eligible:
+            return None
+        total_weight = 0
+        for lane in eligible:
+            lane.current_weight += lane.weight
+            total_weight += lane.weight
+        chosen = max(eligible, key=lambda lane: lane.current_weight)
+        chosen.current_weight -= total_weight
+        return chosen
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                lane = self._pick_lane()
+                while lane is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                    lane = self._pick_lane()
+                future, fn, args, kwargs, enqueued_at = lane.queue.popleft()
+                lane.running += 1
+
+            started_at = time.monotonic()
+            failed = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    failed = True
+                    future.set_exception(e)
+            finished_at = time.monotonic()
+
+            with self._cond:
+                lane.running -= 1
+                lane.completed += 1
+                lane.failed += int(failed)
+                lane.wait_times.append(started_at - enqueued_at)
+                lane.run_times.append(finished_at - started_at)
+                lane.wait_time_total += started_at - enqueued_at
+                lane.run_time_total += finished_at - started_at
+                self._cond.notify_all()
+
+    def shutdown(self, wait: bool = True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    @staticmethod
+    def _percentiles(samples) -> dict:
+        samples = sorted(samples)
+        if not samples:
+            return {}
+        return {
+            'p50': samples[len(samples) // 2],
+            'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'max': samples[-1],
+        }
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                name: {
+                    'weight': lane.weight,
+                    'max_concurrency': lane.max_concurrency,
+                    'queued': len(lane.queue),
+                    'running': lane.running,
+                    'completed': lane.completed,
+                    'failed': lane.failed,
+                    'wait_time_seconds_total': lane.wait_time_total,
+                    'run_time_seconds_total': lane.run_time_total,
+                    'wait_time': self._percentiles(lane.wait_times),
+                    'run_time': self._percentiles(lane.run_times),
+                }
+                for name, lane in self.lanes.items()
+            }
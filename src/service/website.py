@@ -1,7 +1,16 @@
 import os
 import re
+import asyncio
 import requests
-from bs4 import BeautifulSoup
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from src.deadline import timeout_for
+from src.lazy import LazyModule
+from src.metrics import track
+from src.logger import get_logger
+from src.http_client import get_async_client
+
+logger = get_logger('website')
+bs4 = LazyModule('bs4')
 
 WEBSITE_SYSTEM_MESSAGE = """
 你是一名專業的資料分析與摘要專家，擅長深入理解文章或網頁內容，快速識別核心主題與關鍵資訊。你具備以下能力：
@@ -31,6 +40,12 @@ WEBSITE_MESSAGE_FORMAT = """
 
 DEFAULT_HEADER={'User-Agent': r'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36 Edg/119.0.0.0',}
 DEFAULT_SELECTOR=('div', {'class': 'content'})
+COMMON_SELECTORS={
+    'default': ('article', {}),
+    'content': ('div', {'class': 'content'}),
+}
+JINA_READER_URL='https://r.jina.ai/'
+TRACKING_QUERY_PARAMS = ('fbclid', 'gclid', 'igshid', 'mibextid', 'ref', 'openExternalBrowser')
 
 class Website:
     def __init__(self) -> None:
@@ -109,70 +124,89 @@ class Website:
         else:
             return None
 
-    def get_soup_from_url(self,url: str,timeout=50,**attrs):
+    def normalize_url(self, url: str):
+        """
+        統一網址格式，讓同一篇文章的不同分享連結可以視為同一個 key
+        （小寫 scheme/host、移除 fragment 與追蹤參數、排序 query）
+        """
+        parts = urlsplit(url.strip())
+        query = sorted(
+            (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not key.startswith('utm_') and key not in TRACKING_QUERY_PARAMS
+        )
+        path = parts.path.rstrip('/') or '/'
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), ''))
+
+    def get_soup_from_url(self,url: str,timeout=50,deadline=None,**attrs):
         
         # headers = ''
-        hotpage = requests.get(url,timeout=timeout, **attrs)
-        soup = BeautifulSoup(hotpage.text, 'html.parser')
-        return soup
+        with track('scrape'):
+            hotpage = requests.get(url,timeout=timeout_for(deadline, timeout), **attrs)
+        return self.parse_html(hotpage.text)
 
+    def parse_html(self, html: str):
+        return bs4.BeautifulSoup(html, 'html.parser')
 
-    def get_content_from_url_user_def(self,url: str):
-        sites_info = self.sites_info
-        for key, info in sites_info.items():
-            if key in url:
-                headers = info.get('headers',DEFAULT_HEADER)
-                tag ,attrs = info.get('selector',DEFAULT_SELECTOR)
-                cookies =  info.get('cookies')
-                soup = self.get_soup_from_url(url,headers=headers,cookies=cookies)
-                chunks = [article.text.strip() for article in soup.find_all(tag, **attrs)]
-                print(f'selectors:{key}')
-                return chunks
+    def select_chunks(self, soup, tag, attrs):
+        return [article.text.strip() for article in soup.find_all(tag, **attrs)]
 
-        return []
 
-    def get_content_from_url_common(self,url: str):
-        selectors={
-            'default': ('article', {}),
-            'content': ('div', {'class': 'content'}),
-        }
+    def find_site_info(self, url: str):
+        for key, info in self.sites_info.items():
+            if key in url:
+                return key, info
+        return None, None
 
-        soup = self.get_soup_from_url(url)    
-        for key, (tag, attrs) in selectors.items():    
-            chunks = [article.text.strip() for article in soup.find_all(tag, **attrs)]
+    def get_content_from_url_user_def(self,url: str,deadline=None):
+        key, info = self.find_site_info(url)
+        if info is None:
+            return []
+        headers = info.get('headers',DEFAULT_HEADER)
+        tag ,attrs = info.get('selector',DEFAULT_SELECTOR)
+        cookies =  info.get('cookies')
+        soup = self.get_soup_from_url(url,deadline=deadline,headers=headers,cookies=cookies)
+        chunks = self.select_chunks(soup, tag, attrs)
+        logger.info('selectors:%s', key)
+        return chunks
+
+    def select_common_chunks(self, soup):
+        for key, (tag, attrs) in COMMON_SELECTORS.items():
+            chunks = self.select_chunks(soup, tag, attrs)
             if chunks:
-                print(f'selectors:{key}')
+                logger.info('selectors:%s', key)
                 return chunks
-            
-        return chunks    
+        return []
+
+    def get_content_from_url_common(self,url: str,deadline=None):
+        soup = self.get_soup_from_url(url,deadline=deadline)    
+        return self.select_common_chunks(soup)
     
-    def get_content_from_url_text(self,url: str):
+    def get_content_from_url_text(self,url: str,deadline=None):
  
-        soup = self.get_soup_from_url(url)    
+        soup = self.get_soup_from_url(url,deadline=deadline)    
         chunks= [soup.text]
 
         return chunks
     
-    def get_content_from_url_text_by_ai(self,url: str):
-        url_jina = 'https://r.jina.ai/'
-        print(f'selectors:jina.ai')
-        soup = self.get_soup_from_url(url_jina+url)    
+    def get_content_from_url_text_by_ai(self,url: str,deadline=None):
+        logger.info('selectors:jina.ai')
+        soup = self.get_soup_from_url(JINA_READER_URL+url,deadline=deadline)    
         chunks= [soup.text]
 
         return chunks        
   
-    def get_content_from_url(self, url: str):
-        chunks = self.get_content_from_url_user_def(url)
+    def get_content_from_url(self, url: str, deadline=None):
+        chunks = self.get_content_from_url_user_def(url, deadline=deadline)
         if chunks:
             return chunks
-        chunks = self.get_content_from_url_common(url)
+        chunks = self.get_content_from_url_common(url, deadline=deadline)
         if chunks:
             return chunks
-        chunks = self.get_content_from_url_text_by_ai(url)
+        chunks = self.get_content_from_url_text_by_ai(url, deadline=deadline)
         if chunks:
             return chunks
         
-        print(f'No support! {url}')
+        logger.warning('No support! %s', url)
         return chunks
 
 
@@ -186,16 +220,61 @@ class WebsiteReader:
         self.text_length_limit = 45000
         self.model_engine = model_engine
 
-    def send_msg(self, msg):
-        return self.model.chat_completions(msg, self.model_engine)
+    def send_msg(self, msg, deadline=None, on_section=None):
+        if on_section is not None:
+            return self.model.chat_completions_stream(
+                msg, self.model_engine, on_section=on_section, deadline=deadline, task='reduce')
+        return self.model.chat_completions(msg, self.model_engine, deadline=deadline, task='reduce')
 
-    def summarize(self, chunks):
+    def build_messages(self, chunks):
         text = '\n'.join(chunks)[:self.text_length_limit]
-        msgs = [{
+        return [{
             "role": "system",
             "content": self.system_message
         }, {
             "role": "user",
             "content": self.message_format.format(text)
         }]
-        return self.send_msg(msgs)
+
+    def summarize(self, chunks, deadline=None, on_section=None):
+        return self.send_msg(self.build_messages(chunks), deadline, on_section=on_section)
+
+
+class AsyncWebsite(Website):
+    """Website whose fetches run on the shared async HTTP client; parsing runs in a worker thread."""
+
+    async def get_soup_from_url(self, url: str, timeout=50, deadline=None, headers=None, cookies=None):
+        if cookies:
+            headers = {**(headers or {}), 'Cookie': '; '.join(f'{key}={value}' for key, value in cookies.items())}
+        with track('scrape'):
+            hotpage = await get_async_client().get(url, timeout=timeout_for(deadline, timeout), headers=headers)
+        # html.parser 解析大型頁面需要數十毫秒，不要卡住 event loop
+        return await asyncio.to_thread(self.parse_html, hotpage.text)
+
+    async def get_content_from_url(self, url: str, deadline=None):
+        key, info = self.find_site_info(url)
+        if info is not None:
+            tag, attrs = info.get('selector', DEFAULT_SELECTOR)
+            soup = await self.get_soup_from_url(
+                url, deadline=deadline, headers=info.get('headers', DEFAULT_HEADER), cookies=info.get('cookies'))
+            chunks = self.select_chunks(soup, tag, attrs)
+            logger.info('selectors:%s', key)
+            if chunks:
+                return chunks
+        chunks = self.select_common_chunks(await self.get_soup_from_url(url, deadline=deadline))
+        if chunks:
+            return chunks
+        logger.info('selectors:jina.ai')
+        chunks = [(await self.get_soup_from_url(JINA_READER_URL + url, deadline=deadline)).text]
+        if chunks:
+            return chunks
+
+        logger.warning('No support! %s', url)
+        return chunks
+
+
+class AsyncWebsiteReader(WebsiteReader):
+    """WebsiteReader for an AsyncOpenAIModel."""
+
+    async def summarize(self, chunks, deadline=None, on_section=None):
+        return await self.send_msg(self.build_messages(chunks), deadline, on_section=on_section)
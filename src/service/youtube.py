@@ -1,16 +1,20 @@
 import math
 import os
+import asyncio
 import re
 import time
 import xml.etree.ElementTree as ET
+import requests
 from src.utils import get_role_and_content
+from src.deadline import timeout_for
+from src.metrics import track, retries
+from src.logger import get_logger
 
-from youtube_transcript_api import (
-    YouTubeTranscriptApi,
-    NoTranscriptFound,
-    TranscriptsDisabled
-)
-from youtube_transcript_api.proxies import GenericProxyConfig
+from src.lazy import LazyModule
+
+logger = get_logger('youtube')
+youtube_transcript_api = LazyModule('youtube_transcript_api')
+youtube_transcript_proxies = LazyModule('youtube_transcript_api.proxies')
 
 YOUTUBE_SYSTEM_MESSAGE = """
 你是一位專業且細心的影片內容分析專家，專門負責從 YouTube 影片的字幕中整理重點、總結核心資訊及細節，具備以下特質：
@@ -28,6 +32,24 @@ WHOLE_MESSAGE_FORMAT = ("下面是每一個部分的小結論：\"\"\"{}\"\"\" \
 SINGLE_MESSAGE_FORMAT = ("下面是一個 Youtube 影片的字幕： \"\"\"{}\"\"\" "
                          "\n\n請總結出這部影片的重點與一些細節，字數約 400 字左右")
 
+FETCH_TIMEOUT = 30
+RETRY_DELAY = 5
+# 逐段摘要時，開始下一段前至少需要剩餘的秒數（需保留最後整合摘要的時間）
+MAP_STEP_MIN_BUDGET = 20
+
+
+class DeadlineSession(requests.Session):
+    """requests.Session whose requests default to a timeout derived from the deadline."""
+
+    def __init__(self, deadline=None):
+        super().__init__()
+        self.deadline = deadline
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = timeout_for(self.deadline, FETCH_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
 
 class Youtube:
     def __init__(self, step=1, retries=None):
@@ -42,7 +64,7 @@ class Youtube:
         self.proxy_url = os.getenv("PROXY_URL")
         self.proxy_config = None
         if self.proxy_url:
-            self.proxy_config = GenericProxyConfig(
+            self.proxy_config = youtube_transcript_proxies.GenericProxyConfig(
                 # http_url=self.proxy_url,
                 https_url=self.proxy_url
             )
@@ -51,10 +73,11 @@ class Youtube:
         preserve_env = os.getenv("PRESERVE_FORMATTING", "false").lower()
         self.preserve_formatting = (preserve_env == "true")
 
-    def get_transcript_chunks(self, video_id):
+    def get_transcript_chunks(self, video_id, deadline=None):
         """
         根據最新的 youtube_transcript_api 使用 fetch() 方法並回傳分段後的字幕。
         :param video_id: YouTube 影片 ID
+        :param deadline: 本次事件的 Deadline，所有請求的 timeout 由剩餘時間決定
         :return: (bool, list_of_chunks, error_msg)
         """
         # 先檢查 video_id 是否有效
@@ -63,24 +86,29 @@ class Youtube:
 
         try:
             # 建立 YouTubeTranscriptApi 實例，包含可選的 proxy_config
-            ytt_api = YouTubeTranscriptApi(
-                proxy_config=self.proxy_config
+            ytt_api = youtube_transcript_api.YouTubeTranscriptApi(
+                proxy_config=self.proxy_config,
+                http_client=DeadlineSession(deadline)
             )
             fetched_transcript = None
             for attempt in range(self.retry_count):
                 try:
                     # 透過 fetch() 取得 FetchedTranscript 物件，再使用 to_raw_data() 取得原始字幕列表
-                    fetched_transcript = ytt_api.fetch(
-                        video_id,
-                        languages=[
-                            'zh-TW', 'zh', 'zh-CN', 'ja', 'zh-Hant', 'zh-Hans', 'en', 'ko'
-                        ],
-                        preserve_formatting=self.preserve_formatting
-                    )
+                    with track('transcript_fetch'):
+                        fetched_transcript = ytt_api.fetch(
+                            video_id,
+                            languages=[
+                                'zh-TW', 'zh', 'zh-CN', 'ja', 'zh-Hant', 'zh-Hans', 'en', 'ko'
+                            ],
+                            preserve_formatting=self.preserve_formatting
+                        )
                     break
                 except ET.ParseError:
-                    if attempt < self.retry_count - 1:
-                        time.sleep(5)
+                    # 剩餘時間不足以等待後重試時，直接放棄
+                    has_budget = deadline is None or deadline.has_budget(RETRY_DELAY + 1)
+                    if attempt < self.retry_count - 1 and has_budget:
+                        retries.inc(stage='transcript_fetch')
+                        time.sleep(RETRY_DELAY)
                         continue
                     else:
                         return False, [], '無法取得字幕，請稍後再試'
@@ -88,25 +116,30 @@ class Youtube:
             if not fetched_transcript:
                 return False, [], '無法取得字幕，請稍後再試'
 
-            raw_data = fetched_transcript.to_raw_data()
+            chunks = self.chunk_transcript(fetched_transcript.to_raw_data())
 
-            # 依據 step 篩選出所需要的字幕
-            text = [t.get('text', '') for i, t in enumerate(raw_data) if i % self.step == 0]
-            # 再將結果按照 chunk_size 切割成多個區塊
-            chunks = [
-                '\n'.join(text[i * self.chunk_size : (i + 1) * self.chunk_size])
-                for i in range(math.ceil(len(text) / self.chunk_size))
-            ]
-
-        except NoTranscriptFound:
+        except youtube_transcript_api.NoTranscriptFound:
             return False, [], '目前只支援：中文、英文、日文、韓文'
-        except TranscriptsDisabled:
+        except youtube_transcript_api.TranscriptsDisabled:
             return False, [], '本影片無開啟字幕功能'
         except Exception as e:
             return False, [], str(e)
 
         return True, chunks, None
 
+    def chunk_transcript(self, raw_data):
+        """
+        將原始字幕列表依 step 篩選後，按照 chunk_size 切割成多個區塊
+        :param raw_data: [{'text': ..., 'start': ..., 'duration': ...}, ...]
+        """
+        # 依據 step 篩選出所需要的字幕
+        text = [t.get('text', '') for i, t in enumerate(raw_data) if i % self.step == 0]
+        # 再將結果按照 chunk_size 切割成多個區塊
+        return [
+            '\n'.join(text[i * self.chunk_size : (i + 1) * self.chunk_size])
+            for i in range(math.ceil(len(text) / self.chunk_size))
+        ]
+
     def retrieve_video_id(self, url):
         """
         從網址中抓取影片 ID
@@ -136,66 +169,117 @@ class YoutubeTranscriptReader:
         self.model = model
         self.model_engine = model_engine
 
-    def send_msg(self, msg):
+    def send_msg(self, msg, deadline=None, task='reduce', on_section=None):
         """
         透過 self.model.chat_completions 對話模型進行問答。
         msg: [{"role": "system", "content": ...}, {"role": "user", "content": ...}]
+        task: 'map'（逐段摘要）或 'reduce'（整合摘要），決定使用的模型路由
+        on_section: 若有提供，改用串流，每完成一段回答就呼叫一次
         """
-        return self.model.chat_completions(msg, self.model_engine)
+        if on_section is not None:
+            return self.model.chat_completions_stream(
+                msg, self.model_engine, on_section=on_section, deadline=deadline, task=task)
+        return self.model.chat_completions(msg, self.model_engine, deadline=deadline, task=task)
+
+    def build_part_messages(self, index, chunk):
+        return [
+            {
+                "role": "system",
+                "content": self.summary_system_prompt
+            },
+            {
+                "role": "user",
+                "content": self.part_message_format.format(index, chunk, index)
+            }
+        ]
 
-    def summarize(self, chunks):
+    def build_whole_messages(self, summaries):
+        # 將多段摘要結果合併為一個字串
+        merged_text = '\n'.join(summaries)
+        return [
+            {
+                'role': 'system',
+                'content': self.summary_system_prompt
+            },
+            {
+                'role': 'user',
+                'content': self.whole_message_format.format(merged_text)
+            }
+        ]
+
+    def build_single_messages(self, chunks):
+        text = chunks[0] if chunks else ''
+        return [
+            {
+                'role': 'system',
+                'content': self.summary_system_prompt
+            },
+            {
+                'role': 'user',
+                'content': self.single_message_format.format(text)
+            }
+        ]
+
+    def summarize(self, chunks, deadline=None, on_section=None):
         """
         對多個 chunk 的字幕進行分段摘要，最後再整合成總結。
         :param chunks: list of subtitle chunks
+        :param deadline: 本次事件的 Deadline，剩餘時間不足時略過後面的段落，只整合已完成的小結
+        :param on_section: 串流最後的整合摘要，每完成一段就呼叫一次
         :return: 回傳最終的摘要結果
         """
         summary_msg = []
-        print(f'chunks size: {len(chunks)}')
+        logger.info('chunks size: %d', len(chunks))
 
         if len(chunks) > 1:
             # 有多個 chunk，需要逐段摘要，最後合併
             for i, chunk in enumerate(chunks):
-                msgs = [
-                    {
-                        "role": "system",
-                        "content": self.summary_system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": self.part_message_format.format(i, chunk, i)
-                    }
-                ]
-                _, response, _ = self.send_msg(msgs)
+                if summary_msg and deadline is not None and not deadline.has_budget(MAP_STEP_MIN_BUDGET):
+                    logger.warning('deadline: skip %d remaining chunk(s)', len(chunks) - i)
+                    break
+                is_successful, response, error_message = self.send_msg(self.build_part_messages(i, chunk), deadline, task='map')
+                if not is_successful:
+                    return False, None, error_message
                 _, content = get_role_and_content(response)
                 summary_msg.append(content)
 
-            # 將多段摘要結果合併為一個字串
-            merged_text = '\n'.join(summary_msg)
-
             # 再針對所有小結進行最終的整合摘要
-            msgs = [
-                {
-                    'role': 'system',
-                    'content': self.summary_system_prompt
-                },
-                {
-                    'role': 'user',
-                    'content': self.whole_message_format.format(merged_text)
-                }
-            ]
-            return self.send_msg(msgs)
+            return self.send_msg(self.build_whole_messages(summary_msg), deadline, on_section=on_section)
 
         else:
             # 只有一段字幕
-            text = chunks[0] if chunks else ''
-            msgs = [
-                {
-                    'role': 'system',
-                    'content': self.summary_system_prompt
-                },
-                {
-                    'role': 'user',
-                    'content': self.single_message_format.format(text)
-                }
-            ]
-            return self.send_msg(msgs)
+            return self.send_msg(self.build_single_messages(chunks), deadline, on_section=on_section)
+
+
+class AsyncYoutubeTranscriptReader(YoutubeTranscriptReader):
+    """YoutubeTranscriptReader for an AsyncOpenAIModel; the per-chunk summaries run concurrently."""
+
+    async def summarize(self, chunks, deadline=None, on_section=None):
+        logger.info('chunks size: %d', len(chunks))
+        if len(chunks) <= 1:
+            return await self.send_msg(self.build_single_messages(chunks), deadline, on_section=on_section)
+
+        tasks = [
+            asyncio.ensure_future(self.send_msg(self.build_part_messages(i, chunk), deadline, task='map'))
+            for i, chunk in enumerate(chunks)
+        ]
+        timeout = None if deadline is None else max(0.0, deadline.remaining() - MAP_STEP_MIN_BUDGET)
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if not done:
+            # 至少等到一段完成，才有東西可以整合
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if pending:
+            logger.warning('deadline: skip %d remaining chunk(s)', len(pending))
+            for task in pending:
+                task.cancel()
+
+        summary_msg = []
+        for task in tasks:
+            if task not in done:
+                continue
+            is_successful, response, error_message = task.result()
+            if not is_successful:
+                return False, None, error_message
+            _, content = get_role_and_content(response)
+            summary_msg.append(content)
+        return await self.send_msg(self.build_whole_messages(summary_msg), deadline, on_section=on_section)
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key.
+
+    The first caller for a key runs the work; callers that arrive while it is
+    still in flight wait on the same future and get its result or exception.
+    Nothing is cached once the call finishes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {
+            'executed': 0,
+            'coalesced': 0,
+            'failed': 0,
+        }
+
+    def do(self, key, fn, *args, timeout=None, **kwargs):
+        """
+        :param timeout: 最長等待其他請求結果的秒數，逾時會丟出 TimeoutError
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+                self._counters['executed'] += 1
+            else:
+                self._counters['coalesced'] += 1
+
+        if not is_leader:
+            return future.result(timeout=timeout)
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                self._counters['failed'] += 1
+                self._calls.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._calls.pop(key, None)
+        future.set_result(result)
+        return result
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                **self._counters,
+            }
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop."""
+
+    def __init__(self):
+        self._calls = {}
+        self._counters = {
+            'executed': 0,
+            'coalesced': 0,
+            'failed': 0,
+        }
+
+    async def do(self, key, fn, *args, timeout=None, **kwargs):
+        """
+        :param fn: coroutine function
+        :param timeout: 最長等待其他請求結果的秒數，逾時會丟出 TimeoutError
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self._counters['coalesced'] += 1
+            # shield：等待者逾時或被取消時不影響正在執行的那一份
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+
+        self._counters['executed'] += 1
+        task = asyncio.ensure_future(fn(*args, **kwargs))
+        self._calls[key] = task
+        try:
+            return await task
+        except BaseException:
+            self._counters['failed'] += 1
+            raise
+        finally:
+            self._calls.pop(key, None)
+
+    def metrics(self) -> dict:
+        return {
+            'in_flight': len(self._calls),
+            **self._counters,
+        }
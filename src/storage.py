@@ -1,47 +1,284 @@
+import os
 import json
+import time
+import atexit
 import datetime
+import threading
+from collections import OrderedDict
+
+from .logger import get_logger
+
+
+logger = get_logger('storage')
 
 
 class FileStorage:
-    def __init__(self, file_name):
-        self.fine_name = file_name
+    """
+    Append-only journal of `key -> value`, one JSON line per update.
+
+    Each save() appends `["set", key, value]` lines, so its cost does not
+    grow with the number of users, and a crash can at worst tear the last
+    line, which load() truncates. A corrupt line elsewhere is skipped (and
+    logged), never truncated, and disappears at the next compaction. load() replays the journal into the in-memory
+    index. Once the journal holds `compact_ratio` times more lines than live
+    keys (and at least `compact_min_records`), it is rewritten to a temp
+    file, fsynced and atomically renamed over the old one.
+
+    A legacy whole-file JSON object is read as well and rewritten in the
+    journal format on load.
+    """
+
+    def __init__(self, file_name, compact_ratio=4.0, compact_min_records=1000, fsync=True):
+        self.file_name = file_name
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.fsync = fsync
         self.history = {}
+        self._records = 0
+        self._loaded = False
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.file_name, 'a', encoding='utf-8', newline='')
+        return self._file
+
+    def _write(self, f, lines):
+        f.write(lines)
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
 
     def save(self, data):
-        self.history.update(data)
-        with open(self.fine_name, 'w', newline='') as f:
-            json.dump(self.history, f)
+        lines = ''.join(json.dumps(['set', key, value], ensure_ascii=False) + '\n' for key, value in data.items())
+        with self._lock:
+            if not self._loaded:
+                # 先重播既有的 journal（並轉換舊格式），才能安全地 append
+                self._load()
+            self.history.update(data)
+            self._write(self._open(), lines)
+            self._records += len(data)
+            if self._records >= self.compact_min_records and self._records > self.compact_ratio * len(self.history):
+                self._compact()
 
     def load(self):
-        with open(self.fine_name, newline='') as jsonfile:
-            data = json.load(jsonfile)
-        self.history = data
+        with self._lock:
+            return self._load()
+
+    def get(self, key):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return self.history.get(key)
+
+    def _load(self):
+        self.history, self._records = self._replay()
+        self._loaded = True
         return self.history
 
+    def _replay(self):
+        if not os.path.exists(self.file_name):
+            return {}, 0
+        with open(self.file_name, 'rb') as f:
+            raw = f.read()
+
+        if raw.lstrip().startswith(b'{'):
+            # 舊版格式：整個檔案是一個 JSON object
+            history = json.loads(raw)
+            self._compact_to(history)
+            return history, len(history)
+
+        history = {}
+        records = 0
+        lines = raw.splitlines(keepends=True)
+        if lines and not lines[-1].endswith(b'\n'):
+            # 只有最後一行、且沒有換行結尾，才是寫到一半當機留下的殘缺紀錄；截掉後才能繼續 append
+            torn = lines.pop()
+            logger.warning('dropping torn last record of %s (%d bytes)', self.file_name, len(torn))
+            with open(self.file_name, 'r+b') as f:
+                f.truncate(len(raw) - len(torn))
+        for number, line in enumerate(lines, 1):
+            records += 1
+            try:
+                op, key, value = json.loads(line)
+            except ValueError:
+                # 中間的壞紀錄不能截斷，否則後面所有使用者的資料都會消失；略過，下次 compact 時清掉
+                logger.error('skipping corrupt record at %s line %d', self.file_name, number)
+                continue
+            if op == 'set':
+                history[key] = value
+        return history, records
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        self._compact_to(self.history)
+        self._records = len(self.history)
+
+    def _compact_to(self, history):
+        tmp_name = f'{self.file_name}.tmp'
+        with open(tmp_name, 'w', encoding='utf-8', newline='') as f:
+            f.write(''.join(json.dumps(['set', key, value], ensure_ascii=False) + '\n' for key, value in history.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.replace(tmp_name, self.file_name)
+        # rename 本身也要落盤
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.file_name)), os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
 
 class MongoStorage:
-    def __init__(self, db):
-        self.db = db
+    """
+    `user_id -> api_key` in the `api_key` collection, with a unique index on
+    user_id.
+
+    - get(): per-user lookup through a read-through LRU cache, so a request
+      never needs the whole collection in memory.
+    - save(): upserts are buffered and written with one unordered
+      bulk_write once `batch_size` users are pending, or once the oldest
+      pending upsert is `max_delay` seconds old (batch_size=1 writes
+      through on every save). flush() writes what is pending; it also runs
+      at interpreter exit.
+    - load(): full scan, kept for callers that still want the whole dict.
+
+    Batching is unsafe on serverless platforms (Vercel): a frozen or
+    recycled instance neither reaches the next save nor runs atexit, so
+    keep batch_size=1 there.
+
+    Environment Variables:
+        MONGODB__STORAGE_CACHE_SIZE
+        MONGODB__STORAGE_BATCH_SIZE
+        MONGODB__STORAGE_MAX_DELAY
+    """
+
+    def __init__(self, db, collection='api_key', cache_size=10000, batch_size=1, max_delay=5.0):
+        self.collection = db[collection]
+        self.collection.create_index('user_id', unique=True)
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._cache = OrderedDict()
+        self._pending = {}
+        # 最舊一筆 pending 的時間（time.monotonic）
+        self._pending_since = None
+        self._lock = threading.Lock()
+        self._counters = {
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'bulk_writes': 0,
+            'written': 0,
+        }
+        if batch_size > 1:
+            # 結束前寫入還在 pending 的 API key
+            atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls, db):
+        return cls(
+            db,
+            cache_size=int(os.getenv('MONGODB__STORAGE_CACHE_SIZE', '10000')),
+            batch_size=int(os.getenv('MONGODB__STORAGE_BATCH_SIZE', '1')),
+            max_delay=float(os.getenv('MONGODB__STORAGE_MAX_DELAY', '5')),
+        )
+
+    def _cache_put(self, user_id, api_key):
+        self._cache[user_id] = api_key
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, user_id):
+        with self._lock:
+            if user_id in self._pending:
+                return self._pending[user_id][0]
+            if user_id in self._cache:
+                self._cache.move_to_end(user_id)
+                self._counters['cache_hits'] += 1
+                return self._cache[user_id]
+            self._counters['cache_misses'] += 1
+        doc = self.collection.find_one({'user_id': user_id}, {'_id': 0, 'api_key': 1})
+        api_key = doc['api_key'] if doc else None
+        with self._lock:
+            # 查詢期間若有新的 save，以 save 的值為準
+            if user_id not in self._pending and user_id not in self._cache:
+                self._cache_put(user_id, api_key)
+        return api_key
 
     def save(self, data):
-        user_id, api_key = list(data.items())[0]
-        self.db['api_key'].update_one({
-            'user_id': user_id
-        }, {
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            for user_id, api_key in data.items():
+                self._pending[user_id] = (api_key, now)
+                self._cache_put(user_id, api_key)
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+            if len(self._pending) < self.batch_size and time.monotonic() - self._pending_since < self.max_delay:
+                return
+        self.flush()
+
+    def flush(self):
+        from pymongo import UpdateOne
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            pending_since, self._pending_since = self._pending_since, None
+        if not pending:
+            return
+        requests = [UpdateOne({'user_id': user_id}, {
             '$set': {
                 'user_id': user_id,
                 'api_key': api_key,
-                'created_at': datetime.datetime.utcnow()
+                'created_at': created_at
             }
-        }, upsert=True)
+        }, upsert=True) for user_id, (api_key, created_at) in pending.items()]
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception:
+            with self._lock:
+                # 寫入失敗時放回 pending（較新的 save 優先），下次 flush 再試
+                for user_id, value in pending.items():
+                    self._pending.setdefault(user_id, value)
+                if self._pending_since is None or pending_since < self._pending_since:
+                    self._pending_since = pending_since
+            raise
+        with self._lock:
+            self._counters['bulk_writes'] += 1
+            self._counters['written'] += len(requests)
 
     def load(self):
-        data = list(self.db['api_key'].find())
-        res = {}
-        for i in range(len(data)):
-            res[data[i]['user_id']] = data[i]['api_key']
+        self.flush()
+        res = {doc['user_id']: doc['api_key'] for doc in self.collection.find({}, {'_id': 0, 'user_id': 1, 'api_key': 1})}
+        with self._lock:
+            for user_id, api_key in list(res.items())[-self.cache_size:]:
+                self._cache_put(user_id, api_key)
         return res
 
+    def close(self):
+        self.flush()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'cached': len(self._cache),
+                'pending': len(self._pending),
+            }
+
 
 class Storage:
     def __init__(self, storage):
@@ -52,3 +289,6 @@ class Storage:
 
     def load(self):
         return self.storage.load()
+
+    def get(self, key):
+        return self.storage.get(key)
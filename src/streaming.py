@@ -0,0 +1,84 @@
+import os
+
+
+PARTIAL_ANSWER_NOTICE = '\n\n（處理時間已到，以上為目前的部分回答）'
+# LINE 文字訊息上限為 5000 字，保留空間給部分回答的提示
+MAX_SECTION_CHARS = 4800
+DEFAULT_MIN_SECTION_CHARS = int(os.getenv('STREAM_MIN_SECTION_CHARS', '600'))
+
+
+class SectionSplitter:
+    """
+    Collects a streamed answer and cuts it into sections as it arrives.
+
+    A section ends at the first paragraph break once it holds at least
+    `min_chars`, or at the last line break / space before `max_chars` so
+    every section fits in one LINE text message.
+
+    With `convert` (an incremental converter such as utils.s2t_stream()),
+    sections are converted as they are cut; `text` stays the raw answer.
+    """
+
+    def __init__(self, min_chars=DEFAULT_MIN_SECTION_CHARS, max_chars=MAX_SECTION_CHARS, convert=None):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.convert = convert
+        self._chunks = []
+        self._buffer = ''
+
+    @property
+    def text(self) -> str:
+        return ''.join(self._chunks)
+
+    def feed(self, delta: str) -> list:
+        """Add a delta and return the sections it completed."""
+        self._chunks.append(delta)
+        self._buffer += self.convert.feed(delta) if self.convert is not None else delta
+        sections = []
+        cut = self._find_cut()
+        while cut is not None:
+            section = self._buffer[:cut].strip()
+            self._buffer = self._buffer[cut:]
+            if section:
+                sections.append(section)
+            cut = self._find_cut()
+        return sections
+
+    def _find_cut(self):
+        if len(self._buffer) > self.max_chars:
+            window = self._buffer[:self.max_chars]
+            cut = max(window.rfind('\n'), window.rfind(' '))
+            return cut if cut > 0 else self.max_chars
+        cut = self._buffer.find('\n\n', self.min_chars)
+        return cut if cut != -1 else None
+
+    def finish(self, suffix: str = ''):
+        """Return the last section (with `suffix` appended), or None if nothing is left."""
+        if self.convert is not None:
+            self._buffer += self.convert.flush()
+        if suffix:
+            self._chunks.append(suffix)
+            self._buffer += suffix
+        section = self._buffer.strip()
+        self._buffer = ''
+        return section or None
+
+
+class ProgressiveDelivery:
+    """
+    Sends the messages of one answer: the first through `reply` (a reply
+    token can only be used once), the rest through `push`.
+
+    `reply` and `push` may be coroutine functions; send() then returns the
+    awaitable.
+    """
+
+    def __init__(self, reply, push):
+        self.reply = reply
+        self.push = push
+        self.sent = 0
+
+    def send(self, message):
+        send = self.push if self.sent else self.reply
+        self.sent += 1
+        return send(message)
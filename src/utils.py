@@ -1,16 +1,199 @@
-# import opencc
+import os
+import re
+import functools
+import importlib.util
 
-# s2t_converter = opencc.OpenCC('s2t')
-# t2s_converter = opencc.OpenCC('t2s')
+from .logger import get_logger
+
+
+logger = get_logger('utils')
+
+S2T_DICTIONARIES = ('STPhrases.txt', 'STCharacters.txt')
+_TERM_PATTERN = re.compile(r'[0-9a-z]+|[㐀-鿿豈-﫿]+')
+
+
+class S2TConverter:
+    """
+    Simplified -> Traditional conversion with OpenCC's s2t dictionaries
+    (STPhrases + STCharacters), giving the same output as OpenCC's s2t
+    config: forward maximum matching over phrases, falling back to single
+    characters.
+
+    The dictionary is compiled once into a flattened trie: single characters
+    become a str.translate() table, and multi-character phrases are indexed
+    by their first two characters with the phrase lengths to try, longest
+    first. Positions whose bigram starts no phrase are skipped with one dict
+    lookup, and the text between phrase matches is translated in C.
+    Converted lines are memoized, since replies repeat headings, list
+    markers and boilerplate.
+
+    Environment Variables:
+        S2T_CONVERSION
+        S2T_CACHE_SIZE
+    """
+
+    def __init__(self, phrases: dict, cache_size=8192):
+        self.phrases = {key: value for key, value in phrases.items() if len(key) > 1}
+        self.table = {ord(key): value for key, value in phrases.items() if len(key) == 1}
+        self.max_len = max(map(len, self.phrases), default=2)
+        lengths = {}
+        for key in self.phrases:
+            lengths.setdefault(key[:2], set()).add(len(key))
+        self.lengths = {bigram: tuple(sorted(ls, reverse=True)) for bigram, ls in lengths.items()}
+        self.convert_line = functools.lru_cache(maxsize=cache_size)(self._convert_line)
+
+    @classmethod
+    def from_files(cls, paths, cache_size=8192):
+        phrases = {}
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    key, _, values = line.rstrip('\n').partition('\t')
+                    if key and values and key not in phrases:
+                        # 有多個候選時與 OpenCC 相同取第一個
+                        phrases[key] = values.split(' ')[0]
+        return cls(phrases, cache_size=cache_size)
+
+    def _convert(self, text: str, final=True):
+        """
+        Convert `text` from the start. Unless `final`, stop where a phrase could
+        still be extended by text that has not arrived yet; return (converted, consumed).
+        """
+        phrases, table, get = self.phrases, self.table, self.lengths.get
+        parts = []
+        n = len(text)
+        # 至少要有兩個字才可能是詞；非 final 時保留可能被下一段延長的尾巴
+        limit = n - 1 if final else n - self.max_len + 1
+        last = i = 0
+        while i < limit:
+            lengths = get(text[i:i + 2])
+            if lengths is not None:
+                for length in lengths:
+                    piece = text[i:i + length]
+                    if len(piece) == length and piece in phrases:
+                        parts.append(text[last:i].translate(table))
+                        parts.append(phrases[piece])
+                        i = last = i + length
+                        break
+                else:
+                    i += 1
+            else:
+                i += 1
+        end = n if final else max(i, last)
+        parts.append(text[last:end].translate(table))
+        return ''.join(parts), end
+
+    def _convert_line(self, line: str) -> str:
+        converted, _ = self._convert(line)
+        return converted
+
+    def convert(self, text: str) -> str:
+        if not text:
+            return text
+        # 詞典裡沒有跨行的詞，逐行轉換並快取
+        return '\n'.join(map(self.convert_line, text.split('\n')))
+
+    def stream(self):
+        return S2TStream(self)
+
+
+class S2TStream:
+    """
+    Incremental conversion of streamed text: feed() returns the converted
+    text that can no longer change, holding back the few characters a later
+    delta could still extend into a phrase. The concatenated output equals
+    convert() of the whole text.
+    """
+
+    def __init__(self, converter: S2TConverter):
+        self.converter = converter
+        self._pending = ''
+
+    def feed(self, delta: str) -> str:
+        text = self._pending + delta
+        converted, consumed = self.converter._convert(text, final=False)
+        self._pending = text[consumed:]
+        return converted
+
+    def flush(self) -> str:
+        text, self._pending = self._pending, ''
+        converted, _ = self.converter._convert(text)
+        return converted
+
+
+class IdentityStream:
+    def feed(self, delta: str) -> str:
+        return delta
+
+    def flush(self) -> str:
+        return ''
+
+
+def _opencc_dictionary_dir():
+    spec = importlib.util.find_spec('opencc')
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    return os.path.join(list(spec.submodule_search_locations)[0], 'dictionary')
+
+
+@functools.lru_cache(maxsize=None)
+def get_s2t_converter():
+    """
+    The process-wide converter, compiled on first use; None when conversion
+    is disabled or the OpenCC dictionaries are not installed.
+    """
+    if os.getenv('S2T_CONVERSION', 'true').lower() != 'true':
+        return None
+    directory = _opencc_dictionary_dir()
+    paths = [os.path.join(directory, name) for name in S2T_DICTIONARIES] if directory else []
+    if not paths or not all(os.path.exists(path) for path in paths):
+        logger.warning('OpenCC dictionaries not found; replies are not converted to Traditional Chinese')
+        return None
+    return S2TConverter.from_files(paths, cache_size=int(os.getenv('S2T_CACHE_SIZE', '8192')))
+
+
+def s2t(text: str) -> str:
+    converter = get_s2t_converter()
+    return converter.convert(text) if converter is not None else text
+
+
+def s2t_stream():
+    converter = get_s2t_converter()
+    return converter.stream() if converter is not None else IdentityStream()
+
+
+def message_text(content) -> str:
+    if isinstance(content, str):
+        return content
+    # vision 訊息的 content 是 list，圖片只留下標記
+    parts = []
+    for part in content or []:
+        if part.get('type') == 'text':
+            parts.append(part.get('text', ''))
+        else:
+            parts.append('[image]')
+    return ' '.join(parts)
+
+
+def search_terms(text: str):
+    """Lowercased words, plus the characters and character bigrams of CJK runs."""
+    terms = []
+    for token in _TERM_PATTERN.findall(text.lower()):
+        if token[0] < '㐀':
+            terms.append(token)
+            continue
+        terms.extend(token)
+        terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return terms
 
 
 def get_role_and_content(response: str):
     role = response['choices'][0]['message']['role']
     content = response['choices'][0]['message']['content'].strip()
-    # content = s2t_converter.convert(content)
+    content = s2t(content)
     return role, content
 
 def get_tool_calls(response: str):
     tool_calls = response['choices'][0]['message'].get('tool_calls')
     # function_name = [tool_call['function']['name'] for tool_call in tool_calls ]
-    return tool_calls
\ No newline at end of file
+    return tool_calls
@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import asyncio
+import datetime
+import inspect
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.v3 import WebhookHandler, WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent
+
+from .logger import get_logger
+
+logger = get_logger('webhook')
+
+
+class MongoEventIdStore:
+    """
+    Shared store of seen webhookEventIds so redeliveries are dropped across
+    instances. Expired ids are removed by a Mongo TTL index.
+    """
+
+    def __init__(self, db, ttl=600, collection='webhook_events'):
+        self.collection = db[collection]
+        self.collection.create_index('created_at', expireAfterSeconds=ttl)
+
+    def add(self, event_id: str) -> bool:
+        from pymongo.errors import DuplicateKeyError
+        try:
+            self.collection.insert_one({'_id': event_id, 'created_at': datetime.datetime.utcnow()})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def contains(self, event_id: str) -> bool:
+        return self.collection.count_documents({'_id': event_id}, limit=1) > 0
+
+    def discard(self, event_id: str):
+        self.collection.delete_one({'_id': event_id})
+
+
+class RecentEventIds:
+    """
+    Bounded set of recently seen webhookEventIds with a TTL, optionally
+    backed by a shared store for multi-instance deployments.
+    """
+
+    def __init__(self, ttl=600, max_size=10000, store=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.store = store
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self.duplicates = 0
+
+    def _evict(self, now):
+        while self._seen:
+            event_id, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.ttl and len(self._seen) <= self.max_size:
+                break
+            self._seen.popitem(last=False)
+
+    def contains(self, event_id: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            if event_id in self._seen:
+                return True
+        return self.store is not None and self.store.contains(event_id)
+
+    def add(self, event_id: str) -> bool:
+        """Record the id; return False if it was already seen (a duplicate)."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            is_new = event_id not in self._seen
+            self._seen[event_id] = now
+        if is_new and self.store is not None:
+            is_new = self.store.add(event_id)
+        if not is_new:
+            self.count_duplicates()
+        return is_new
+
+    def discard(self, event_id: str):
+        """Forget the id, e.g. because handling it failed and a redelivery must be processed."""
+        with self._lock:
+            self._seen.pop(event_id, None)
+        if self.store is not None:
+            self.store.discard(event_id)
+
+    def count_duplicates(self, count: int = 1):
+        with self._lock:
+            self.duplicates += count
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'tracked': len(self._seen),
+                'duplicates': self.duplicates,
+            }
+
+
+class IdempotentWebhookHandler(WebhookHandler):
+    """WebhookHandler that drops events whose webhookEventId was already handled."""
+
+    def __init__(self, channel_secret, event_ids: RecentEventIds = None):
+        super().__init__(channel_secret)
+        self.event_ids = event_ids or RecentEventIds()
+        # 簽章已在 _parse 中驗證過，不用再算一次
+        self._verified_parser = WebhookParser(channel_secret, skip_signature_verification=lambda: True)
+
+    def _parse(self, body: str, signature: str):
+        """Verify the signature, then parse; return None if every event in the batch was already handled."""
+        # 先驗證簽章：未簽章或偽造的 body 一律 400，也不會透露哪些 event id 已處理過
+        if not self.parser.skip_signature_verification() \
+                and not self.parser.signature_validator.validate(body, signature):
+            raise InvalidSignatureError('Invalid signature. signature=' + signature)
+        if self._is_known_redelivery(body):
+            return None
+        return self._verified_parser.parse(body, signature, as_payload=True)
+
+    def _is_known_redelivery(self, body: str) -> bool:
+        # 在建立 pydantic model 之前，先用原始 JSON 快速判斷整批是否都已處理過
+        try:
+            events = json.loads(body).get('events') or []
+        except (ValueError, AttributeError):
+            return False
+        event_ids = [event.get('webhookEventId') for event in events if isinstance(event, dict)]
+        if not event_ids or len(event_ids) != len(events):
+            return False
+        if all(event_id and self.event_ids.contains(event_id) for event_id in event_ids):
+            self.event_ids.count_duplicates(len(event_ids))
+            return True
+        return False
+
+    async def _off_loop(self, fn, *args):
+        # 共用的 event id store（Mongo）查詢會阻塞，不在 event loop 上執行
+        if self.event_ids.store is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    def is_duplicate(self, event) -> bool:
+        event_id = getattr(event, 'webhook_event_id', None)
+        if not event_id:
+            return False
+        return not self.event_ids.add(event_id)
+
+    def release(self, event):
+        """Undo is_duplicate() for an event whose handler failed, so LINE's redelivery is handled."""
+        event_id = getattr(event, 'webhook_event_id', None)
+        if event_id:
+            self.event_ids.discard(event_id)
+
+    def get_handler(self, event):
+        func = None
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(f'{event.__class__.__name__}_{event.message.__class__.__name__}')
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__)
+        return func or self._default
+
+    def dispatch(self, event, destination):
+        func = self.get_handler(event)
+        if func is None:
+            return
+        arg_spec = inspect.getfullargspec(func)
+        if arg_spec.varargs is not None or len(arg_spec.args) == 2:
+            return func(event, destination)
+        elif len(arg_spec.args) == 1:
+            return func(event)
+        else:
+            return func()
+
+    def handle(self, body, signature):
+        payload = self._parse(body, signature)
+        if payload is None:
+            return
+        for event in payload.events:
+            if self.is_duplicate(event):
+                continue
+            try:
+                self.dispatch(event, payload.destination)
+            except Exception:
+                self.release(event)
+                raise
+
+    async def handle_async(self, body, signature):
+        """handle() for coroutine handlers, used by the ASGI app."""
+        payload = await self._off_loop(self._parse, body, signature)
+        if payload is None:
+            return
+        for event in payload.events:
+            if await self._off_loop(self.is_duplicate, event):
+                continue
+            try:
+                result = self.dispatch(event, payload.destination)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                await self._off_loop(self.release, event)
+                raise
+
+
+class ConcurrentWebhookHandler(IdempotentWebhookHandler):
+    """
+    Dispatch the events of one webhook batch concurrently across users.
+
+    Events are grouped by their source (user id, else group / room id). Each
+    group runs strictly in order, so one user's events never overlap or get
+    reordered, while different users' groups run side by side: one slow
+    summary no longer holds up everybody else in the same batch. The first
+    group runs on the request thread, the rest on a shared worker pool, each
+    in a copy of the caller's contextvars.
+
+    A failed event does not stop the rest of its group. Its id is released
+    and, once every group is done, the first error is raised so the request
+    fails and LINE redelivers the batch; the events that succeeded are then
+    dropped as duplicates.
+
+    Environment Variables:
+        WEBHOOK_BATCH_WORKERS
+    """
+
+    def __init__(self, channel_secret, event_ids: RecentEventIds = None, max_workers=8):
+        super().__init__(channel_secret, event_ids)
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._counters = {
+            'batches': 0,
+            'events': 0,
+            'concurrent_batches': 0,
+            'failed_events': 0,
+        }
+
+    @classmethod
+    def from_env(cls, channel_secret, event_ids: RecentEventIds = None):
+        return cls(channel_secret, event_ids, max_workers=int(os.getenv('WEBHOOK_BATCH_WORKERS', '8')))
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='webhook-batch')
+            return self._executor
+
+    @staticmethod
+    def ordering_key(event):
+        source = getattr(event, 'source', None)
+        for attr in ('user_id', 'group_id', 'room_id'):
+            key = getattr(source, attr, None)
+            if key:
+                return key
+        return None
+
+    def _group_events(self, payload):
+        groups = OrderedDict()
+        for event in payload.events:
+            if self.is_duplicate(event):
+                continue
+            groups.setdefault(self.ordering_key(event), []).append(event)
+        with self._lock:
+            self._counters['batches'] += 1
+            self._counters['events'] += sum(len(events) for events in groups.values())
+            if len(groups) > 1:
+                self._counters['concurrent_batches'] += 1
+        return list(groups.values())
+
+    def _count_failure(self, event, error):
+        with self._lock:
+            self._counters['failed_events'] += 1
+        logger.error('webhook event %s failed', getattr(event, 'webhook_event_id', None), exc_info=error)
+
+    def _run_group(self, events, destination):
+        """:return: the first error raised by a handler of the group, if any"""
+        error = None
+        for event in events:
+            try:
+                self.dispatch(event, destination)
+            except Exception as e:
+                # 同一位使用者後續的事件仍照順序處理
+                self.release(event)
+                self._count_failure(event, e)
+                error = error or e
+        return error
+
+    def handle(self, body, signature):
+        payload = self._parse(body, signature)
+        if payload is None:
+            return
+        groups = self._group_events(payload)
+        if not groups:
+            return
+        executor = self._get_executor() if len(groups) > 1 else None
+        futures = [
+            executor.submit(contextvars.copy_context().run, self._run_group, events, payload.destination)
+            for events in groups[1:]
+        ]
+        errors = [self._run_group(groups[0], payload.destination)]
+        errors += [future.result() for future in futures]
+        error = next((e for e in errors if e is not None), None)
+        if error is not None:
+            raise error
+
+    async def _run_group_async(self, events, destination):
+        error = None
+        for event in events:
+            try:
+                result = self.dispatch(event, destination)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                await self._off_loop(self.release, event)
+                self._count_failure(event, e)
+                error = error or e
+        return error
+
+    async def handle_async(self, body, signature):
+        payload = await self._off_loop(self._parse, body, signature)
+        if payload is None:
+            return
+        groups = await self._off_loop(self._group_events, payload)
+        errors = await asyncio.gather(*(self._run_group_async(events, payload.destination) for events in groups))
+        error = next((e for e in errors if e is not None), None)
+        if error is not None:
+            raise error
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                **self._counters,
+            }
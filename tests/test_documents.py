@@ -0,0 +1,91 @@
+from src import documents as documents_module
+from src.documents import DocumentStore, PassageIndex
+
+
+def test_split_at_line_breaks():
+    text = 'aaaa\nbbbb\n\ncccc\ndddd'
+    assert PassageIndex.split(text, 10) == ['aaaa\nbbbb', 'cccc\ndddd']
+
+
+def test_split_long_line():
+    # 沒有換行的長段落直接切開
+    assert PassageIndex.split('x' * 25 + '\nyy', 10) == ['x' * 10, 'x' * 10, 'x' * 5 + '\nyy']
+
+
+def test_search_ranks_by_bm25_and_returns_document_order():
+    index = PassageIndex('doc', [
+        'the harbour opens at dawn',
+        'ferry tickets cost ten dollars; ferry tickets are sold at the pier',
+        'the museum is closed on mondays',
+        'a single ferry leaves at noon',
+    ])
+    assert index.search('ferry tickets', 1) == ['ferry tickets cost ten dollars; ferry tickets are sold at the pier']
+    assert index.search('ferry tickets', 2) == [
+        'ferry tickets cost ten dollars; ferry tickets are sold at the pier',
+        'a single ferry leaves at noon',
+    ]
+    assert index.search('volcano', 2) == []
+
+
+def test_search_cjk():
+    index = PassageIndex('doc', ['台北今天下雨', '高雄天氣晴朗'])
+    assert index.search('台北下雨了嗎', 1) == ['台北今天下雨']
+
+
+def test_search_ignores_stop_words_and_single_characters():
+    index = PassageIndex('doc', [
+        '高鐵是連接台北與高雄的鐵路，每天的班次很多',
+        'the train is the fastest way to get there',
+    ])
+    # 只有「是」「的」「天」或 the、is 重疊時不算相關
+    assert index.search('你好，今天是我的生日', 2) == []
+    assert index.search('what is the weather like', 2) == []
+    assert index.search('高鐵票價', 2) == ['高鐵是連接台北與高雄的鐵路，每天的班次很多']
+
+
+def test_search_min_score():
+    index = PassageIndex('doc', ['ferry tickets cost ten dollars', 'the museum is closed'])
+    # 問題中大部分內容詞都沒有出現在文件中
+    question = 'do you know any good pizza restaurants near the ferry pier downtown'
+    assert index.search(question, 2) == ['ferry tickets cost ten dollars']
+    assert index.search(question, 2, min_score=0.2) == []
+
+
+def test_store_expires_documents(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(documents_module.time, 'monotonic', lambda: now[0])
+    store = DocumentStore(ttl=10)
+    store.put('U', store.build('doc', ['ferry tickets']))
+    assert store.search('U', 'ferry') == ['ferry tickets']
+    now[0] += 11
+    assert store.get('U') is None
+    assert store.search('U', 'ferry') == []
+
+
+def test_store_drops_least_recently_used():
+    store = DocumentStore(max_users=2)
+    for user_id in ('A', 'B'):
+        store.put(user_id, store.build(user_id, ['text of ' + user_id]))
+    # 讀取 A 之後，最久沒用的是 B
+    assert store.get('A') is not None
+    store.put('C', store.build('C', ['text of C']))
+    assert store.get('B') is None
+    assert store.get('A') is not None
+    assert store.get('C') is not None
+    assert store.metrics()['documents'] == 2
+
+
+def test_augment_inserts_passages_before_question():
+    store = DocumentStore(passage_chars=40, top_k=1)
+    store.put('U', store.build('https://example.com', ['ferry tickets cost ten dollars', 'the museum is closed']))
+    question = {'role': 'user', 'content': 'how much are ferry tickets'}
+    messages = store.augment('U', [{'role': 'system', 'content': 'system'}, question])
+    assert messages[-1] is question
+    assert messages[1]['role'] == 'system'
+    assert messages[1]['content'].endswith('ferry tickets cost ten dollars')
+    assert 'https://example.com' in messages[1]['content']
+    # 與文件無關的問題不附加段落
+    unrelated = {'role': 'user', 'content': '你好，今天是我的生日'}
+    assert store.augment('U', [unrelated]) == [unrelated]
+    # 沒有文件時不改動
+    assert store.augment('V', [question]) == [question]
@@ -0,0 +1,102 @@
+import numpy as np
+
+from src.deadline import Deadline
+from src.longterm import HashingEmbedder, LongTermMemory, VectorIndex
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_add_keeps_newest_max_items():
+    index = VectorIndex(2, max_items=2)
+    index.add(np.stack([unit(1, 0), unit(0, 1)]), ['a', 'b'])
+    index.add(np.stack([unit(1, 1)]), ['c'])
+    assert index.texts == ['b', 'c']
+    assert index.vectors.shape == (2, 2)
+
+
+def test_search_best_first_with_positions():
+    index = VectorIndex(2, max_items=10)
+    index.add(np.stack([unit(1, 0), unit(0, 1), unit(1, 1)]), ['x', 'y', 'xy'])
+    hits = index.search(unit(1, 0), k=2)
+    assert [(position, text) for _, position, text in hits] == [(0, 'x'), (2, 'xy')]
+    assert hits[0][0] > hits[1][0]
+    # 低於 min_score 的結果不回傳
+    assert [text for _, _, text in index.search(unit(1, 0), k=3, min_score=0.5)] == ['x', 'xy']
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / 'index.npz')
+    index = VectorIndex(2, max_items=10)
+    index.add(np.stack([unit(1, 0), unit(0, 1)]), ['蘋果', 'banana'])
+    index.save(path)
+    loaded = VectorIndex.load(path, 2, max_items=10)
+    assert loaded.texts == ['蘋果', 'banana']
+    # 以 float16 儲存
+    assert np.allclose(loaded.vectors, index.vectors, atol=1e-3)
+    # 一般的 .npz，不需要 pickle
+    with np.load(path) as archive:
+        assert sorted(archive.files) == ['texts', 'vectors']
+
+
+def test_load_discards_index_when_dimension_changed(tmp_path):
+    path = str(tmp_path / 'index.npz')
+    index = VectorIndex(2, max_items=10)
+    index.add(np.stack([unit(1, 0)]), ['a'])
+    index.save(path)
+    loaded = VectorIndex.load(path, 3, max_items=10)
+    assert len(loaded) == 0
+    assert loaded.vectors.shape == (0, 3)
+
+
+def test_recall_returns_relevant_entries_oldest_first(tmp_path):
+    long_term = LongTermMemory(HashingEmbedder(), directory=str(tmp_path), top_k=2, min_score=0.1)
+    long_term.add('U', [
+        {'role': 'user', 'content': 'my cat is called Mochi'},
+        {'role': 'assistant', 'content': 'Mochi is a lovely name for a cat'},
+        {'role': 'user', 'content': 'what is the weather in Taipei'},
+        {'role': 'assistant', 'content': 'it is raining in Taipei'},
+    ])
+    assert long_term.drain(5)
+    cat = 'user: my cat is called Mochi\nassistant: Mochi is a lovely name for a cat'
+    weather = 'user: what is the weather in Taipei\nassistant: it is raining in Taipei'
+    # 較相關的是天氣那一筆，但仍依原本的先後順序回傳
+    assert long_term.recall('U', 'is it raining in Taipei, what about my cat') == [cat, weather]
+    long_term.top_k = 1
+    assert long_term.recall('U', 'Mochi the cat') == [cat]
+    # 重新建立後從目錄載入
+    reloaded = LongTermMemory(HashingEmbedder(), directory=str(tmp_path), top_k=1, min_score=0.1)
+    assert reloaded.recall('U', 'weather in Taipei') == [weather]
+
+
+class RemoteEmbedder(HashingEmbedder):
+    remote = True
+
+
+def test_recall_skipped_without_budget_for_remote_embedder():
+    long_term = LongTermMemory(RemoteEmbedder())
+    long_term.add('U', [{'role': 'user', 'content': 'my cat is called Mochi'}])
+    assert long_term.drain(5)
+    assert long_term.recall('U', 'cat', deadline=Deadline(1)) == []
+    assert long_term.metrics()['recalls_skipped'] == 1
+    assert long_term.recall('U', 'cat', deadline=Deadline(60)) == ['user: my cat is called Mochi']
+
+
+def test_local_recall_ignores_budget():
+    # 本機 hashing 不呼叫網路，剩餘時間少也照樣檢索
+    long_term = LongTermMemory(HashingEmbedder())
+    long_term.add('U', [{'role': 'user', 'content': 'my cat is called Mochi'}])
+    assert long_term.drain(5)
+    assert long_term.recall('U', 'cat', deadline=Deadline(1)) == ['user: my cat is called Mochi']
+    assert long_term.metrics()['recalls_skipped'] == 0
+
+
+def test_remove_deletes_persisted_index(tmp_path):
+    long_term = LongTermMemory(HashingEmbedder(), directory=str(tmp_path))
+    long_term.add('U', [{'role': 'user', 'content': 'hello'}])
+    long_term.remove('U')
+    assert long_term.drain(5)
+    assert list(tmp_path.iterdir()) == []
+    assert long_term.recall('U', 'hello') == []
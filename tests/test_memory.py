@@ -0,0 +1,13 @@
+from src.memory import Memory
+
+
+def test_locks_do_not_grow_with_users():
+    memory = Memory('system', memory_message_count=2, lock_stripes=8)
+    for i in range(100):
+        memory.append(f'U{i}', 'user', 'hello')
+    assert len(memory._locks) == 8
+    # 同一位使用者可以重入
+    with memory.lock('U1'):
+        memory.append('U1', 'assistant', 'hi')
+    assert [turn['content'] for turn in memory.get('U1')[1:]] == ['hello', 'hi']
+
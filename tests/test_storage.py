@@ -0,0 +1,191 @@
+import json
+
+import pytest
+
+from src.storage import FileStorage, MongoStorage
+
+
+def write_lines(path, *lines):
+    path.write_bytes(b''.join(lines))
+
+
+def record(key, value):
+    return (json.dumps(['set', key, value]) + '\n').encode('utf-8')
+
+
+def test_save_and_reload(tmp_path):
+    path = tmp_path / 'db.json'
+    storage = FileStorage(str(path), fsync=False)
+    storage.save({'a': 1})
+    storage.save({'b': 2, 'a': 3})
+    storage.close()
+    assert FileStorage(str(path)).load() == {'a': 3, 'b': 2}
+
+
+def test_torn_last_line_is_truncated(tmp_path):
+    path = tmp_path / 'db.json'
+    write_lines(path, record('a', 1), record('b', 2), b'["set", "c", ')
+    storage = FileStorage(str(path), fsync=False)
+    assert storage.load() == {'a': 1, 'b': 2}
+    assert path.read_bytes() == record('a', 1) + record('b', 2)
+    # 截斷後可以繼續 append
+    storage.save({'c': 3})
+    storage.close()
+    assert FileStorage(str(path)).load() == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_corrupt_middle_line_is_skipped_not_truncated(tmp_path):
+    path = tmp_path / 'db.json'
+    raw = record('a', 1) + b'["set", "b", \x00garbage\n' + record('c', 3) + record('d', 4)
+    write_lines(path, raw)
+    assert FileStorage(str(path)).load() == {'a': 1, 'c': 3, 'd': 4}
+    assert path.read_bytes() == raw
+
+
+def test_corrupt_last_line_with_newline_is_not_truncated(tmp_path):
+    path = tmp_path / 'db.json'
+    raw = record('a', 1) + b'not json\n'
+    write_lines(path, raw)
+    assert FileStorage(str(path)).load() == {'a': 1}
+    assert path.read_bytes() == raw
+
+
+def test_compaction_keeps_latest_values(tmp_path):
+    path = tmp_path / 'db.json'
+    storage = FileStorage(str(path), compact_ratio=2.0, compact_min_records=10, fsync=False)
+    for i in range(20):
+        storage.save({'a': i, 'b': -i})
+    storage.close()
+    lines = path.read_bytes().splitlines()
+    assert len(lines) < 10
+    assert FileStorage(str(path)).load() == {'a': 19, 'b': -19}
+
+
+def test_compaction_drops_corrupt_lines(tmp_path):
+    path = tmp_path / 'db.json'
+    write_lines(path, record('a', 1), b'garbage\n', record('b', 2))
+    storage = FileStorage(str(path), fsync=False)
+    storage.load()
+    storage.compact()
+    storage.close()
+    assert path.read_bytes() == record('a', 1) + record('b', 2)
+
+
+def test_legacy_json_object_is_converted(tmp_path):
+    path = tmp_path / 'db.json'
+    path.write_text(json.dumps({'a': 1, 'b': 2}))
+    assert FileStorage(str(path), fsync=False).load() == {'a': 1, 'b': 2}
+    assert path.read_bytes() == record('a', 1) + record('b', 2)
+
+
+class FakeCollection:
+    """The part of a pymongo collection MongoStorage uses, backed by a dict keyed by user_id."""
+
+    def __init__(self):
+        self.docs = {}
+        self.indexes = []
+        self.finds = 0
+        self.bulk_writes = []
+        self.fail_writes = 0
+
+    def create_index(self, key, **kwargs):
+        self.indexes.append((key, kwargs))
+
+    def find_one(self, query, projection=None):
+        self.finds += 1
+        doc = self.docs.get(query['user_id'])
+        return {'api_key': doc['api_key']} if doc else None
+
+    def find(self, query, projection=None):
+        return [{'user_id': doc['user_id'], 'api_key': doc['api_key']} for doc in self.docs.values()]
+
+    def bulk_write(self, requests, ordered=True):
+        if self.fail_writes:
+            self.fail_writes -= 1
+            raise RuntimeError('write failed')
+        self.bulk_writes.append(len(requests))
+        for request in requests:
+            # pymongo 的 UpdateOne 沒有公開的 getter
+            user_id = request._filter['user_id']
+            self.docs.setdefault(user_id, {}).update(request._doc['$set'])
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+
+def test_mongo_storage_creates_unique_index():
+    db = FakeDatabase()
+    MongoStorage(db)
+    assert db['api_key'].indexes == [('user_id', {'unique': True})]
+
+
+def test_mongo_storage_read_through_cache():
+    db = FakeDatabase()
+    collection = db['api_key']
+    collection.docs['U'] = {'user_id': 'U', 'api_key': 'sk-u'}
+    storage = MongoStorage(db)
+    assert storage.get('U') == 'sk-u'
+    assert storage.get('U') == 'sk-u'
+    # 查不到也會快取
+    assert storage.get('missing') is None
+    assert storage.get('missing') is None
+    assert collection.finds == 2
+    assert storage.metrics()['cache_hits'] == 2
+
+
+def test_mongo_storage_batches_saves():
+    db = FakeDatabase()
+    collection = db['api_key']
+    storage = MongoStorage(db, batch_size=3)
+    storage.save({'A': 'sk-a'})
+    storage.save({'B': 'sk-b'})
+    assert collection.bulk_writes == []
+    assert storage.get('A') == 'sk-a'
+    storage.save({'C': 'sk-c'})
+    assert collection.bulk_writes == [3]
+    storage.save({'D': 'sk-d'})
+    storage.flush()
+    assert collection.bulk_writes == [3, 1]
+    assert storage.load() == {'A': 'sk-a', 'B': 'sk-b', 'C': 'sk-c', 'D': 'sk-d'}
+
+
+def test_mongo_storage_requeues_failed_writes():
+    db = FakeDatabase()
+    collection = db['api_key']
+    storage = MongoStorage(db, batch_size=10)
+    storage.save({'A': 'sk-a', 'B': 'sk-b'})
+    collection.fail_writes = 1
+    with pytest.raises(RuntimeError):
+        storage.flush()
+    assert storage.metrics()['pending'] == 2
+    # 放回 pending 之後的新 save 會覆蓋舊值
+    storage.save({'A': 'sk-a2'})
+    storage.flush()
+    assert collection.docs['A']['api_key'] == 'sk-a2'
+    assert collection.docs['B']['api_key'] == 'sk-b'
+    assert storage.metrics()['pending'] == 0
+
+
+def test_mongo_storage_flushes_old_pending_saves(monkeypatch):
+    from src import storage as storage_module
+    now = [100.0]
+    monkeypatch.setattr(storage_module.time, 'monotonic', lambda: now[0])
+    db = FakeDatabase()
+    collection = db['api_key']
+    storage = MongoStorage(db, batch_size=100, max_delay=5)
+    storage.save({'A': 'sk-a'})
+    now[0] += 4
+    storage.save({'B': 'sk-b'})
+    assert collection.bulk_writes == []
+    # 最舊的一筆超過 max_delay，下一次 save 就寫入
+    now[0] += 2
+    storage.save({'C': 'sk-c'})
+    assert collection.bulk_writes == [3]
+    storage.save({'D': 'sk-d'})
+    storage.close()
+    assert collection.bulk_writes == [3, 1]
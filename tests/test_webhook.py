@@ -0,0 +1,87 @@
+import hmac
+import json
+import asyncio
+import base64
+import hashlib
+
+import pytest
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+from src.webhook import ConcurrentWebhookHandler, IdempotentWebhookHandler, RecentEventIds
+
+
+SECRET = 'test-secret'
+
+
+def sign(body):
+    return base64.b64encode(hmac.new(SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+def text_event(event_id, user_id='U1', text='hi'):
+    return {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': 0,
+        'webhookEventId': event_id,
+        'deliveryContext': {'isRedelivery': False},
+        'source': {'type': 'user', 'userId': user_id},
+        'replyToken': 'token-' + event_id,
+        'message': {'type': 'text', 'id': 'm-' + event_id, 'quoteToken': 'q', 'text': text},
+    }
+
+
+def body_for(*events):
+    return json.dumps({'destination': 'D', 'events': list(events)})
+
+
+@pytest.fixture(params=[IdempotentWebhookHandler, ConcurrentWebhookHandler])
+def handler(request):
+    handler = request.param(SECRET, RecentEventIds())
+    handler.handled = []
+
+    @handler.add(MessageEvent, message=TextMessageContent)
+    def on_text(event):
+        if event.message.text == 'fail':
+            raise RuntimeError('handler failed')
+        handler.handled.append(event.webhook_event_id)
+
+    return handler
+
+
+def test_redelivery_is_dropped(handler):
+    body = body_for(text_event('E1'), text_event('E2', user_id='U2'))
+    handler.handle(body, sign(body))
+    handler.handle(body, sign(body))
+    assert sorted(handler.handled) == ['E1', 'E2']
+
+
+def test_forged_redelivery_is_rejected(handler):
+    body = body_for(text_event('E1'))
+    handler.handle(body, sign(body))
+    # 已處理過的 event id 也要先驗證簽章
+    with pytest.raises(InvalidSignatureError):
+        handler.handle(body, 'forged')
+    with pytest.raises(InvalidSignatureError):
+        handler.handle(body_for(text_event('E2')), 'forged')
+    assert handler.handled == ['E1']
+
+
+def test_failed_event_is_handled_on_redelivery(handler):
+    body = body_for(text_event('E1', text='fail'), text_event('E2', user_id='U2'))
+    with pytest.raises(RuntimeError):
+        handler.handle(body, sign(body))
+    assert 'E1' not in handler.handled
+    # LINE 重送時，失敗的事件要再處理一次
+    retry = body_for(text_event('E1'), text_event('E2', user_id='U2'))
+    handler.handle(retry, sign(retry))
+    assert sorted(handler.handled) == ['E1', 'E2']
+
+
+def test_failed_event_is_released_on_the_async_path(handler):
+    body = body_for(text_event('E1', text='fail'), text_event('E2', user_id='U2'))
+    with pytest.raises(RuntimeError):
+        asyncio.run(handler.handle_async(body, sign(body)))
+    retry = body_for(text_event('E1'), text_event('E2', user_id='U2'))
+    asyncio.run(handler.handle_async(retry, sign(retry)))
+    assert sorted(handler.handled) == ['E1', 'E2']